@@ -0,0 +1,881 @@
+"""Core SmartLab analysis pipeline: parse, split, stats, z-scores/grades and explanations.
+
+These functions are free of Streamlit calls so that app.py can cache each stage
+separately and other entry points can reuse the same scoring logic.
+"""
+import csv
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+import robust
+
+# Identifier columns that are never treated as tests
+NON_TEST_COLUMNS = ['Lab Code', 'Brand code', 'Model code']
+
+# Grading table: (grade, upper |z| bound, colour, description). A z-score gets
+# the first grade whose bound is >= |z|. The UI, PDF reports and charts all
+# read their labels and colours from here.
+GRADE_TABLE = [
+    ('Excellent', 0.5, '#2ecc71', 'very close to mean'),
+    ('Good', 1.0, '#3498db', 'moderately close to mean'),
+    ('Satisfactory', 2.0, '#f39c12', 'somewhat far from mean'),
+    ('Unsatisfactory', 3.0, '#e74c3c', 'far from mean'),
+    ('Serious problem', np.inf, '#c0392b', 'very far from mean'),
+]
+NO_DATA_GRADE = 'No data'
+NO_DATA_COLOR = '#95a5a6'
+
+GRADE_LABELS = [grade for grade, _, _, _ in GRADE_TABLE] + [NO_DATA_GRADE]
+GRADE_COLORS = {grade: color for grade, _, color, _ in GRADE_TABLE}
+GRADE_COLORS[NO_DATA_GRADE] = NO_DATA_COLOR
+_GRADE_BOUNDS = np.array([bound for _, bound, _, _ in GRADE_TABLE[:-1]])
+
+
+def _grade_rules():
+    """Describe the |z| interval of every grade, e.g. 'is between 0.5 and 1.0'"""
+    rules = {}
+    lower = None
+    for grade, bound, _, _ in GRADE_TABLE:
+        if lower is None:
+            rules[grade] = f"≤ {bound:.1f}"
+        elif np.isinf(bound):
+            rules[grade] = f"> {lower:.1f}"
+        else:
+            rules[grade] = f"is between {lower:.1f} and {bound:.1f}"
+        lower = bound
+    return rules
+
+
+GRADE_RULES = _grade_rules()
+
+# Statistics estimators: estimator -> (label, location name, scale name). The
+# chosen location and scale replace the mean and SD in z = (x - mean) / SD.
+ESTIMATORS = {
+    'classical': ('Mean / standard deviation', 'Mean', 'Std Dev'),
+    'mad': ('Median / scaled MAD', 'Median', 'Scaled MAD'),
+    'algorithm_a': ('ISO 13528 Algorithm A (robust)', 'Robust Mean', 'Robust SD'),
+}
+
+# Compact mode stores test values and z-scores at single precision
+COMPACT_FLOAT = 'float32'
+
+
+def hash_bytes(raw_bytes):
+    """Return a stable content hash for an uploaded file"""
+    return hashlib.sha256(raw_bytes).hexdigest()
+
+
+# Round file formats accepted for upload: format -> file extensions
+ROUND_FORMATS = {
+    'csv': ['.csv'],
+    'parquet': ['.parquet'],
+    'feather': ['.feather', '.arrow', '.ipc'],
+}
+
+
+def round_format(filename):
+    """Format of a round file from its extension; anything unknown is read as CSV"""
+    extension = os.path.splitext(filename)[1].lower()
+    for fmt, extensions in ROUND_FORMATS.items():
+        if extension in extensions:
+            return fmt
+    return 'csv'
+
+
+def _csv_header(raw_bytes):
+    first_line = BytesIO(raw_bytes).readline().decode('utf-8-sig')
+    return next(csv.reader([first_line]), [])
+
+
+def _read_csv(raw_bytes, float_cols):
+    """Read a CSV with the given columns typed as float64.
+
+    Uses pyarrow's multithreaded CSV reader when it is installed and the pandas
+    C parser otherwise. Both raise ValueError if a typed column holds text.
+    """
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+    except ImportError:
+        return pd.read_csv(BytesIO(raw_bytes), dtype={col: 'float64' for col in float_cols})
+
+    table = pa_csv.read_csv(
+        pa.BufferReader(raw_bytes),
+        read_options=pa_csv.ReadOptions(use_threads=True),
+        convert_options=pa_csv.ConvertOptions(column_types={col: pa.float64() for col in float_cols}),
+    )
+    return table.to_pandas()
+
+
+def _read_columnar(raw_bytes, fmt):
+    """Load a Parquet or Feather/Arrow IPC file straight from the uploaded buffer"""
+    import pyarrow as pa
+
+    # BufferReader wraps the upload without copying it
+    source = pa.BufferReader(raw_bytes)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(source)
+    else:
+        import pyarrow.feather as feather
+        table = feather.read_table(source, memory_map=False)
+    return table.to_pandas()
+
+
+def _non_test_kind(dtype):
+    """What a date/time, duration or boolean column holds; None for any other dtype"""
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'date/time'
+    if pd.api.types.is_timedelta64_dtype(dtype):
+        return 'duration'
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'true/false'
+    return None
+
+
+def test_column(values):
+    """A column parsed as a test: ``(values, kind, invalid)``.
+
+    ``kind`` names a date/time, duration or true/false column (``values`` is
+    then None); otherwise ``values`` is the float64 column and ``invalid``
+    counts the stray text values that became missing.
+    """
+    kind = _non_test_kind(values.dtype)
+    if kind:
+        return None, kind, 0
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        return values.astype('float64'), None, 0
+    numbers = pd.to_numeric(values, errors='coerce').astype('float64')
+    return numbers, None, int((numbers.isna() & values.notna()).sum())
+
+
+def column_warning(col, kind=None, invalid=0, is_test=True):
+    """Schema warning about one column (see apply_round_schema), or None"""
+    if kind:
+        return f"Column '{col}' holds {kind} values and is not analyzed as a test."
+    if not is_test:
+        return f"Column '{col}' has no numeric values and is not analyzed as a test."
+    if invalid:
+        return f"Test '{col}': {invalid} non-numeric value(s) treated as missing data."
+    return None
+
+
+def apply_round_schema(df):
+    """Give every test column (anything but the identifiers) the float64 dtype.
+
+    A test column with stray text values keeps its numeric values and the text
+    becomes missing; a column without any numeric value is left as text and
+    is not a test. Date/time, duration and true/false columns (e.g. a
+    submission timestamp) are kept as they are and are not tests either.
+    Returns ``(df, warnings)`` describing these cases.
+    """
+    warnings = []
+    for col in df.columns:
+        if col in NON_TEST_COLUMNS or pd.api.types.is_float_dtype(df[col].dtype):
+            continue
+        values, kind, invalid = test_column(df[col])
+        is_test = not kind and not (invalid and values.isna().all())
+        if is_test:
+            df[col] = values
+        warning = column_warning(col, kind, invalid, is_test)
+        if warning:
+            warnings.append(warning)
+    return df, warnings
+
+
+def read_round(raw_bytes, fmt='csv'):
+    """Parse an uploaded round with an explicit schema, treating zero values as missing data.
+
+    Returns ``(df, warnings)``; see apply_round_schema for the warnings.
+    """
+    if fmt == 'csv':
+        float_cols = [col for col in _csv_header(raw_bytes) if col not in NON_TEST_COLUMNS]
+        try:
+            df = _read_csv(raw_bytes, float_cols)
+        except ValueError:
+            # Some test column holds text: infer its type and coerce it below
+            df = _read_csv(raw_bytes, [])
+    elif fmt in ('parquet', 'feather'):
+        df = _read_columnar(raw_bytes, fmt)
+    else:
+        raise ValueError(f"Unsupported round file format: {fmt}")
+
+    df, warnings = apply_round_schema(df)
+    return df.replace(0, np.nan), warnings
+
+
+# Column of a merged round naming the file every row came from
+SOURCE_FILE_COLUMN = 'Source file'
+
+
+def hash_files(files):
+    """Stable content hash of several uploaded ``(name, raw_bytes)`` files, in order"""
+    digest = hashlib.sha256()
+    for name, raw_bytes in files:
+        digest.update(f"{name}\0{hash_bytes(raw_bytes)}\0".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _check_round_columns(name, columns):
+    missing = [col for col in NON_TEST_COLUMNS if col not in columns]
+    if missing:
+        raise ValueError(f"{name} is missing column(s): {', '.join(missing)}")
+
+
+def read_round_file(name, raw_bytes):
+    """Parse one named round file and check that it has the identifier columns.
+
+    Returns ``(df, warnings)`` with the file name in every warning. Raises
+    ValueError with a readable message naming the file; a CSV header is checked
+    before the file is parsed.
+    """
+    fmt = round_format(name)
+    if fmt == 'csv':
+        try:
+            header = _csv_header(raw_bytes)
+        except UnicodeDecodeError:
+            raise ValueError(f"{name} is not a UTF-8 text file") from None
+        _check_round_columns(name, header)
+    try:
+        df, warnings = read_round(raw_bytes, fmt)
+    except ValueError as e:
+        raise ValueError(f"{name}: {e}") from e
+    _check_round_columns(name, df.columns)
+    return df, [f"{name}: {warning}" for warning in warnings]
+
+
+def lab_code_text(lab_codes):
+    """Lab Codes as text, so numeric and text Lab Codes can be mixed; missing codes stay missing.
+
+    Whole numbers read as floats (e.g. 1001.0 in a column with gaps) lose the
+    '.0', so they match the same lab's integer code elsewhere.
+    """
+    codes = pd.Series(lab_codes)
+    keys = codes.astype(str).astype(object)
+    if pd.api.types.is_float_dtype(codes.dtype):
+        whole = codes.notna() & (codes % 1 == 0)
+        keys[whole] = codes[whole].astype('int64').astype(str)
+    keys[codes.isna()] = None
+    return keys.to_numpy()
+
+
+def read_rounds(files, max_workers=None):
+    """Parse several round files concurrently and merge them into one round.
+
+    ``files`` is a list of ``(name, raw_bytes)``, e.g. one file per site. Each
+    file is parsed and checked for the identifier columns on a thread pool (the
+    Arrow readers release the GIL). The merged round has the union of the test
+    columns, missing where a file lacks a test, and a categorical
+    SOURCE_FILE_COLUMN. Returns ``(df, warnings, duplicates)``; see
+    cross_file_duplicates. Raises ValueError naming the first unreadable file.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or min(len(files), os.cpu_count() or 1)) as pool:
+        parsed = list(pool.map(lambda file: read_round_file(*file), files))
+
+    warnings = [warning for _, file_warnings in parsed for warning in file_warnings]
+    numeric_codes = [pd.api.types.is_numeric_dtype(file_df['Lab Code'].dtype) for file_df, _ in parsed]
+    if any(numeric_codes) and not all(numeric_codes):
+        # Mixed numbers and text could not be sorted, split to Parquet or saved to the history
+        for file_df, _ in parsed:
+            file_df['Lab Code'] = lab_code_text(file_df['Lab Code'])
+        text_files = [name for (name, _), numeric in zip(files, numeric_codes) if not numeric]
+        warnings.append(f"Lab Codes are text in {', '.join(text_files)} and numbers in the other files; "
+                        "all Lab Codes were converted to text (e.g. 1001.0 becomes '1001').")
+    df = pd.concat([file_df for file_df, _ in parsed], ignore_index=True, sort=False)
+    # A test that is text in one file and numeric in another is coerced once more after the merge
+    df, merge_warnings = apply_round_schema(df)
+    # Columns a file already reported on are not reported again for the merged round
+    warnings += [warning for warning in merge_warnings
+                 if not any(file_warning.endswith(f": {warning}") for file_warning in warnings)]
+
+    # Repeated file names get a number so every source stays distinguishable
+    names = []
+    for name, _ in files:
+        label, n = name, 1
+        while label in names:
+            n += 1
+            label = f"{name} ({n})"
+        names.append(label)
+    codes = np.repeat(np.arange(len(parsed)), [len(file_df) for file_df, _ in parsed])
+    df[SOURCE_FILE_COLUMN] = pd.Categorical.from_codes(codes, categories=names)
+    return df, warnings, cross_file_duplicates(df)
+
+
+def cross_file_duplicates(df):
+    """(Lab Code, Model code) pairs submitted in more than one source file.
+
+    One row per pair, in order of first appearance, with the files it appears
+    in and its number of rows. Only the first of these rows is used by the
+    viewer and reports (see LabIndex).
+    """
+    columns = ['Lab Code', 'Model code', 'Files', 'Rows']
+    model_ids, model_codes = pd.factorize(df['Model code'])
+    n_models = max(len(model_codes), 1)
+    lab_codes = df['Lab Code'].to_numpy()
+    if not (lab_codes.dtype.kind in 'iu' and len(lab_codes)
+            and -2 ** 62 // n_models < lab_codes.min() and lab_codes.max() < 2 ** 62 // n_models):
+        # Other Lab Codes (text, or integers too large to combine) are numbered first
+        lab_codes, _ = pd.factorize(lab_codes)
+    pair_ids, pair_keys = pd.factorize(lab_codes.astype('int64') * n_models + model_ids)
+    source_codes = df[SOURCE_FILE_COLUMN].cat.codes.to_numpy()
+
+    # Rows of a merged round are grouped by file, so a pair spans several files
+    # exactly when its first and last rows come from different files
+    first_source = np.empty(len(pair_keys), dtype=source_codes.dtype)
+    first_source[pair_ids[::-1]] = source_codes[::-1]
+    last_source = np.empty(len(pair_keys), dtype=source_codes.dtype)
+    last_source[pair_ids] = source_codes
+    repeated = np.flatnonzero((first_source != last_source)[pair_ids])
+    if len(repeated) == 0:
+        return pd.DataFrame(columns=columns)
+
+    # Only the flagged rows remain: list each pair's files in file order
+    flagged_ids, _ = pd.factorize(pair_ids[repeated])
+    n_sources = len(df[SOURCE_FILE_COLUMN].cat.categories)
+    combos = np.unique(flagged_ids.astype('int64') * n_sources + source_codes[repeated])
+    names = list(df[SOURCE_FILE_COLUMN].cat.categories)
+    files = [[] for _ in range(flagged_ids.max() + 1)]
+    for pair, code in zip((combos // n_sources).tolist(), (combos % n_sources).tolist()):
+        files[pair].append(names[code])
+
+    first_rows = repeated[pd.Series(flagged_ids).drop_duplicates().index]
+    return pd.DataFrame({
+        'Lab Code': df['Lab Code'].to_numpy()[first_rows],
+        'Model code': df['Model code'].to_numpy()[first_rows],
+        'Files': [", ".join(pair_files) for pair_files in files],
+        'Rows': np.bincount(flagged_ids),
+    }, columns=columns)
+
+
+def group_rows_by_model(df):
+    """Group row positions by Model code in a single pass.
+
+    Returns ``(model_rows, model_counts)``: the positional row indices of every
+    model, in order of first appearance, and the number of records per model.
+    """
+    model_rows = df.groupby('Model code', sort=False, observed=True).indices
+    model_counts = {model_code: len(rows) for model_code, rows in model_rows.items()}
+    return model_rows, model_counts
+
+
+def model_frame(df, model_rows, model_code):
+    """Materialize the rows of a single model"""
+    return df.iloc[model_rows[model_code]]
+
+
+# Function to split CSV by Model code
+def compact_frame(df):
+    """Downcast a round or scored frame to a compact in-memory representation.
+
+    Float columns (test values, z-scores) become float32, Brand/Model codes
+    become categoricals and integer Lab Codes use the smallest integer type.
+    Grade columns are already categorical.
+    """
+    columns = {}
+    for col in df.columns:
+        series = df[col]
+        if col in NON_TEST_COLUMNS and col != 'Lab Code' and not isinstance(series.dtype, pd.CategoricalDtype):
+            series = series.astype('category')
+        elif col == 'Lab Code' and pd.api.types.is_integer_dtype(series.dtype):
+            series = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_float_dtype(series.dtype):
+            series = series.astype(COMPACT_FLOAT)
+        columns[col] = series
+    return pd.DataFrame(columns, index=df.index)
+
+
+def standard_frame(df):
+    """Undo compact_frame: float64 values, plain identifier columns"""
+    columns = {}
+    for col in df.columns:
+        series = df[col]
+        if col in NON_TEST_COLUMNS and isinstance(series.dtype, pd.CategoricalDtype):
+            series = series.astype(series.cat.categories.dtype)
+        elif col in NON_TEST_COLUMNS and pd.api.types.is_integer_dtype(series.dtype):
+            series = series.astype('int64')
+        elif pd.api.types.is_float_dtype(series.dtype):
+            series = series.astype('float64')
+        columns[col] = series
+    return pd.DataFrame(columns, index=df.index)
+
+
+def frame_bytes(df):
+    """Deep memory usage of a frame, including string and categorical payloads"""
+    return int(df.memory_usage(deep=True).sum())
+
+
+def memory_report(frames):
+    """Bytes per pipeline stage in the standard and the compact representation.
+
+    ``frames`` maps stage names to the frames currently held, in either form.
+    """
+    rows = []
+    for stage, df in frames.items():
+        standard = frame_bytes(standard_frame(df))
+        compact = frame_bytes(compact_frame(df))
+        rows.append({
+            'Stage': stage,
+            'Rows': len(df),
+            'Standard (bytes)': standard,
+            'Compact (bytes)': compact,
+            'Saving': f"{1 - compact / standard:.0%}" if standard else "",
+        })
+    return pd.DataFrame(rows)
+
+
+def get_numeric_cols(df):
+    """Select numeric test columns, excluding the identifier columns"""
+    numeric_cols = df.select_dtypes(include=np.number).columns
+    # select_dtypes counts durations as numbers
+    return [col for col in numeric_cols if col not in NON_TEST_COLUMNS and _non_test_kind(df[col].dtype) is None]
+
+
+def compute_stats(meandata, numeric_cols, estimator='classical'):
+    """Calculate mean, standard deviation and count for every test.
+
+    With a robust ``estimator`` (see ESTIMATORS) 'mean' and 'std' hold its
+    location and scale, estimated for all tests in one array operation, and
+    'scale_fallback' tells whether the robust scale was 0 and the classical
+    SD is used instead (see robust).
+    """
+    if estimator != 'classical':
+        values = meandata[numeric_cols].to_numpy(dtype=float)
+        location, scale, fallback = robust.grouped_estimates(values, np.zeros(len(values), dtype=int), 1, estimator)
+        counts = meandata[numeric_cols].count()
+        return {
+            col: {'mean': location[0, i], 'std': scale[0, i], 'count': counts[col],
+                  'scale_fallback': bool(fallback[0, i])}
+            for i, col in enumerate(numeric_cols)
+        }
+
+    stats_dict = {}
+    for col in numeric_cols:
+        # Accumulate in double precision even when the values are stored as float32
+        values = meandata[col].astype('float64')
+        stats_dict[col] = {
+            'mean': values.mean(),
+            'std': values.std(),
+            'count': values.count()
+        }
+    return stats_dict
+
+
+def scale_fallback_tests(stats_dict, numeric_cols):
+    """Tests whose robust scale was 0 and use the classical SD instead"""
+    return [col for col in numeric_cols if stats_dict[col].get('scale_fallback')]
+
+
+def stats_table(stats_dict, numeric_cols, estimator='classical'):
+    """Summarise stats_dict as a display table, with columns named after the estimator"""
+    _, location, scale = ESTIMATORS[estimator]
+    return pd.DataFrame({
+        'Test': numeric_cols,
+        'Average' if estimator == 'classical' else location: [stats_dict[col]['mean'] for col in numeric_cols],
+        scale: [stats_dict[col]['std'] for col in numeric_cols],
+        'Count': [stats_dict[col]['count'] for col in numeric_cols]
+    }).round(2)
+
+
+class RoundStats:
+    """Mean, standard deviation and count of every (model, test) of a round.
+
+    ``mean``, ``std`` and ``count`` are frames indexed by model code with one
+    column per test, computed in a single grouped aggregation (the same layout
+    as ingest.RunningStats). Robust estimators fill ``mean`` and ``std`` with
+    their location and scale for all models and tests at once, and mark in
+    ``scale_fallback`` where the robust scale was 0 and the classical SD is
+    used instead.
+    """
+
+    def __init__(self, df, numeric_cols, estimator='classical'):
+        self.test_cols = list(numeric_cols)
+        self.estimator = estimator
+        # Accumulate in double precision even when the values are stored as float32
+        values = df[self.test_cols].astype('float64')
+        groups = values.groupby(df['Model code'], sort=False, observed=True)
+        self.count = groups.count()
+        if estimator == 'classical':
+            self.mean = groups.mean()
+            self.std = groups.std()
+            self.scale_fallback = None
+        else:
+            group_index = self.count.index.get_indexer(df['Model code'])
+            # Rows without a Model code belong to no model, as in the classical groupby
+            in_model = group_index >= 0
+            location, scale, fallback = robust.grouped_estimates(
+                values.to_numpy()[in_model], group_index[in_model], len(self.count.index), estimator)
+            self.mean = pd.DataFrame(location, index=self.count.index, columns=self.test_cols)
+            self.std = pd.DataFrame(scale, index=self.count.index, columns=self.test_cols)
+            self.scale_fallback = pd.DataFrame(fallback, index=self.count.index, columns=self.test_cols)
+
+    def stats_dict(self, model_code):
+        """Statistics of one model in the same shape as compute_stats"""
+        mean = self.mean.loc[model_code]
+        std = self.std.loc[model_code]
+        count = self.count.loc[model_code]
+        stats_dict = {
+            col: {'mean': mean[col], 'std': std[col], 'count': int(count[col])}
+            for col in self.test_cols
+        }
+        if self.scale_fallback is not None:
+            fallback = self.scale_fallback.loc[model_code]
+            for col in self.test_cols:
+                stats_dict[col]['scale_fallback'] = bool(fallback[col])
+        return stats_dict
+
+
+def round_zscores(values_df, numeric_cols, round_stats):
+    """Z-scores for rows of any models, each against its own model's statistics"""
+    model_codes = values_df['Model code']
+    means = round_stats.mean.reindex(model_codes).to_numpy()
+    stds = round_stats.std.reindex(model_codes).to_numpy()
+    return pd.DataFrame(
+        np.round((values_df[numeric_cols].to_numpy(dtype=float) - means) / stds, 2),
+        columns=numeric_cols,
+        index=values_df.index,
+    )
+
+
+def score_round(values_df, numeric_cols, round_stats):
+    """Z-scores and grades for rows of any models, each against its own model's statistics"""
+    return assemble_scores(values_df, numeric_cols, round_zscores(values_df, numeric_cols, round_stats))
+
+
+def overview_statistics(round_stats, grade_counts_by_model=None):
+    """Test statistics of every model in one long table, optionally with grade counts"""
+    overview = pd.concat({
+        'Average': round_stats.mean.stack(future_stack=True),
+        'Std Dev': round_stats.std.stack(future_stack=True),
+        'Count': round_stats.count.stack(future_stack=True).astype('int64'),
+    }, axis=1).round(2)
+    overview.index.names = ['Model code', 'Test']
+    if grade_counts_by_model is not None:
+        overview = overview.join(grade_counts_by_model)
+    return overview.reset_index()
+
+
+def grade_counts_by_model(scored, numeric_cols):
+    """Labs per grade for every (model, test): a frame indexed by (model code, test)"""
+    model_index, model_codes = pd.factorize(scored['Model code'], sort=False)
+    n_grades = len(GRADE_LABELS)
+    counts = np.zeros((len(model_codes), len(numeric_cols), n_grades), dtype='int64')
+    for i, col in enumerate(numeric_cols):
+        codes = scored[f'{col}_grade'].cat.codes.to_numpy()
+        counts[:, i, :] = np.bincount(
+            model_index * n_grades + codes, minlength=len(model_codes) * n_grades
+        ).reshape(len(model_codes), n_grades)
+    index = pd.MultiIndex.from_product([model_codes, numeric_cols], names=['Model code', 'Test'])
+    return pd.DataFrame(counts.reshape(-1, n_grades), index=index, columns=GRADE_LABELS)
+
+
+def model_grade_summary(grade_counts_by_model, model_counts):
+    """Share of results per grade for every model, all tests pooled"""
+    totals = grade_counts_by_model.groupby(level='Model code', sort=False, observed=True).sum()
+    shares = totals.div(totals.sum(axis=1), axis=0).mul(100).round(1)
+    shares.columns = [f'{grade} %' for grade in shares.columns]
+    shares.insert(0, 'Records', pd.Series(model_counts).reindex(shares.index))
+    return shares.reset_index()
+
+
+def grade_codes(zscores):
+    """Bin a 2-D array of z-scores into grade codes (indexes into GRADE_LABELS)"""
+    abs_z = np.abs(np.asarray(zscores, dtype=float))
+    codes = np.searchsorted(_GRADE_BOUNDS, abs_z, side='left')
+    codes[np.isnan(abs_z)] = len(GRADE_LABELS) - 1
+    return codes
+
+
+def grade_matrix(zscore_df):
+    """Grade a whole block of z-score columns at once into categorical columns"""
+    codes = grade_codes(zscore_df.to_numpy(dtype=float))
+    return pd.DataFrame({
+        col: pd.Categorical.from_codes(codes[:, i], categories=GRADE_LABELS)
+        for i, col in enumerate(zscore_df.columns)
+    }, index=zscore_df.index)
+
+
+def score_model(model_df, numeric_cols, stats_dict):
+    """Compute z-scores and grades for one model and arrange the output columns"""
+    means = pd.Series({col: stats_dict[col]['mean'] for col in numeric_cols})
+    stds = pd.Series({col: stats_dict[col]['std'] for col in numeric_cols})
+    zscores = ((model_df[numeric_cols] - means) / stds).round(2)
+    return assemble_scores(model_df, numeric_cols, zscores)
+
+
+def assemble_scores(values_df, numeric_cols, zscores):
+    """Grade a block of z-scores and lay out ids, values, z-scores and grades per test"""
+    # Process data - Include original columns in output
+    new_columns = list(NON_TEST_COLUMNS)
+    for col in numeric_cols:
+        new_columns.extend([col, f'{col}_zscore', f'{col}_grade'])
+
+    grades = grade_matrix(zscores)
+
+    meandata = pd.concat([
+        values_df[NON_TEST_COLUMNS + list(numeric_cols)],
+        zscores.add_suffix('_zscore'),
+        grades.add_suffix('_grade'),
+    ], axis=1)
+
+    return meandata[new_columns]
+
+
+def format_explanation(value, zscore, grade, mean_val, std_val):
+    """Return (calculation, grade_explanation) strings for one test result"""
+    if pd.isna(value):
+        calculation = "No data available"
+    else:
+        # !s keeps float32 values at their short representation
+        calculation = f"Z-Score = ({value!s} - {mean_val:.2f}) / {std_val:.2f} = {zscore!s}"
+
+    if pd.isna(zscore):
+        grade_explanation = "No data available for grading"
+    else:
+        grade_explanation = f"Grade '{grade}' assigned because |{zscore!s}| " + GRADE_RULES.get(grade, "")
+
+    return calculation, grade_explanation
+
+
+class ExplanationProvider:
+    """Calculation and grade explanation strings for a scored model.
+
+    ``explain`` formats a single (lab, test) cell lazily for the viewer (see
+    also LabIndex.record for whole-lab reports); ``full_columns`` builds every explanation column with
+    vectorized string operations for full exports.
+    """
+
+    def __init__(self, meandata, numeric_cols, stats_dict):
+        self.meandata = meandata
+        self.numeric_cols = list(numeric_cols)
+        self.stats_dict = stats_dict
+
+    def explain(self, lab_index, col):
+        """Return (calculation, grade_explanation) for one lab and test"""
+        return format_explanation(
+            self.meandata.at[lab_index, col],
+            self.meandata.at[lab_index, f'{col}_zscore'],
+            self.meandata.at[lab_index, f'{col}_grade'],
+            self.stats_dict[col]['mean'],
+            self.stats_dict[col]['std'],
+        )
+
+    def full_columns(self):
+        """Build all `{col}_calculation` and `{col}_grade_explanation` columns"""
+        columns = {}
+        for col in self.numeric_cols:
+            mean_val = self.stats_dict[col]['mean']
+            std_val = self.stats_dict[col]['std']
+            values = self.meandata[col]
+            zscores = self.meandata[f'{col}_zscore']
+            zscore_text = zscores.astype(str)
+
+            calculation = ("Z-Score = (" + values.astype(str) +
+                           f" - {mean_val:.2f}) / {std_val:.2f} = " + zscore_text)
+            columns[f'{col}_calculation'] = calculation.where(values.notna(), "No data available")
+
+            grades = self.meandata[f'{col}_grade'].astype(str)
+            explanation = ("Grade '" + grades + "' assigned because |" + zscore_text + "| " +
+                           grades.map(GRADE_RULES).fillna(""))
+            columns[f'{col}_grade_explanation'] = explanation.where(zscores.notna(), "No data available for grading")
+
+        return pd.DataFrame(columns, index=self.meandata.index)
+
+
+def _float_block(frame):
+    """Columns as one float array, staying float32 when the frame is compact"""
+    compact = len(frame.columns) and all(dtype == COMPACT_FLOAT for dtype in frame.dtypes)
+    return frame.to_numpy(dtype=COMPACT_FLOAT if compact else float)
+
+
+class LabIndex:
+    """Processed results of one model keyed by Lab Code.
+
+    Built once per model. Lab lookups are hash lookups instead of boolean scans,
+    and ``record`` fetches the value, z-score, grade and explanations of every
+    test of a lab at once. When a Lab Code appears more than once only its first
+    row is used; the repeated codes are listed in ``duplicates``.
+    """
+
+    def __init__(self, meandata, numeric_cols, stats_dict):
+        self.numeric_cols = list(numeric_cols)
+        self.stats_dict = stats_dict
+
+        lab_codes = meandata['Lab Code']
+        repeated = lab_codes.duplicated(keep='first')
+        self.duplicates = lab_codes[lab_codes.isin(lab_codes[repeated])].value_counts(sort=False)
+        labs = meandata[~repeated.to_numpy()]
+
+        self.lab_codes = pd.Index(labs['Lab Code'])
+        self.row_labels = labs.index
+        self._values = _float_block(labs[self.numeric_cols])
+        self._zscores = _float_block(labs[[f'{col}_zscore' for col in self.numeric_cols]])
+        self._grade_codes = np.column_stack([
+            labs[f'{col}_grade'].cat.codes.to_numpy() for col in self.numeric_cols
+        ]) if self.numeric_cols else np.empty((len(labs), 0), dtype=int)
+        self._means = np.array([stats_dict[col]['mean'] for col in self.numeric_cols], dtype=float)
+        self._stds = np.array([stats_dict[col]['std'] for col in self.numeric_cols], dtype=float)
+
+    def __contains__(self, lab_code):
+        return lab_code in self.lab_codes
+
+    def __len__(self):
+        return len(self.lab_codes)
+
+    def position(self, lab_code):
+        return self.lab_codes.get_loc(lab_code)
+
+    def row_label(self, lab_code):
+        """Index label of the lab's row in the processed results"""
+        return self.row_labels[self.position(lab_code)]
+
+    def record(self, lab_code):
+        """Value, z-score, grade and explanations of every test for one lab, indexed by test"""
+        pos = self.position(lab_code)
+        values = self._values[pos]
+        zscores = self._zscores[pos]
+        grades = pd.Categorical.from_codes(self._grade_codes[pos], categories=GRADE_LABELS)
+
+        explanations = [
+            format_explanation(value, zscore, grade, mean_val, std_val)
+            for value, zscore, grade, mean_val, std_val in zip(values, zscores, grades, self._means, self._stds)
+        ]
+
+        return pd.DataFrame({
+            'Value': values,
+            'Z-Score': zscores,
+            'Grade': grades,
+            'Calculation': [calculation for calculation, _ in explanations],
+            'Grade Explanation': [grade_explanation for _, grade_explanation in explanations],
+        }, index=pd.Index(self.numeric_cols, name='Test'))
+
+
+def grade_counts(meandata, numeric_cols):
+    """Number of labs per grade for every test: a (tests x GRADE_LABELS) frame"""
+    counts = np.zeros((len(numeric_cols), len(GRADE_LABELS)), dtype='int64')
+    for i, col in enumerate(numeric_cols):
+        counts[i] = np.bincount(meandata[f'{col}_grade'].cat.codes.to_numpy(), minlength=len(GRADE_LABELS))
+    return pd.DataFrame(counts, index=pd.Index(numeric_cols, name='Test'), columns=GRADE_LABELS)
+
+
+# Box plots keep at most this many of the most extreme outliers per test
+MAX_BOX_FLIERS = 50
+
+
+def zscore_box_stats(meandata, numeric_cols, max_fliers=MAX_BOX_FLIERS):
+    """Box-plot summary of the z-scores of every test, in matplotlib's ``bxp`` format.
+
+    Quartiles use linear interpolation and whiskers reach the most extreme
+    z-score within 1.5 IQR of the box, as in matplotlib's boxplot. Tests without
+    any z-score are left out.
+    """
+    box_stats = []
+    for col in numeric_cols:
+        zscores = meandata[f'{col}_zscore'].dropna().to_numpy(dtype=float)
+        if len(zscores) == 0:
+            continue
+        q1, med, q3 = np.percentile(zscores, [25, 50, 75])
+        iqr = q3 - q1
+        inside = zscores[(zscores >= q1 - 1.5 * iqr) & (zscores <= q3 + 1.5 * iqr)]
+        fliers = zscores[(zscores < inside.min()) | (zscores > inside.max())]
+        if len(fliers) > max_fliers:
+            fliers = fliers[np.argsort(-np.abs(fliers))[:max_fliers]]
+        box_stats.append({
+            'label': col,
+            'q1': q1,
+            'med': med,
+            'q3': q3,
+            'whislo': inside.min(),
+            'whishi': inside.max(),
+            'fliers': np.sort(fliers),
+            'n': len(zscores),
+        })
+    return box_stats
+
+
+# Page sizes offered by the processed results table
+RESULTS_PAGE_SIZES = [25, 50, 100, 250]
+
+# Sort key of the results table for the largest |z-score| of a lab
+WORST_ZSCORE = 'Worst |z-score|'
+
+
+def result_order(meandata, numeric_cols, grades=None, test=None, sort_by='Lab Code', descending=False):
+    """Row positions of the processed results after filtering and sorting.
+
+    With ``grades``, only labs whose ``test`` (any test if None) has one of
+    those grades are kept; the match runs on the categorical grade codes.
+    ``sort_by`` is 'Lab Code', a test (sorted by its z-score) or WORST_ZSCORE.
+    Missing values sort last in either direction.
+    """
+    positions = np.arange(len(meandata))
+    if grades:
+        tests = [test] if test else numeric_cols
+        codes = np.column_stack([meandata[f'{col}_grade'].cat.codes.to_numpy() for col in tests])
+        wanted = [GRADE_LABELS.index(grade) for grade in grades]
+        positions = positions[np.isin(codes, wanted).any(axis=1)]
+
+    if sort_by == WORST_ZSCORE:
+        abs_z = np.abs(meandata[[f'{col}_zscore' for col in numeric_cols]].to_numpy(dtype=float))
+        abs_z[np.isnan(abs_z)] = -np.inf
+        keys = abs_z.max(axis=1)
+        keys[np.isneginf(keys)] = np.nan
+    elif sort_by == 'Lab Code':
+        keys = meandata['Lab Code'].to_numpy()
+    else:
+        keys = meandata[f'{sort_by}_zscore'].to_numpy(dtype=float)
+
+    order = pd.Series(keys[positions]).sort_values(ascending=not descending, na_position='last', kind='stable')
+    return positions[order.index.to_numpy()]
+
+
+def results_page(meandata, positions, page, page_size):
+    """The rows of one page (numbered from 0) of an ordered results table"""
+    return meandata.iloc[positions[page * page_size:(page + 1) * page_size]]
+
+
+# CSS for every grade, in the order of the categorical grade codes
+GRADE_CSS = np.array([f'background-color: {GRADE_COLORS[grade]}; color: white;' for grade in GRADE_LABELS])
+
+
+def _color_grades(grades):
+    return pd.DataFrame(
+        {col: GRADE_CSS[grades[col].cat.codes.to_numpy()] for col in grades.columns},
+        index=grades.index
+    )
+
+
+def style_results(meandata, numeric_cols):
+    """Styler for (a page of) processed results: grade cells coloured, numbers to two decimals"""
+    # Grade colours are looked up from the categorical codes in one pass over the grade block
+    grade_columns = [col for col in meandata.columns if '_grade' in col]
+    styled = meandata.style.apply(_color_grades, subset=grade_columns, axis=None)
+
+    numeric_format = {col: "{:.2f}" for col in numeric_cols}
+    zscore_format = {col: "{:.2f}" for col in meandata.columns if '_zscore' in col}
+    return styled.format({**numeric_format, **zscore_format})
+
+
+def export_frame(meandata, numeric_cols, calc_details):
+    """Processed results with the calculation details appended for download"""
+    download_df = meandata.copy()
+    for col in numeric_cols:
+        download_df[f'{col}_calculation_details'] = calc_details[f'{col}_calculation']
+        download_df[f'{col}_grade_explanation'] = calc_details[f'{col}_grade_explanation']
+    return download_df
+
+
+# Rows of the analysis export built and written at a time
+EXPORT_CHUNK_ROWS = 5000
+
+
+def export_chunks(meandata, numeric_cols, stats_dict, chunk_rows=EXPORT_CHUNK_ROWS):
+    """The export_frame of a model in row chunks, with explanations built per chunk"""
+    for start in range(0, max(len(meandata), 1), chunk_rows):
+        chunk = meandata.iloc[start:start + chunk_rows]
+        calc_details = ExplanationProvider(chunk, numeric_cols, stats_dict).full_columns()
+        yield export_frame(chunk, numeric_cols, calc_details)
@@ -0,0 +1,434 @@
+"""HTTP scoring API for laboratory information systems.
+
+Serves the scoring pipeline of the app without the UI. A round is uploaded
+once as the raw file in the request body; it is parsed, scored with the chosen
+estimator and kept in an in-process cache, so statistics and grade lookups are
+answered from memory. Parsing and scoring run on worker threads, and PDF
+rendering runs in a bounded process pool, so long renders do not hold up
+quick lookups:
+
+    POST /rounds?filename=round.csv&estimator=classical     upload and score a round
+    GET  /rounds                                            rounds in the cache
+    GET  /rounds/{round_id}                                 models, tests and warnings of a round
+    GET  /rounds/{round_id}/models/{model}/statistics       test statistics of a model
+    GET  /rounds/{round_id}/models/{model}/labs/{lab}       a lab's values, z-scores and grades
+    POST /rounds/{round_id}/models/{model}/grades           grades of many labs: {"lab_codes": [...]}
+    GET  /rounds/{round_id}/models/{model}/labs/{lab}/report.pdf
+    GET  /rounds/{round_id}/models/{model}/reports.zip?labs=1001,1002   (all labs by default)
+
+Run it locally with uvicorn:
+
+    python api.py --host 127.0.0.1 --port 8600 --pdf-workers 4
+
+or test it in-process with Starlette's TestClient (needs httpx):
+
+    with TestClient(api.create_app()) as client:
+        client.post("/rounds?filename=round.csv", content=raw_bytes)
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import analysis
+import history
+import storage
+
+# Scored rounds kept in memory; the least recently used round is dropped first
+MAX_CACHED_ROUNDS = 8
+
+# Largest accepted round upload, as in the app
+MAX_UPLOAD_BYTES = 200 * 1024 * 1024
+
+
+class APIError(Exception):
+    """An error answered with its status code and message"""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+def _json_value(value):
+    """A JSON-safe Python value: NumPy scalars unwrapped, NaN as null"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _lookup_key(keys, value):
+    """The key in ``keys`` that a path or JSON value refers to (Lab and Model codes are mostly numbers)"""
+    if value in keys:
+        return value
+    text = str(value)
+    if text.lstrip('-').isdigit() and int(text) in keys:
+        return int(text)
+    if text in keys:
+        return text
+    return None
+
+
+class ScoredRound:
+    """An uploaded round scored with one estimator; each model's LabIndex is built on first use"""
+
+    def __init__(self, round_id, name, raw_bytes, estimator):
+        self.round_id = round_id
+        self.name = name
+        self.estimator = estimator
+        df, self.warnings = analysis.read_round_file(name, raw_bytes)
+        self.model_rows, self.model_counts = analysis.group_rows_by_model(df)
+        self.round_stats = analysis.RoundStats(df, analysis.get_numeric_cols(df), estimator)
+        self.scores = analysis.score_round(df, self.round_stats.test_cols, self.round_stats)
+        self._labs = {}
+        self._lock = threading.Lock()
+
+    def summary(self):
+        return {
+            'round_id': self.round_id,
+            'name': self.name,
+            'estimator': self.estimator,
+            'records': int(sum(self.model_counts.values())),
+            'models': {str(model_code): int(count) for model_code, count in self.model_counts.items()},
+            'tests': list(self.round_stats.test_cols),
+            'warnings': self.warnings,
+        }
+
+    def model_code(self, value):
+        model_code = _lookup_key(self.model_counts, value)
+        if model_code is None:
+            raise APIError(404, f"Model {value} is not in round {self.round_id}")
+        return model_code
+
+    def labs(self, model_code):
+        """LabIndex of one model, built once"""
+        with self._lock:
+            if model_code not in self._labs:
+                self._labs[model_code] = analysis.LabIndex(
+                    analysis.model_frame(self.scores, self.model_rows, model_code),
+                    self.round_stats.test_cols, self.round_stats.stats_dict(model_code))
+            return self._labs[model_code]
+
+    def lab_code(self, labs, value):
+        lab_code = _lookup_key(labs.lab_codes, value)
+        if lab_code is None:
+            raise APIError(404, f"Lab {value} is not in this model of round {self.round_id}")
+        return lab_code
+
+
+def lab_grades(labs, lab_code):
+    """Values, z-scores, grades and explanations of every test of a lab"""
+    record = labs.record(lab_code)
+    return {
+        'lab_code': _json_value(lab_code),
+        'duplicate_lab_code': lab_code in labs.duplicates.index,
+        'tests': [
+            {
+                'test': test,
+                'value': _json_value(value),
+                'z_score': _json_value(zscore),
+                'grade': str(grade),
+                'calculation': calculation,
+                'grade_explanation': grade_explanation,
+            }
+            for test, (value, zscore, grade, calculation, grade_explanation) in record.iterrows()
+        ],
+    }
+
+
+class ScoringService:
+    """Round cache, PDF process pool and saved round history shared by all requests"""
+
+    def __init__(self, max_rounds=MAX_CACHED_ROUNDS, pdf_workers=None, history_folder=history.HISTORY_FOLDER):
+        self.max_rounds = max_rounds
+        self.pdf_workers = pdf_workers or min(4, os.cpu_count() or 1)
+        self.history_store = history.HistoryStore(history_folder)
+        self._rounds = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                # Spawned workers avoid forking a process that runs an event loop and threads
+                self._pool = ProcessPoolExecutor(max_workers=self.pdf_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+
+    def add_round(self, raw_bytes, name, estimator):
+        """Score an upload, or return the cached round if the same file was already scored"""
+        round_id = f"{analysis.hash_bytes(raw_bytes)[:16]}-{estimator}"
+        with self._lock:
+            if round_id in self._rounds:
+                self._rounds.move_to_end(round_id)
+                return self._rounds[round_id], True
+        scored = ScoredRound(round_id, name, raw_bytes, estimator)
+        with self._lock:
+            self._rounds[round_id] = scored
+            while len(self._rounds) > self.max_rounds:
+                self._rounds.popitem(last=False)
+        return scored, False
+
+    def get_round(self, round_id):
+        with self._lock:
+            if round_id not in self._rounds:
+                raise APIError(404, f"Round {round_id} is not loaded; upload it again")
+            self._rounds.move_to_end(round_id)
+            return self._rounds[round_id]
+
+    def rounds(self):
+        with self._lock:
+            return list(self._rounds.values())
+
+    def _pdf_jobs(self, scored, model_code, lab_codes):
+        import reports
+
+        # Each worker only receives its lab's record, history and the model statistics
+        labs = scored.labs(model_code)
+        stats_dict = scored.round_stats.stats_dict(model_code)
+        stat_rows = reports.model_stat_rows(stats_dict, labs.numeric_cols, scored.estimator)
+        return [
+            (lab_code, model_code, labs.record(lab_code), stats_dict, labs.numeric_cols, scored.estimator,
+             self.history_store.lab_history(lab_code, model_code), stat_rows)
+            for lab_code in lab_codes
+        ]
+
+    async def render_pdfs(self, scored, model_code, lab_codes):
+        """Render lab PDFs in the process pool; yields ``(lab_code, pdf_bytes)`` as they finish.
+
+        As in reports.generate_lab_reports, only a window of a few renders per
+        worker is submitted at once, so a ZIP of many labs leaves room in the
+        shared pool for single reports, and a finished PDF is dropped as soon as
+        it has been handed on. Renders that have not started are cancelled if
+        the request goes away.
+        """
+        import reports
+
+        jobs = await run_in_threadpool(self._pdf_jobs, scored, model_code, lab_codes)
+        loop = asyncio.get_running_loop()
+        pool = self.pool()
+        window = reports.REPORT_JOBS_PER_WORKER * self.pdf_workers
+        pending = set()
+        try:
+            for job in jobs:
+                pending.add(loop.run_in_executor(pool, reports.render_lab_pdf_bytes, *job))
+                if len(pending) >= window:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    while done:
+                        yield done.pop().result()
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                while done:
+                    yield done.pop().result()
+        finally:
+            for render in pending:
+                render.cancel()
+
+
+def _service(request):
+    return request.app.state.service
+
+
+async def _read_upload(request):
+    """The request body, refused as soon as it grows past MAX_UPLOAD_BYTES.
+
+    The bytes are counted as they arrive, as a chunked upload has no Content-Length.
+    """
+    too_large = APIError(413, f"Round files are limited to {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+    content_length = request.headers.get('content-length', '')
+    if content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+        raise too_large
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise too_large
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def upload_round(request):
+    estimator = request.query_params.get('estimator', 'classical')
+    if estimator not in analysis.ESTIMATORS:
+        raise APIError(400, f"Unknown estimator {estimator}; use one of {', '.join(analysis.ESTIMATORS)}")
+    name = request.query_params.get('filename', 'round.csv')
+    raw_bytes = await _read_upload(request)
+    if not raw_bytes:
+        raise APIError(400, "The request body must contain the round file")
+    try:
+        scored, cached = await run_in_threadpool(_service(request).add_round, raw_bytes, name, estimator)
+    except ValueError as e:
+        raise APIError(400, f"Could not read the round: {e}")
+    return JSONResponse({**scored.summary(), 'cached': cached}, status_code=200 if cached else 201)
+
+
+async def list_rounds(request):
+    return JSONResponse({'rounds': [
+        {key: value for key, value in scored.summary().items() if key != 'warnings'}
+        for scored in _service(request).rounds()
+    ]})
+
+
+async def get_round(request):
+    return JSONResponse(_service(request).get_round(request.path_params['round_id']).summary())
+
+
+async def model_statistics(request):
+    scored = _service(request).get_round(request.path_params['round_id'])
+    model_code = scored.model_code(request.path_params['model_code'])
+    stats_dict = scored.round_stats.stats_dict(model_code)
+    _, location, scale = analysis.ESTIMATORS[scored.estimator]
+    return JSONResponse({
+        'round_id': scored.round_id,
+        'model_code': str(model_code),
+        'estimator': scored.estimator,
+        'location': location,
+        'scale': scale,
+        'records': int(scored.model_counts[model_code]),
+        'statistics': [
+            {'test': col, 'mean': _json_value(stats['mean']), 'std': _json_value(stats['std']),
+             'count': int(stats['count']), 'scale_fallback': stats.get('scale_fallback', False)}
+            for col, stats in stats_dict.items()
+        ],
+    })
+
+
+async def get_lab(request):
+    scored = _service(request).get_round(request.path_params['round_id'])
+    model_code = scored.model_code(request.path_params['model_code'])
+    labs = await run_in_threadpool(scored.labs, model_code)
+    lab_code = scored.lab_code(labs, request.path_params['lab_code'])
+    return JSONResponse({'round_id': scored.round_id, 'model_code': str(model_code), **lab_grades(labs, lab_code)})
+
+
+async def batch_grades(request):
+    scored = _service(request).get_round(request.path_params['round_id'])
+    model_code = scored.model_code(request.path_params['model_code'])
+    try:
+        lab_codes = (await request.json())['lab_codes']
+        if not isinstance(lab_codes, list):
+            raise TypeError
+    except (ValueError, KeyError, TypeError):
+        raise APIError(400, 'The request body must be JSON like {"lab_codes": [1001, 1002]}')
+    labs = await run_in_threadpool(scored.labs, model_code)
+
+    results, not_found = [], []
+    for value in lab_codes:
+        lab_code = _lookup_key(labs.lab_codes, value)
+        if lab_code is None:
+            not_found.append(value)
+        else:
+            results.append(lab_grades(labs, lab_code))
+    return JSONResponse({'round_id': scored.round_id, 'model_code': str(model_code),
+                         'labs': results, 'not_found': not_found})
+
+
+async def lab_report(request):
+    service = _service(request)
+    scored = service.get_round(request.path_params['round_id'])
+    model_code = scored.model_code(request.path_params['model_code'])
+    labs = await run_in_threadpool(scored.labs, model_code)
+    lab_code = scored.lab_code(labs, request.path_params['lab_code'])
+    [(_, pdf_bytes)] = [pdf async for pdf in service.render_pdfs(scored, model_code, [lab_code])]
+    return Response(pdf_bytes, media_type='application/pdf', headers={
+        'Content-Disposition': f'attachment; filename="SmartLab_Lab{lab_code}_Model{model_code}_Report.pdf"'})
+
+
+async def model_reports(request):
+    service = _service(request)
+    scored = service.get_round(request.path_params['round_id'])
+    model_code = scored.model_code(request.path_params['model_code'])
+    labs = await run_in_threadpool(scored.labs, model_code)
+    if request.query_params.get('labs'):
+        lab_codes = [scored.lab_code(labs, value.strip()) for value in request.query_params['labs'].split(',')]
+    else:
+        lab_codes = list(labs.lab_codes)
+
+    # Each PDF goes into the spooled ZIP as soon as its worker finishes; PDFs barely compress
+    spool = tempfile.SpooledTemporaryFile(max_size=storage.ZIP_SPOOL_MAX_MEMORY, suffix='.zip')
+    try:
+        with zipfile.ZipFile(spool, 'w', zipfile.ZIP_STORED) as zip_file:
+            async for lab_code, pdf_bytes in service.render_pdfs(scored, model_code, lab_codes):
+                zip_file.writestr(f"SmartLab_Lab{lab_code}_Model{model_code}_Report.pdf", pdf_bytes)
+        size = spool.tell()
+    except BaseException:
+        spool.close()
+        raise
+    # The ZIP is sent from the spool in chunks, and the spool is closed once it has been read
+    return StreamingResponse(storage.iter_spool(spool), media_type='application/zip', headers={
+        'Content-Length': str(size),
+        'Content-Disposition': f'attachment; filename="SmartLab_AllLabs_Model{model_code}_Reports.zip"'})
+
+
+async def api_error(request, exc):
+    return JSONResponse({'error': exc.message}, status_code=exc.status_code)
+
+
+def create_app(max_rounds=MAX_CACHED_ROUNDS, pdf_workers=None, history_folder=history.HISTORY_FOLDER):
+    """The ASGI application, with its own round cache and PDF pool"""
+    service = ScoringService(max_rounds, pdf_workers, history_folder)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        service.shutdown()
+
+    app = Starlette(
+        routes=[
+            Route('/rounds', upload_round, methods=['POST']),
+            Route('/rounds', list_rounds, methods=['GET']),
+            Route('/rounds/{round_id}', get_round, methods=['GET']),
+            Route('/rounds/{round_id}/models/{model_code}/statistics', model_statistics, methods=['GET']),
+            Route('/rounds/{round_id}/models/{model_code}/labs/{lab_code}', get_lab, methods=['GET']),
+            Route('/rounds/{round_id}/models/{model_code}/grades', batch_grades, methods=['POST']),
+            Route('/rounds/{round_id}/models/{model_code}/labs/{lab_code}/report.pdf', lab_report, methods=['GET']),
+            Route('/rounds/{round_id}/models/{model_code}/reports.zip', model_reports, methods=['GET']),
+        ],
+        exception_handlers={APIError: api_error},
+        lifespan=lifespan,
+    )
+    app.state.service = service
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the SmartLab scoring pipeline over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="interface to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8600, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--pdf-workers", type=int, default=None,
+                        help="processes rendering PDF reports (default: up to 4)")
+    parser.add_argument("--max-rounds", type=int, default=MAX_CACHED_ROUNDS,
+                        help="scored rounds kept in memory (default: %(default)s)")
+    parser.add_argument("--history", default=history.HISTORY_FOLDER,
+                        help="round history used for the trend table of PDF reports (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    import uvicorn
+
+    uvicorn.run(create_app(args.max_rounds, args.pdf_workers, args.history), host=args.host, port=args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,21 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
+import functools
 import os
-import base64
-from io import StringIO, BytesIO
 import zipfile
-# Add reportlab imports
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
-from reportlab.lib.units import inch
-from reportlab.graphics.shapes import Drawing
-from reportlab.graphics.charts.barcharts import VerticalBarChart
+
+import analysis
+import append
+import charts
+import history
+import ingest
+import profiling
+import robust
+import storage
+
+# matplotlib/plotly (via charts) and reportlab (via reports) are imported where they are
+# first used, so a fresh session does not pay for them before an upload.
 
 # Page configuration
 st.set_page_config(
@@ -73,82 +74,354 @@ st.markdown("""
 st.title(':microscope: SmartLab Data Analysis')
 st.markdown('<div class="header-style">Comprehensive Laboratory Test Analysis with Z-Scores and Grading</div>', unsafe_allow_html=True)
 
-# Function to split CSV by Model code
-def split_csv_by_model_code(df, output_folder="split_by_model_code"):
-    # Create output folder if it doesn't exist
-    os.makedirs(output_folder, exist_ok=True)
-    
-    # Get unique Model codes
-    unique_model_codes = df['Model code'].unique()
-    model_dfs = {}
-    
-    # Split data by Model code
-    for model_code in unique_model_codes:
-        filtered_df = df[df['Model code'] == model_code]
-        model_dfs[model_code] = filtered_df
-        
-        # Save to CSV with enhanced feedback
-        output_filename = f"BloodData_Model_{model_code}.csv"
-        output_path = os.path.join(output_folder, output_filename)
-        filtered_df.to_csv(output_path, index=False)
-        
-        # Display a nice confirmation for each saved file with styled message
-        st.markdown(f"""
-        <div style="margin-bottom:8px; padding:8px 12px; border-radius:6px; background-color:#E8F4FD; 
-                    border-left:3px solid #3498db; display:flex; align-items:center;">
-            <span style="color:#2874A6; font-size:16px; margin-right:10px;">💾</span>
-            <div>
-                <span style="font-weight:600; color:#2C3E50;">{output_filename}</span>
-                <span style="margin-left:8px; color:#5D6D7E; font-size:13px;">({len(filtered_df)} records saved)</span>
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    return model_dfs, unique_model_codes
+# Stage timings of every rerun for the debug panel at the bottom. Recording is
+# off unless enabled there or by SMARTLAB_STAGE_METRICS; then stage() is a no-op.
+recorder = profiling.StageRecorder(
+    profiling.recording_requested(st.session_state.get("debug_stage_timings", False)),
+    st.session_state.setdefault("stage_timing_runs", [])
+)
+stage = recorder.stage
+
+# Cached pipeline stages. Every stage is keyed by the hash of the uploaded
+# bytes (and the selected model where relevant), so changing only the lab or
+# test selectors reuses the cached results. Arguments prefixed with "_" are not
+# hashed by Streamlit; the key arguments already identify their content.
+# "compact" selects the float32/categorical representation and is part of the key.
+#
+# The server is long-running and shared by all sessions, so every stage is
+# bounded. Round-level stages hold whole rounds and keep only a few; per-model
+# and per-view entries are smaller but multiply with every model, engine,
+# filter and sort, so they also expire after VIEW_CACHE_TTL.
+ROUND_CACHE_ENTRIES = 8
+MODEL_CACHE_ENTRIES = 64
+VIEW_CACHE_ENTRIES = 256
+VIEW_CACHE_TTL = "1h"
+
+@st.cache_data(show_spinner=False, max_entries=ROUND_CACHE_ENTRIES)
+def load_round(data_hash, compact, fmt, _raw_bytes):
+    df, schema_warnings = analysis.read_round(_raw_bytes, fmt)
+    return (analysis.compact_frame(df) if compact else df), schema_warnings
+
+# Several uploaded files (one per site) are parsed concurrently and merged into one round
+@st.cache_data(show_spinner=False, max_entries=ROUND_CACHE_ENTRIES)
+def load_rounds(data_hash, compact, _files):
+    df, schema_warnings, duplicates = analysis.read_rounds(_files)
+    return (analysis.compact_frame(df) if compact else df), schema_warnings, duplicates
+
+@st.cache_data(show_spinner=False, max_entries=ROUND_CACHE_ENTRIES)
+def split_round(data_hash, compact, _df):
+    return analysis.group_rows_by_model(_df)
+
+# Split files are persisted by one background writer shared by all sessions
+@st.cache_resource
+def get_split_writer():
+    return storage.SplitFileWriter()
+
+# Every model is scored at once, so switching models only slices the cached results
+@st.cache_data(show_spinner=False, max_entries=ROUND_CACHE_ENTRIES)
+def round_statistics(data_hash, compact, estimator, _df):
+    return analysis.RoundStats(_df, analysis.get_numeric_cols(_df), estimator)
+
+@st.cache_data(show_spinner=False, max_entries=ROUND_CACHE_ENTRIES)
+def scored_round(data_hash, compact, estimator, _df, _round_stats):
+    scores = analysis.score_round(_df, _round_stats.test_cols, _round_stats)
+    return analysis.compact_frame(scores) if compact else scores
+
+@st.cache_data(show_spinner=False, max_entries=ROUND_CACHE_ENTRIES)
+def round_overview(data_hash, compact, estimator, _round_stats, _scores, _model_counts):
+    grade_counts = analysis.grade_counts_by_model(_scores, _round_stats.test_cols)
+    return (analysis.model_grade_summary(grade_counts, _model_counts),
+            analysis.overview_statistics(_round_stats, grade_counts))
+
+@st.cache_data(show_spinner=False, max_entries=MODEL_CACHE_ENTRIES, ttl=VIEW_CACHE_TTL)
+def lab_index(data_hash, compact, estimator, model_code, _meandata, _numeric_cols, _stats_dict):
+    return analysis.LabIndex(_meandata, _numeric_cols, _stats_dict)
+
+# Streaming ingest keeps only the running statistics and the selected model in memory
+@st.cache_data(show_spinner=False, max_entries=ROUND_CACHE_ENTRIES)
+def streamed_statistics(data_hash, _raw_bytes):
+    return ingest.stream_statistics(_raw_bytes)
+
+@st.cache_data(show_spinner=False, max_entries=MODEL_CACHE_ENTRIES, ttl=VIEW_CACHE_TTL)
+def streamed_model(data_hash, compact, model_code, _raw_bytes, _running_stats):
+    model_df = ingest.load_model_rows(_raw_bytes, model_code, _running_stats)
+    return analysis.compact_frame(model_df) if compact else model_df
+
+# Robust estimators need all of a model's results, so streaming mode estimates them per model
+@st.cache_data(show_spinner=False, max_entries=MODEL_CACHE_ENTRIES, ttl=VIEW_CACHE_TTL)
+def model_statistics(data_hash, compact, estimator, model_code, _model_df, _numeric_cols):
+    return analysis.compute_stats(_model_df, _numeric_cols, estimator)
+
+@st.cache_data(show_spinner=False, max_entries=MODEL_CACHE_ENTRIES, ttl=VIEW_CACHE_TTL)
+def scored_model(data_hash, compact, estimator, model_code, _model_df, _numeric_cols, _stats_dict):
+    meandata = analysis.score_model(_model_df, _numeric_cols, _stats_dict)
+    return analysis.compact_frame(meandata) if compact else meandata
+
+# Filtered and sorted row order of the results table; pages are sliced from it
+@st.cache_data(show_spinner=False, max_entries=VIEW_CACHE_ENTRIES, ttl=VIEW_CACHE_TTL)
+def result_positions(data_hash, compact, estimator, model_code, grades, test, sort_by, descending, _meandata, _numeric_cols):
+    return analysis.result_order(_meandata, _numeric_cols, list(grades), test, sort_by, descending)
+
+# Charts are cached per model and engine and drawn from aggregates, not the per-lab rows
+@st.cache_data(show_spinner=False, max_entries=VIEW_CACHE_ENTRIES, ttl=VIEW_CACHE_TTL)
+def grade_chart(data_hash, compact, estimator, model_code, engine, _meandata, _numeric_cols):
+    counts = analysis.grade_counts(_meandata, _numeric_cols)
+    if engine == 'Plotly':
+        return charts.grade_distribution_plotly(counts, model_code)
+    return charts.grade_distribution_png(counts, model_code)
+
+@st.cache_data(show_spinner=False, max_entries=VIEW_CACHE_ENTRIES, ttl=VIEW_CACHE_TTL)
+def zscore_chart(data_hash, compact, estimator, model_code, engine, _meandata, _numeric_cols):
+    box_stats = analysis.zscore_box_stats(_meandata, _numeric_cols)
+    if engine == 'Plotly':
+        return charts.zscore_distribution_plotly(box_stats, model_code)
+    return charts.zscore_distribution_png(box_stats, model_code)
+
+# Late submissions are folded into one on-disk store per round, shared by all sessions
+@st.cache_resource
+def get_incremental_round(data_hash, _round_df):
+    folder = append.store_folder(data_hash)
+    if append.IncrementalRound.exists(folder):
+        return append.IncrementalRound.load(folder)
+    return append.IncrementalRound.from_round(_round_df, folder)
+
+# round_key changes with every appended submission, so only the state after it is cached
+@st.cache_data(show_spinner=False, max_entries=MODEL_CACHE_ENTRIES, ttl=VIEW_CACHE_TTL)
+def appended_model(round_key, compact, estimator, model_code, _incremental):
+    model_df = _incremental.frame(model_code)
+    meandata = _incremental.scored(model_code, estimator)
+    if compact:
+        model_df, meandata = analysis.compact_frame(model_df), analysis.compact_frame(meandata)
+    return model_df, _incremental.stats_dict(model_code, estimator), meandata
+
+# Saved rounds for trend queries, shared by all sessions
+@st.cache_resource
+def get_history_store():
+    return history.HistoryStore()
+
+@st.cache_data(show_spinner=False, max_entries=VIEW_CACHE_ENTRIES, ttl=VIEW_CACHE_TTL)
+def memory_report(data_hash, compact, streaming, model_code, _frames):
+    return analysis.memory_report(_frames)
 
 # File upload section
 with st.expander("📁 Upload Your Data", expanded=True):
-    uploaded_file = st.file_uploader("Choose a CSV file containing lab test results", type=["csv"])
+    uploaded_files = st.file_uploader(
+        "Choose CSV, Parquet or Feather files containing lab test results",
+        type=[ext.lstrip('.') for extensions in analysis.ROUND_FORMATS.values() for ext in extensions],
+        accept_multiple_files=True,
+        help="Files from several sites are merged into one round, with a 'Source file' column."
+    )
+    split_format = st.selectbox(
+        "Split file format",
+        options=storage.available_formats(),
+        format_func=str.upper,
+        key="split_format"
+    )
+    streaming = st.checkbox(
+        "Streaming ingest for large files",
+        value=False,
+        help="Read the file in chunks and keep only running statistics and the selected model in memory. Split files are written as CSV.",
+        key="streaming_ingest"
+    )
+    compact = st.checkbox(
+        "Compact in-memory representation",
+        value=False,
+        help="Store test values and z-scores as float32 (about 7 significant digits) and Brand/Model codes as categoricals. "
+             "Explanation columns are generated only for the download and not kept in memory.",
+        key="compact_mode"
+    )
+    estimator = st.selectbox(
+        "Statistics estimator",
+        options=list(analysis.ESTIMATORS),
+        format_func=lambda key: analysis.ESTIMATORS[key][0],
+        help="Robust estimators keep a few gross outliers from inflating the standard deviation "
+             "and masking other labs' failures.",
+        key="estimator"
+    )
     st.markdown("""
     <div class="info-box">
         <b>File Requirements:</b><br>
-        - CSV format with lab test results<br>
+        - CSV, Parquet or Feather/Arrow IPC format with lab test results<br>
         - Should contain numeric test values<br>
         - Should include 'Lab Code' and 'Model code' columns<br>
-        - Zero values will be treated as missing data
+        - Zero values will be treated as missing data<br>
+        - Several files are merged into one round; tests missing from a file are missing data
     </div>
     """, unsafe_allow_html=True)
 
-if uploaded_file is not None:
+if uploaded_files:
     # Read and process data
-    meandata = pd.read_csv(uploaded_file)
-    meandata = meandata.replace(0, np.nan)
+    merged = len(uploaded_files) > 1
+    upload_name = uploaded_files[0].name.rsplit('.', 1)[0] + ("_merged" if merged else "")
+    if merged:
+        round_files = [(uploaded.name, uploaded.getvalue()) for uploaded in uploaded_files]
+        data_hash = analysis.hash_files(round_files)
+    else:
+        raw_bytes = uploaded_files[0].getvalue()
+        data_hash = analysis.hash_bytes(raw_bytes)
+        round_format = analysis.round_format(uploaded_files[0].name)
+    split_writer = get_split_writer()
+    if streaming and merged:
+        st.info(f"Streaming ingest applies to a single CSV upload; the {len(uploaded_files)} files are merged in memory.")
+        streaming = False
+    elif streaming and round_format != 'csv':
+        # Columnar files load without parsing, so streaming only applies to CSV
+        st.info(f"Streaming ingest applies to CSV uploads; this {round_format.title()} file is loaded directly.")
+        streaming = False
+    if streaming:
+        # One chunked pass gathers per-model statistics; the round is never held in memory
+        split_format = 'csv'
+        with st.spinner("Streaming data and computing per-model statistics..."), stage("stream_statistics"):
+            running_stats, schema_warnings = streamed_statistics(data_hash, raw_bytes)
+            model_counts = running_stats.model_counts()
+            unique_model_codes = list(model_counts)
+        total_records = sum(model_counts.values())
+        total_columns = len(running_stats.columns)
+        for warning in schema_warnings:
+            st.warning(warning)
+
+        split_writer.submit_stream(data_hash, unique_model_codes, functools.partial(
+            ingest.stream_split_files, raw_bytes, split_writer.output_folder, test_cols=running_stats.test_cols))
+
+        def get_model_data(model_code):
+            return streamed_model(data_hash, compact, model_code, raw_bytes, running_stats)
+    else:
+        with stage("parse"):
+            if merged:
+                try:
+                    round_df, schema_warnings, file_duplicates = load_rounds(data_hash, compact, round_files)
+                except ValueError as e:
+                    st.error(f"Could not merge the uploaded files. {e}")
+                    st.stop()
+            else:
+                round_df, schema_warnings = load_round(data_hash, compact, round_format, raw_bytes)
+        for warning in schema_warnings:
+            st.warning(warning)
+        if merged:
+            st.info(f"Merged {len(uploaded_files)} files into one round of {len(round_df)} records; "
+                    f"the '{analysis.SOURCE_FILE_COLUMN}' column records each row's file.")
+            if len(file_duplicates) > 0:
+                st.warning(f"{len(file_duplicates)} Lab Code(s) were submitted for the same model in more than one file. "
+                           "Only the first row of each is used in the viewer and reports.")
+                st.dataframe(file_duplicates, hide_index=True, use_container_width=True)
+        with st.spinner("Splitting data by model code..."), stage("split"):
+            model_rows, model_counts = split_round(data_hash, compact, round_df)
+            unique_model_codes = list(model_counts)
+        total_records = len(round_df)
+        total_columns = len(round_df.columns)
+        with st.spinner("Scoring all models..."):
+            with stage("statistics"):
+                round_stats = round_statistics(data_hash, compact, estimator, round_df)
+            with stage("scoring"):
+                round_scores = scored_round(data_hash, compact, estimator, round_df, round_stats)
+
+        # Persist the split files in the background; the UI does not wait for the writes
+        split_writer.submit_round(data_hash, round_df, model_rows, split_format)
+
+        def get_model_data(model_code):
+            return analysis.model_frame(round_df, model_rows, model_code)
+
+        # A round that already received late submissions reopens its store
+        incremental = None
+        if append.IncrementalRound.exists(append.store_folder(data_hash)):
+            incremental = get_incremental_round(data_hash, round_df)
     
     # Split data by Model code
     st.markdown('<div class="subheader-style">Split Data by Model Code</div>', unsafe_allow_html=True)
     
-    # Display file info before splitting
+    # Display file info
     col1, col2, col3 = st.columns(3)
     with col1:
-        st.metric("Total Records", f"{len(meandata)}", delta=None)
+        st.metric("Total Records", f"{total_records}", delta=None)
     with col2:
-        st.metric("Unique Model Codes", f"{meandata['Model code'].nunique()}", delta=None)
+        st.metric("Unique Model Codes", f"{len(unique_model_codes)}", delta=None)
     with col3:
-        st.metric("Data Columns", f"{len(meandata.columns)}", delta=None)
+        st.metric("Data Columns", f"{total_columns}", delta=None)
+    
+    save_messages = {
+        'saved': 'records saved',
+        'unchanged': 'records, file unchanged',
+        'pending': 'records, saving in background',
+        'failed': 'records, save failed',
+    }
     
-    # Add progress indicator for splitting operation
-    with st.spinner("Splitting data by model code..."):
-        model_dfs, unique_model_codes = split_csv_by_model_code(meandata)
+    # Display a nice confirmation for each saved file with styled message
+    for model_code in unique_model_codes:
+        output_filename = storage.split_filename(model_code, split_format)
+        save_status = split_writer.status(data_hash, model_code, split_format)
+        st.markdown(f"""
+        <div style="margin-bottom:8px; padding:8px 12px; border-radius:6px; background-color:#E8F4FD; 
+                    border-left:3px solid #3498db; display:flex; align-items:center;">
+            <span style="color:#2874A6; font-size:16px; margin-right:10px;">💾</span>
+            <div>
+                <span style="font-weight:600; color:#2C3E50;">{output_filename}</span>
+                <span style="margin-left:8px; color:#5D6D7E; font-size:13px;">({model_counts[model_code]} {save_messages[save_status]})</span>
+            </div>
+        </div>
+        """, unsafe_allow_html=True)
     
     # Show success message with enhanced styling
     st.markdown(f"""
     <div style="background-color:#E9F7EF; padding:15px; border-radius:10px; border-left:5px solid #2ECC71; margin:20px 0px;">
         <h4 style="color:#27AE60; margin-top:0;">✅ Data Successfully Split!</h4>
         <p>Your data has been split into <b>{len(unique_model_codes)}</b> separate files based on Model code.</p>
-        <p>Each file has been saved and is available for individual analysis.</p>
+        <p>Each file is saved in the background and is available for individual analysis.</p>
     </div>
     """, unsafe_allow_html=True)
     
+    # Late submissions update only the models they touch; the split files above stay as uploaded
+    split_model_codes = unique_model_codes
+    round_key = data_hash
+    with st.expander("📨 Late Submissions"):
+        if streaming:
+            st.info("Late submissions can be appended when the round is loaded without streaming ingest.")
+        else:
+            st.caption("Rows for existing models update those models' statistics; their labs are re-scored "
+                       "and every grade that moved is logged. Other models are not recomputed.")
+            late_file = st.file_uploader(
+                "Late submission file (same columns as the round)",
+                type=[ext.lstrip('.') for extensions in analysis.ROUND_FORMATS.values() for ext in extensions],
+                key="late_file"
+            )
+            if late_file is not None and st.button("Append submissions", key="append_submissions"):
+                late_bytes = late_file.getvalue()
+                late_df, late_warnings = analysis.read_round(late_bytes, analysis.round_format(late_file.name))
+                for warning in late_warnings:
+                    st.warning(warning)
+                incremental = get_incremental_round(data_hash, round_df)
+                with st.spinner("Updating the affected models..."), stage("append_submissions"):
+                    try:
+                        changes = incremental.append(late_df, estimator, late_file.name, analysis.hash_bytes(late_bytes))
+                    except ValueError as e:
+                        st.error(str(e))
+                        changes = False
+                if changes is None:
+                    st.info(f"{late_file.name} has already been appended to this round.")
+                elif changes is not False:
+                    affected = ", ".join(incremental.submissions[-1]['records'])
+                    st.success(f"Appended {len(late_df)} records to model(s) {affected}; "
+                               f"{len(changes)} existing results changed grade.")
+            if incremental is not None and incremental.submissions:
+                st.markdown("**Appended submissions**")
+                st.dataframe(pd.DataFrame([
+                    {'Submission': entry['name'], 'Appended': entry['submitted_at'],
+                     'Records': sum(entry['records'].values()), 'Models': ", ".join(entry['records']),
+                     'Grade changes': entry['grade_changes']}
+                    for entry in incremental.submissions
+                ]), hide_index=True, use_container_width=True)
+                st.markdown("**Grade changelog**")
+                st.dataframe(incremental.changelog, hide_index=True, use_container_width=True)
+                st.download_button(
+                    label="📥 Download Grade Changelog",
+                    data=incremental.changelog.to_csv(index=False).encode('utf-8'),
+                    file_name='smartlab_grade_changelog.csv',
+                    mime='text/csv'
+                )
+    if not streaming and incremental is not None and incremental.submissions:
+        model_counts = incremental.model_counts()
+        unique_model_codes = list(model_counts)
+        round_key = f"{data_hash}+{len(incremental.submissions)}"
+    
     # Show model code information in a more visual way
     st.markdown('<div style="margin-top:10px; margin-bottom:15px;"><b>Available Model Codes:</b></div>', unsafe_allow_html=True)
     
@@ -157,7 +430,7 @@ if uploaded_file is not None:
     cols = st.columns(4)  # Adjust number of columns as needed
     for i, model_code in enumerate(unique_model_codes):
         with cols[i % 4]:
-            record_count = len(model_dfs[model_code])
+            record_count = model_counts[model_code]
             st.markdown(f"""
             <div style="background-color:#F8F9F9; padding:10px; border-radius:8px; margin-bottom:10px; 
                         border:1px solid #D5DBDB; text-align:center;">
@@ -166,6 +439,50 @@ if uploaded_file is not None:
             </div>
             """, unsafe_allow_html=True)
     
+    # Statistics and grade distributions of every model side by side
+    with st.expander("🌐 Cross-Model Overview"):
+        if streaming:
+            st.caption("Grade distributions need every model scored, which streaming ingest avoids; "
+                       "classical test statistics only.")
+            st.dataframe(analysis.overview_statistics(running_stats), hide_index=True, use_container_width=True)
+        else:
+            if round_key != data_hash:
+                st.caption("The overview covers the round as uploaded; late submissions are not included.")
+            with stage("cross_model_overview"):
+                grade_summary, overview_df = round_overview(data_hash, compact, estimator, round_stats, round_scores, model_counts)
+            st.markdown("**Grade distribution per model** (all tests pooled)")
+            st.dataframe(grade_summary, hide_index=True, use_container_width=True)
+            st.markdown("**Test statistics and grade counts per model**")
+            st.dataframe(overview_df, hide_index=True, use_container_width=True)
+    
+    # Keep processed rounds so later rounds can show each lab's trend
+    history_store = get_history_store()
+    with st.expander("🗄️ Round History"):
+        saved_as = history_store.round_for_hash(data_hash)
+        if streaming:
+            st.info("Rounds can be saved to the history when they are loaded without streaming ingest.")
+        else:
+            if round_key != data_hash:
+                st.caption("The round is saved as uploaded; late submissions are not included.")
+            history_name = st.text_input(
+                "Round name",
+                value=saved_as or upload_name,
+                key="history_round_name"
+            )
+            if st.button("Save round to history", key="save_history"):
+                with st.spinner("Saving round..."), stage("history_save"):
+                    try:
+                        saved_as = history_store.save_round(history_name, round_scores, round_stats, data_hash)
+                        st.success(f"Saved as round {saved_as}.")
+                    except ValueError as e:
+                        st.error(str(e))
+        if history_store.rounds():
+            st.dataframe(pd.DataFrame(history_store.rounds(), columns=['round', 'saved_at', 'estimator', 'records']).rename(
+                columns={'round': 'Round', 'saved_at': 'Saved', 'estimator': 'Estimator', 'records': 'Records'}),
+                hide_index=True, use_container_width=True)
+        else:
+            st.caption("No rounds saved yet.")
+    
     # Allow user to select a Model code for analysis with enhanced select box
     st.markdown("""
     <div style="background-color:#EBF5FB; padding:15px; border-radius:8px; margin-top:20px; margin-bottom:15px;">
@@ -176,7 +493,7 @@ if uploaded_file is not None:
     selected_model = st.selectbox(
         "Choose Model Code",
         options=unique_model_codes,
-        format_func=lambda x: f"Model {x} ({len(model_dfs[x])} records)",
+        format_func=lambda x: f"Model {x} ({model_counts[x]} records)",
         index=0,
         key="model_selector"
     )
@@ -184,55 +501,74 @@ if uploaded_file is not None:
     # Add a divider before proceeding with the analysis
     st.markdown("<hr style='margin:30px 0px; border:none; height:1px; background-color:#D5D8DC;'>", unsafe_allow_html=True)
     
-    # Use the selected model's data for further analysis
-    meandata = model_dfs[selected_model]
-    
-    # Select numeric columns, excluding non-test columns
-    non_test_columns = ['Lab Code', 'Brand code', 'Model code']
-    numeric_cols = meandata.select_dtypes(include=np.number).columns
-    numeric_cols = [col for col in numeric_cols if col not in non_test_columns]
+    # Use the selected model's data for further analysis and
+    # select numeric columns and calculate statistics before processing
+    with stage("model_data"):
+        if round_key != data_hash:
+            numeric_cols = incremental.test_cols
+            model_df, stats_dict, appended_meandata = appended_model(round_key, compact, estimator, selected_model, incremental)
+        elif streaming:
+            model_df = get_model_data(selected_model)
+            numeric_cols = running_stats.test_cols
+            if estimator == 'classical':
+                stats_dict = running_stats.stats_dict(selected_model)
+            else:
+                stats_dict = model_statistics(data_hash, compact, estimator, selected_model, model_df, numeric_cols)
+        else:
+            model_df = get_model_data(selected_model)
+            numeric_cols, stats_dict = round_stats.test_cols, round_stats.stats_dict(selected_model)
     
     # Calculation explanations
     st.markdown('<div class="subheader-style">Calculation Methodology</div>', unsafe_allow_html=True)
     
+    # Grading rules are rendered from the shared grade table
+    grade_rule_items = []
+    lower = None
+    for grade, bound, _, description in analysis.GRADE_TABLE:
+        if lower is None:
+            rule = f"|z| ≤ {bound:g}"
+        elif np.isinf(bound):
+            rule = f"|z| > {lower:g}"
+        else:
+            rule = f"{lower:g} < |z| ≤ {bound:g}"
+        grade_rule_items.append(f"<li><b>{grade}:</b> {rule} ({description})</li>")
+        lower = bound
+    
+    # Location and scale descriptions follow the chosen estimator
+    estimator_label, location_name, scale_name = analysis.ESTIMATORS[estimator]
+    estimator_notes = {
+        'classical': ("mean of all values for that test", "standard deviation of all values for that test"),
+        'mad': ("median of all values for that test",
+                f"median absolute deviation from the median, scaled by {robust.MAD_SCALE}"),
+        'algorithm_a': ("robust mean x* from ISO 13528 Algorithm A",
+                        "robust standard deviation s* from ISO 13528 Algorithm A (results winsorized at x* ± 1.5 s*)"),
+    }
+    location_note, scale_note = estimator_notes[estimator]
+    if estimator != 'classical':
+        scale_note += ("; when it is 0 (more than half the labs report the same value), "
+                       "the classical standard deviation is used instead")
+    
     with st.expander("ℹ️ How the Analysis Works"):
-        st.markdown("""
+        st.markdown(f"""
         <div class="info-box">
             <h4>Z-Score Calculation:</h4>
             <p>Z-scores measure how many standard deviations a value is from the mean.</p>
             <p><b>Formula:</b> <code>z = (x - μ) / σ</code></p>
             <p>Where:<br>
             - <code>x</code> = individual test value<br>
-            - <code>μ</code> = mean of all values for that test<br>
-            - <code>σ</code> = standard deviation of all values for that test</p>
+            - <code>μ</code> = {location_note}<br>
+            - <code>σ</code> = {scale_note}</p>
+            <p><b>Estimator:</b> {estimator_label}</p>
             
             <h4>Grading System:</h4>
             <p>Grades are assigned based on the absolute z-score:</p>
             <ul>
-                <li><b>Excellent:</b> |z| ≤ 0.5 (very close to mean)</li>
-                <li><b>Good:</b> 0.5 < |z| ≤ 1 (moderately close to mean)</li>
-                <li><b>Satisfactory:</b> 1 < |z| ≤ 2 (somewhat far from mean)</li>
-                <li><b>Unsatisfactory:</b> 2 < |z| ≤ 3 (far from mean)</li>
-                <li><b>Serious problem:</b> |z| > 3 (very far from mean)</li>
+                {"".join(grade_rule_items)}
             </ul>
         </div>
         """, unsafe_allow_html=True)
     
-    # Calculate statistics before processing
-    stats_dict = {}
-    for col in numeric_cols:
-        stats_dict[col] = {
-            'mean': meandata[col].mean(),
-            'std': meandata[col].std(),
-            'count': meandata[col].count()
-        }
-    
-    stats_df = pd.DataFrame({
-        'Test': numeric_cols,
-        'Average': [stats_dict[col]['mean'] for col in numeric_cols],
-        'Std Dev': [stats_dict[col]['std'] for col in numeric_cols],
-        'Count': [stats_dict[col]['count'] for col in numeric_cols]
-    }).round(2)
+    stats_df = analysis.stats_table(stats_dict, numeric_cols, estimator)
     
     # Show statistics
     st.markdown('<div class="subheader-style">Test Statistics</div>', unsafe_allow_html=True)
@@ -242,121 +578,121 @@ if uploaded_file is not None:
             st.markdown(f"""
             <div class="metric-box">
                 <b>{row['Test']}</b><br>
-                Avg: {row['Average']}<br>
-                SD: {row['Std Dev']}<br>
+                {stats_df.columns[1]}: {row.iloc[1]}<br>
+                {stats_df.columns[2]}: {row.iloc[2]}<br>
                 N: {row['Count']}
             </div>
             """, unsafe_allow_html=True)
     
-    # Process data - Include original columns in output
-    new_columns = ['Lab Code', 'Brand code', 'Model code']
-    
-    for col in numeric_cols:
-        new_columns.extend([col, f'{col}_zscore', f'{col}_grade'])
-    
-    # Store calculation details in a separate DataFrame
-    calc_details = pd.DataFrame(index=meandata.index)
-    
-    for col in numeric_cols:
-        mean_val = stats_dict[col]['mean']
-        std_val = stats_dict[col]['std']
-        
-        meandata[f'{col}_zscore'] = (meandata[col] - mean_val) / std_val
-        meandata[f'{col}_zscore'] = meandata[f'{col}_zscore'].round(2)
-        
-        # Store calculation details
-        calc_details[f'{col}_calculation'] = meandata.apply(
-            lambda row: f"Z-Score = ({row[col]} - {mean_val:.2f}) / {std_val:.2f} = {row[f'{col}_zscore']}" 
-            if not pd.isna(row[col]) else "No data available", 
-            axis=1
-        )
-    
-    def assign_grade(zscore):
-        if pd.isna(zscore):
-            return "No data"
-        zscore = abs(zscore)
-        if zscore <= 0.5:
-            return "Excellent"
-        elif zscore <= 1:
-            return "Good"
-        elif zscore <= 2:
-            return "Satisfactory"
-        elif zscore <= 3:
-            return "Unsatisfactory"
+    # Process data - z-scores, grades and calculation details
+    with stage("model_scores"):
+        if round_key != data_hash:
+            meandata = appended_meandata
+        elif streaming:
+            meandata = scored_model(data_hash, compact, estimator, selected_model, model_df, numeric_cols, stats_dict)
         else:
-            return "Serious problem"
-    
-    for col in numeric_cols:
-        meandata[f'{col}_grade'] = meandata[f'{col}_zscore'].apply(assign_grade)
-        
-        # Store grade explanation
-        calc_details[f'{col}_grade_explanation'] = meandata.apply(
-            lambda row: f"Grade '{row[f'{col}_grade']}' assigned because |{row[f'{col}_zscore']}| " +
-                       (f"≤ 0.5" if row[f'{col}_grade'] == "Excellent" else
-                        f"is between 0.5 and 1.0" if row[f'{col}_grade'] == "Good" else
-                        f"is between 1.0 and 2.0" if row[f'{col}_grade'] == "Satisfactory" else
-                        f"is between 2.0 and 3.0" if row[f'{col}_grade'] == "Unsatisfactory" else
-                        f"> 3.0" if row[f'{col}_grade'] == "Serious problem" else "")
-            if not pd.isna(row[f'{col}_zscore']) else "No data available for grading",
-            axis=1
-        )
-    
-    # Ensure all original columns are included
-    meandata = meandata[['Lab Code', 'Brand code', 'Model code'] + [col for col in meandata.columns if col not in ['Lab Code', 'Brand code', 'Model code']]]
-    meandata = meandata[new_columns]
-    
+            meandata = analysis.model_frame(round_scores, model_rows, selected_model)
+    # Explanation strings are built lazily: one cell at a time for the viewer
+    # and reports, whole columns only when the full CSV export is downloaded
+    explanations = analysis.ExplanationProvider(meandata, numeric_cols, stats_dict)
+    
+    # Lab Code index used by the viewer and reports for per-lab lookups
+    with stage("lab_index"):
+        labs = lab_index(round_key, compact, estimator, selected_model, meandata, numeric_cols, stats_dict)
+    if len(labs.duplicates) > 0:
+        duplicate_list = ", ".join(f"{lab} ({count} rows)" for lab, count in labs.duplicates.items())
+        st.warning(f"Duplicate Lab Codes found in Model {selected_model}: {duplicate_list}. "
+                   "Only the first row of each duplicated Lab Code is used in the viewer and reports.")
+    fallback_tests = analysis.scale_fallback_tests(stats_dict, numeric_cols)
+    if fallback_tests:
+        st.warning(f"The {scale_name} of {', '.join(fallback_tests)} in Model {selected_model} is 0, "
+                   "as more than half the labs report the same value; the classical standard deviation "
+                   "is used for their z-scores instead.")
+
+    # Memory held per stage in both representations
+    with st.expander("🧠 Memory Usage"):
+        memory_frames = {} if streaming else {"Uploaded round": round_df, "Scored round": round_scores}
+        memory_frames["Selected model"] = model_df
+        memory_frames["Processed results"] = meandata
+        with stage("memory_report"):
+            memory_df = memory_report(round_key, compact, streaming, selected_model, memory_frames)
+        st.dataframe(memory_df, hide_index=True, use_container_width=True)
+        current = "Compact (bytes)" if compact else "Standard (bytes)"
+        st.caption(f"Currently held: {memory_df[current].sum() / 1024:,.0f} KiB "
+                   f"({'compact' if compact else 'standard'} representation).")
+
     # Display results
     st.markdown('<div class="subheader-style">Processed Results</div>', unsafe_allow_html=True)
     
-    # Apply styling
-    def color_grade(val):
-        color_map = {
-            'Excellent': 'background-color: #2ecc71; color: white;',
-            'Good': 'background-color: #3498db; color: white;',
-            'Satisfactory': 'background-color: #f39c12; color: white;',
-            'Unsatisfactory': 'background-color: #e74c3c; color: white;',
-            'Serious problem': 'background-color: #c0392b; color: white;',
-            'No data': 'background-color: #95a5a6; color: white;'
-        }
-        return color_map.get(val, '')
-    
-    # Apply styling to grade columns
-    grade_columns = [col for col in meandata.columns if '_grade' in col]
-    styled_df = meandata.style.applymap(color_grade, subset=grade_columns)
-    
-    # Format numeric columns
-    numeric_format = {col: "{:.2f}" for col in numeric_cols}
-    zscore_format = {col: "{:.2f}" for col in meandata.columns if '_zscore' in col}
-    styled_df = styled_df.format({**numeric_format, **zscore_format})
-    
-    st.dataframe(styled_df, height=400, use_container_width=True)
+    # Filtering and sorting run on the full results; only the visible page is styled and sent
+    filter_col, test_col, sort_col, order_col = st.columns(4)
+    grade_filter = filter_col.multiselect(
+        "Show grades",
+        options=analysis.GRADE_LABELS,
+        placeholder="All grades",
+        key="results_grades"
+    )
+    filter_test = test_col.selectbox("In test", options=["Any test"] + list(numeric_cols), key="results_test")
+    sort_by = sort_col.selectbox(
+        "Sort by",
+        options=['Lab Code', analysis.WORST_ZSCORE] + list(numeric_cols),
+        format_func=lambda key: key if key in ('Lab Code', analysis.WORST_ZSCORE) else f"{key} z-score",
+        key="results_sort"
+    )
+    sort_order = order_col.radio("Order", ["Ascending", "Descending"], horizontal=True, key="results_order")
+    
+    with stage("result_order"):
+        positions = result_positions(
+            round_key, compact, estimator, selected_model, tuple(grade_filter),
+            None if filter_test == "Any test" else filter_test, sort_by, sort_order == "Descending",
+            meandata, numeric_cols
+        )
+    
+    size_col, page_col, info_col = st.columns([1, 1, 2])
+    page_size = size_col.selectbox("Rows per page", options=analysis.RESULTS_PAGE_SIZES, index=1, key="results_page_size")
+    page_count = max(1, -(-len(positions) // page_size))
+    # A narrower filter or larger page can leave the remembered page out of range
+    if st.session_state.get("results_page", 1) > page_count:
+        st.session_state["results_page"] = 1
+    page = page_col.number_input("Page", min_value=1, max_value=page_count, step=1, key="results_page")
+    
+    page_df = analysis.results_page(meandata, positions, page - 1, page_size)
+    first_row = (page - 1) * page_size
+    info_col.caption(f"Rows {min(first_row + 1, len(positions))}–{first_row + len(page_df)} of {len(positions)} "
+                     f"matching labs ({len(meandata)} in Model {selected_model}), page {page} of {page_count}.")
+    
+    if len(page_df) == 0:
+        st.info("No labs match the selected grades.")
+    else:
+        # Grade colours and number formats are applied to this page only
+        with stage("results_styler"):
+            st.dataframe(analysis.style_results(page_df, numeric_cols), height=400, use_container_width=True)
     
     # Detailed calculation viewer section
     st.markdown('<div class="subheader-style">Detailed Calculation Viewer</div>', unsafe_allow_html=True)
     
     # Create selection widgets for Lab Code and Test
     row1, row2 = st.columns(2)
-    selected_lab = row1.selectbox("Select Lab Code", options=meandata['Lab Code'].unique())
+    selected_lab = row1.selectbox("Select Lab Code", options=labs.lab_codes)
     
     test_options = [col for col in numeric_cols]
     selected_test = row2.selectbox("Select Test", options=test_options)
     
     if selected_lab and selected_test:
-        lab_index = meandata[meandata['Lab Code'] == selected_lab].index[0]
-        test_value = meandata.loc[lab_index, selected_test]
-        z_score = meandata.loc[lab_index, f'{selected_test}_zscore']
-        grade = meandata.loc[lab_index, f'{selected_test}_grade']
+        row_label = labs.row_label(selected_lab)
+        test_value = meandata.at[row_label, selected_test]
+        z_score = meandata.at[row_label, f'{selected_test}_zscore']
+        grade = meandata.at[row_label, f'{selected_test}_grade']
         
         # Get calculation details
-        calculation = calc_details.loc[lab_index, f'{selected_test}_calculation']
-        grade_explanation = calc_details.loc[lab_index, f'{selected_test}_grade_explanation']
+        calculation, grade_explanation = explanations.explain(row_label, selected_test)
         
         # Display detailed calculation
         st.markdown(f"""
         <div class="calculation-box">
             <h4>Detailed Calculation for Lab {selected_lab}, Test: {selected_test}</h4>
             <p><b>Raw Value:</b> {f"{test_value:.2f}" if not pd.isna(test_value) else "No data"}</p>
-            <p><b>Test Statistics:</b> Mean = {stats_dict[selected_test]['mean']:.2f}, Standard Deviation = {stats_dict[selected_test]['std']:.2f}</p>
+            <p><b>Test Statistics:</b> {location_name} = {stats_dict[selected_test]['mean']:.2f}, {scale_name} = {stats_dict[selected_test]['std']:.2f}</p>
             <p><b>Z-Score Calculation:</b><br>
             <span class="formula">{calculation}</span></p>
             <p><b>Grade Determination:</b><br>
@@ -364,68 +700,97 @@ if uploaded_file is not None:
             <p><b>Final Grade:</b> {grade}</p>
         </div>
         """, unsafe_allow_html=True)
+        
+        # Trend of this lab and test across the saved rounds, read from the history index
+        with stage("history_trend"):
+            trend = history_store.test_trend(selected_lab, selected_test, selected_model)
+        if len(trend) > 0:
+            st.markdown(f"**Trend for Lab {selected_lab}, {selected_test}** ({len(trend)} saved round(s) with Model {selected_model})")
+            # An ordered categorical keeps the rounds in saved order on the x axis
+            rounds = pd.Categorical(trend['Round'], categories=trend['Round'], ordered=True)
+            st.line_chart(trend.assign(Round=rounds), x='Round', y='Z-Score')
+            st.dataframe(trend, hide_index=True, use_container_width=True)
     
     # Visualization
     st.markdown('<div class="subheader-style">Visual Analysis</div>', unsafe_allow_html=True)
     
-    tab1, tab2 = st.tabs(["Grade Distribution", "Z-Score Distribution"])
+    chart_engine = st.radio("Chart engine", charts.CHART_ENGINES, horizontal=True, key="chart_engine")
+    
+    # Only the open tab is drawn; both charts come from small cached aggregates
+    tab1, tab2 = st.tabs(["Grade Distribution", "Z-Score Distribution"], on_change="rerun", key="visual_tabs")
     
     with tab1:
-        grade_cols = [col for col in meandata.columns if '_grade' in col]
-        grade_data = meandata[['Lab Code'] + grade_cols].melt(id_vars='Lab Code', var_name='Test', value_name='Grade')
-        grade_counts = grade_data.groupby(['Test', 'Grade']).size().reset_index(name='Count')
-        
-        fig, ax = plt.subplots(figsize=(12, 6))
-        sns.barplot(data=grade_counts, x='Test', y='Count', hue='Grade', 
-                   palette={'Excellent':'#2ecc71', 'Good':'#3498db', 'Satisfactory':'#f39c12', 
-                           'Unsatisfactory':'#e74c3c', 'Serious problem':'#c0392b', 'No data':'#95a5a6'})
-        plt.xticks(rotation=45, ha='right')
-        plt.title(f'Grade Distribution by Test (Model {selected_model})')
-        plt.tight_layout()
-        st.pyplot(fig)
+        if tab1.open:
+            with stage("grade_chart"):
+                chart = grade_chart(round_key, compact, estimator, selected_model, chart_engine, meandata, numeric_cols)
+            if chart_engine == 'Plotly':
+                st.plotly_chart(chart, use_container_width=True)
+            else:
+                st.image(chart)
     
     with tab2:
-        zscore_cols = [col for col in meandata.columns if '_zscore' in col]
-        zscore_data = meandata[['Lab Code'] + zscore_cols].melt(id_vars='Lab Code', var_name='Test', value_name='Z-Score')
-        
-        fig, ax = plt.subplots(figsize=(12, 6))
-        sns.boxplot(data=zscore_data, x='Test', y='Z-Score')
-        plt.xticks(rotation=45, ha='right')
-        plt.title(f'Z-Score Distribution by Test (Model {selected_model})')
-        plt.tight_layout()
-        st.pyplot(fig)
+        if tab2.open:
+            with stage("zscore_chart"):
+                chart = zscore_chart(round_key, compact, estimator, selected_model, chart_engine, meandata, numeric_cols)
+            if chart_engine == 'Plotly':
+                st.plotly_chart(chart, use_container_width=True)
+            else:
+                st.image(chart)
     
-    # Add calculation details to download
-    download_df = meandata.copy()
+    export_format = st.selectbox(
+        "Report format",
+        options=storage.export_formats(),
+        format_func=lambda fmt: storage.EXPORT_FORMATS[fmt][0],
+        key="export_format"
+    )
     
-    # Add calculation details to the download DataFrame
-    for col in numeric_cols:
-        download_df[f'{col}_calculation_details'] = calc_details[f'{col}_calculation']
-        download_df[f'{col}_grade_explanation'] = calc_details[f'{col}_grade_explanation']
+    def build_analysis_export(fmt):
+        # Only runs when the button is clicked. The file is written in chunks with the
+        # calculation details and cached on disk per round, settings, model and format;
+        # the least recently used exports are deleted once the cache is full
+        export_path = storage.export_path(
+            f"{round_key}|{estimator}|{'compact' if compact else 'standard'}",
+            f'smartlab_analysis_model_{selected_model}', fmt
+        )
+        data = storage.read_cached_export(export_path)
+        if data is None:
+            with stage("analysis_export"):
+                storage.write_export(analysis.export_chunks(meandata, numeric_cols, stats_dict), export_path, fmt)
+            data = storage.read_file(export_path)
+            storage.prune_exports()
+        return data
     
     # Download button for processed data
+    _, export_extension, export_mime = storage.EXPORT_FORMATS[export_format]
     st.download_button(
         label=f"📥 Download Analysis Report for Model {selected_model}",
-        data=download_df.to_csv(index=False).encode('utf-8'),
-        file_name=f'smartlab_analysis_model_{selected_model}.csv',
-        mime='text/csv',
+        data=functools.partial(build_analysis_export, export_format),
+        file_name=f'smartlab_analysis_model_{selected_model}{export_extension}',
+        mime=export_mime,
         use_container_width=True
     )
     
     # Download all split files as a zip
     st.markdown('<div class="subheader-style">Download All Split Files</div>', unsafe_allow_html=True)
     if st.button("Download All Model Code Files as ZIP"):
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for model_code in unique_model_codes:
-                output_filename = f"BloodData_Model_{model_code}.csv"
-                output_path = os.path.join("split_by_model_code", output_filename)
-                zip_file.write(output_path, output_filename)
-        
-        zip_buffer.seek(0)
+        def split_file_members():
+            for model_code in split_model_codes:
+                output_filename = storage.split_filename(model_code, split_format)
+                output_data = split_writer.ready_data(data_hash, model_code, split_format)
+                if output_data is not None:
+                    yield output_filename, output_data
+                else:
+                    # Disk copy not ready yet or replaced by another round, serialize straight from memory
+                    model_data = get_model_data(model_code)
+                    yield output_filename, storage.serialize_frame(model_data, split_format)
+        
+        # Parquet and Feather files are already compressed
+        split_compression = zipfile.ZIP_DEFLATED if split_format == 'csv' else zipfile.ZIP_STORED
+        with stage("split_files_zip"):
+            zip_spool = storage.spooled_zip(split_file_members(), split_compression)
         st.download_button(
             label="📦 Download ZIP of All Split Files",
-            data=zip_buffer,
+            data=functools.partial(storage.read_spool, zip_spool),
             file_name="split_model_code_files.zip",
             mime="application/zip",
             use_container_width=True
@@ -434,21 +799,13 @@ if uploaded_file is not None:
     # Generate a detailed report for selected lab
     st.markdown('<div class="subheader-style">Export Detailed Calculation Report</div>', unsafe_allow_html=True)
     
-    export_lab = st.selectbox("Select Lab for Detailed Report", options=meandata['Lab Code'].unique(), key="export_lab")
+    export_lab = st.selectbox("Select Lab for Detailed Report", options=labs.lab_codes, key="export_lab")
     
     if st.button("Generate Detailed Report for Selected Lab"):
         st.markdown(f"### Detailed Calculations for Lab: {export_lab} (Model: {selected_model})")
-        lab_data = meandata[meandata['Lab Code'] == export_lab]
-        lab_index = lab_data.index[0]
+        lab_record = labs.record(export_lab)
         
-        for col in numeric_cols:
-            test_value = lab_data.iloc[0][col]
-            z_score = lab_data.iloc[0][f'{col}_zscore']
-            grade = lab_data.iloc[0][f'{col}_grade']
-            
-            calculation = calc_details.loc[lab_index, f'{col}_calculation']
-            grade_explanation = calc_details.loc[lab_index, f'{col}_grade_explanation']
-            
+        for col, (test_value, z_score, grade, calculation, grade_explanation) in lab_record.iterrows():
             st.markdown(f"""
             <div class="calculation-box">
                 <h4>Test: {col}</h4>
@@ -464,344 +821,6 @@ if uploaded_file is not None:
     # Add PDF Report Generation Section with enhanced Lab Code and Model Code format
     st.markdown('<div class="subheader-style">Generate Final PDF Report</div>', unsafe_allow_html=True)
     
-    def create_pdf_report(lab_code, model_code, meandata, stats_dict, numeric_cols, calc_details):
-        """Generate a PDF report for a specific lab with enhanced Lab Code and Model Code format"""
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4, title=f"SmartLab Report - Lab {lab_code} Model {model_code}")
-        styles = getSampleStyleSheet()
-        
-        # Create custom styles
-        title_style = ParagraphStyle(
-            'Title',
-            parent=styles['Heading1'],
-            fontSize=20,
-            textColor=colors.navy,
-            spaceAfter=12,
-            alignment=1  # Center alignment
-        )
-        
-        subtitle_style = ParagraphStyle(
-            'Subtitle',
-            parent=styles['Heading2'],
-            fontSize=14,
-            textColor=colors.darkblue,
-            spaceAfter=6
-        )
-        
-        lab_model_style = ParagraphStyle(
-            'LabModel',
-            parent=styles['Heading2'],
-            fontSize=16,
-            textColor=colors.darkblue,
-            spaceAfter=8,
-            borderWidth=1,
-            borderColor=colors.navy,
-            borderPadding=5,
-            borderRadius=5,
-            alignment=1  # Center alignment
-        )
-        
-        normal_style = ParagraphStyle(
-            'Normal',
-            parent=styles['Normal'],
-            fontSize=10,
-            spaceAfter=6
-        )
-        
-        header_style = ParagraphStyle(
-            'Header',
-            parent=styles['Heading3'],
-            fontSize=12,
-            textColor=colors.darkblue,
-            spaceAfter=6
-        )
-        
-        # Filter data for the selected lab
-        lab_data = meandata[meandata['Lab Code'] == lab_code]
-        if len(lab_data) == 0:
-            return None
-        
-        lab_index = lab_data.index[0]
-        
-        # Build the elements for the PDF
-        elements = []
-        
-        # Add title and metadata with enhanced formatting
-        elements.append(Paragraph(f"SmartLab Blood Cell Quality Analysis", title_style))
-        elements.append(Spacer(1, 0.2*inch))
-        
-        # Add Lab Code and Model Code in a more prominent way
-        elements.append(Paragraph(f"LAB CODE: {lab_code} • MODEL CODE: {model_code}", lab_model_style))
-        elements.append(Spacer(1, 0.2*inch))
-        
-        elements.append(Paragraph(f"Report Generated: {pd.Timestamp.now().strftime('%B %d, %Y')}", normal_style))
-        elements.append(Spacer(1, 0.3*inch))
-        
-        # Add summary section with Lab/Model information
-        elements.append(Paragraph("TEST RESULTS SUMMARY", header_style))
-        elements.append(Paragraph(f"The following results are for Laboratory {lab_code} using Model {model_code} equipment:", normal_style))
-        elements.append(Spacer(1, 0.1*inch))
-        
-        # Create a data table for the test results with improved formatting
-        summary_data = [['Test', 'Value', 'Z-Score', 'Grade']]
-        
-        # Track problematic tests for the executive summary
-        problematic_tests = []
-        
-        for col in numeric_cols:
-            test_value = lab_data.iloc[0][col]
-            z_score = lab_data.iloc[0][f'{col}_zscore']
-            grade = lab_data.iloc[0][f'{col}_grade']
-            
-            # Format values properly
-            formatted_value = f"{test_value:.2f}" if pd.notna(test_value) else "No data"
-            formatted_z_score = f"{z_score:.2f}" if pd.notna(z_score) else "N/A"
-            
-            summary_data.append([col, formatted_value, formatted_z_score, grade])
-            
-            # Track problematic tests for executive summary
-            if grade in ["Unsatisfactory", "Serious problem"]:
-                problematic_tests.append((col, grade, formatted_value, formatted_z_score))
-        
-        # Create the table
-        summary_table = Table(summary_data, colWidths=[1.5*inch, 1*inch, 1*inch, 1.5*inch])
-        
-        # Define table style with colors based on grades
-        table_style = TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.navy),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('ALIGN', (1, 1), (2, -1), 'CENTER'),  # Center-align the values and z-scores
-        ])
-        
-        # Add row-specific styling based on grades
-        for i, row in enumerate(summary_data[1:], 1):
-            grade = row[3]
-            if grade == "Excellent":
-                table_style.add('BACKGROUND', (3, i), (3, i), colors.green)
-                table_style.add('TEXTCOLOR', (3, i), (3, i), colors.white)
-            elif grade == "Good":
-                table_style.add('BACKGROUND', (3, i), (3, i), colors.blue)
-                table_style.add('TEXTCOLOR', (3, i), (3, i), colors.white)
-            elif grade == "Satisfactory":
-                table_style.add('BACKGROUND', (3, i), (3, i), colors.orange)
-                table_style.add('TEXTCOLOR', (3, i), (3, i), colors.white)
-            elif grade == "Unsatisfactory":
-                table_style.add('BACKGROUND', (3, i), (3, i), colors.red)
-                table_style.add('TEXTCOLOR', (3, i), (3, i), colors.white)
-            elif grade == "Serious problem":
-                table_style.add('BACKGROUND', (3, i), (3, i), colors.darkred)
-                table_style.add('TEXTCOLOR', (3, i), (3, i), colors.white)
-            else:
-                table_style.add('BACKGROUND', (3, i), (3, i), colors.gray)
-                table_style.add('TEXTCOLOR', (3, i), (3, i), colors.white)
-        
-        summary_table.setStyle(table_style)
-        elements.append(summary_table)
-        elements.append(Spacer(1, 0.3*inch))
-        
-        # Add executive summary if there are problematic tests
-        if problematic_tests:
-            elements.append(Paragraph("EXECUTIVE SUMMARY", header_style))
-            
-            attention_style = ParagraphStyle(
-                'Attention',
-                parent=styles['Normal'],
-                fontSize=10,
-                textColor=colors.red,
-                spaceAfter=6
-            )
-            
-            elements.append(Paragraph(
-                f"<b>ATTENTION REQUIRED:</b> Lab {lab_code} has {len(problematic_tests)} test(s) that require immediate attention:",
-                attention_style
-            ))
-            
-            for test, grade, value, zscore in problematic_tests:
-                elements.append(Paragraph(
-                    f"• <b>{test}</b>: {grade} (Value: {value}, Z-Score: {zscore})",
-                    normal_style
-                ))
-            
-            elements.append(Spacer(1, 0.15*inch))
-        
-        # Add statistical context section
-        elements.append(Paragraph("MODEL STATISTICAL REFERENCE", header_style))
-        elements.append(Paragraph(f"Statistical distribution for all laboratories using Model {model_code}:", normal_style))
-        elements.append(Spacer(1, 0.1*inch))
-        
-        stat_data = [['Test', 'Population Mean', 'Population Std Dev', 'Sample Count']]
-        for col in numeric_cols:
-            stat_data.append([
-                col, 
-                f"{stats_dict[col]['mean']:.2f}", 
-                f"{stats_dict[col]['std']:.2f}", 
-                f"{stats_dict[col]['count']}"
-            ])
-        
-        stat_table = Table(stat_data, colWidths=[1.5*inch, 1.5*inch, 1.5*inch, 1.5*inch])
-        stat_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.navy),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('ALIGN', (1, 1), (2, -1), 'CENTER'),
-        ]))
-        
-        elements.append(stat_table)
-        elements.append(Spacer(1, 0.3*inch))
-        
-        # Add detailed calculations section with enhanced lab/model presentation
-        elements.append(Paragraph(f"DETAILED CALCULATIONS FOR LAB {lab_code}", header_style))
-        elements.append(Paragraph(f"Model {model_code} Performance Analysis", subtitle_style))
-        elements.append(Spacer(1, 0.1*inch))
-        
-        for col in numeric_cols:
-            test_value = lab_data.iloc[0][col]
-            z_score = lab_data.iloc[0][f'{col}_zscore']
-            grade = lab_data.iloc[0][f'{col}_grade']
-            
-            if pd.notna(test_value):
-                elements.append(Paragraph(f"<b>Test: {col}</b>", subtitle_style))
-                elements.append(Paragraph(f"Raw Value: {test_value:.2f}", normal_style))
-                
-                # Get calculation details
-                calculation = calc_details.loc[lab_index, f'{col}_calculation']
-                grade_explanation = calc_details.loc[lab_index, f'{col}_grade_explanation']
-                
-                elements.append(Paragraph(f"<b>Z-Score Calculation:</b> {calculation}", normal_style))
-                elements.append(Paragraph(f"<b>Grade Determination:</b> {grade_explanation}", normal_style))
-                elements.append(Paragraph(f"<b>Final Grade:</b> {grade}", normal_style))
-                elements.append(Spacer(1, 0.15*inch))
-        
-        # Add interpretations and recommendations section
-        elements.append(Paragraph("RECOMMENDATIONS", header_style))
-        
-        # Count grades to provide an overall summary
-        grade_counts = {
-            "Excellent": 0,
-            "Good": 0,
-            "Satisfactory": 0,
-            "Unsatisfactory": 0,
-            "Serious problem": 0,
-            "No data": 0
-        }
-        
-        for col in numeric_cols:
-            grade = lab_data.iloc[0][f'{col}_grade']
-            if pd.notna(grade):
-                grade_counts[grade] += 1
-        
-        total_grades = sum(grade_counts.values()) - grade_counts["No data"]
-        
-        # Generate interpretation text with enhanced formatting
-        interpretation_text = f"<b>Lab {lab_code}</b> performance with <b>Model {model_code}</b> equipment shows the following distribution:"
-        elements.append(Paragraph(interpretation_text, normal_style))
-        
-        # Create a mini table for grade distribution
-        grade_dist = [['Grade', 'Count', 'Percentage']]
-        for grade, count in grade_counts.items():
-            if grade != "No data":
-                if total_grades > 0:
-                    percentage = (count / total_grades) * 100
-                    grade_dist.append([grade, str(count), f"{percentage:.1f}%"])
-        
-        if grade_counts["No data"] > 0:
-            grade_dist.append(["No data", str(grade_counts["No data"]), "N/A"])
-        
-        grade_table = Table(grade_dist, colWidths=[1.5*inch, 1*inch, 1.5*inch])
-        grade_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.lightsteelblue),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.black),
-            ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('ALIGN', (1, 1), (2, -1), 'CENTER'),
-        ]))
-        
-        elements.append(grade_table)
-        elements.append(Spacer(1, 0.15*inch))
-        
-        # Add recommendations based on overall performance
-        elements.append(Paragraph("<b>Action Items for Lab Management:</b>", normal_style))
-        
-        if grade_counts["Unsatisfactory"] + grade_counts["Serious problem"] > 0:
-            elements.append(Paragraph(
-                "• <b>URGENT:</b> Review tests with 'Unsatisfactory' or 'Serious problem' grades.", 
-                normal_style
-            ))
-            elements.append(Paragraph(
-                "• Verify equipment calibration for Model " + str(model_code) + " at Lab " + str(lab_code) + ".", 
-                normal_style
-            ))
-            elements.append(Paragraph(
-                "• Check technician training and procedural adherence.", 
-                normal_style
-            ))
-        
-        if grade_counts["Satisfactory"] > 0:
-            elements.append(Paragraph(
-                "• <b>RECOMMENDED:</b> Schedule routine review for tests with 'Satisfactory' grades.", 
-                normal_style
-            ))
-            elements.append(Paragraph(
-                "• Consider additional staff training on Model " + str(model_code) + " equipment.", 
-                normal_style
-            ))
-        
-        if grade_counts["Excellent"] + grade_counts["Good"] > 0:
-            elements.append(Paragraph(
-                "• <b>POSITIVE FINDING:</b> " + str(grade_counts["Excellent"] + grade_counts["Good"]) + 
-                " test(s) show excellent or good performance.", 
-                normal_style
-            ))
-        
-        if grade_counts["Excellent"] + grade_counts["Good"] == total_grades and total_grades > 0:
-            elements.append(Paragraph(
-                "• <b>CONGRATULATIONS:</b> All tests are performing well. Continue current quality control processes.", 
-                normal_style
-            ))
-        
-        # Add certification section
-        elements.append(Spacer(1, 0.3*inch))
-        elements.append(Paragraph("CERTIFICATION", header_style))
-        
-        cert_text = f"""This report was automatically generated by the SmartLab Blood Cell Quality Analysis System
-        for Lab Code {lab_code} using Model {model_code} equipment. The analysis is based on statistical comparison 
-        with other laboratories using the same model code. Results should be reviewed by qualified laboratory personnel."""
-        
-        elements.append(Paragraph(cert_text, normal_style))
-        
-        # Add footer with page numbers and lab/model code
-        def add_page_number(canvas, doc):
-            canvas.saveState()
-            canvas.setFont('Helvetica', 9)
-            page_num = canvas.getPageNumber()
-            text = f"Page {page_num}"
-            canvas.drawRightString(A4[0] - 30, 30, text)
-            
-            # Add lab/model code to footer
-            canvas.drawString(30, 30, f"Lab: {lab_code} | Model: {model_code}")
-            
-            # Add report timestamp
-            timestamp = pd.Timestamp.now().strftime("%Y-%m-%d %H:%M")
-            canvas.drawCentredString(A4[0]/2, 30, f"Generated: {timestamp}")
-            
-            canvas.restoreState()
-        
-        # Build the PDF
-        doc.build(elements, onFirstPage=add_page_number, onLaterPages=add_page_number)
-        buffer.seek(0)
-        return buffer
-    
     # Report generation interface with explanatory text
     st.markdown("""
     <div class="info-box">
@@ -814,19 +833,21 @@ if uploaded_file is not None:
     
     report_lab = col1.selectbox(
         "Select Lab for PDF Report", 
-        options=meandata['Lab Code'].unique(), 
+        options=labs.lab_codes, 
         key="pdf_report_lab"
     )
     
     if col2.button("Generate PDF Report"):
-        with st.spinner('Generating PDF report...'):
-            pdf_buffer = create_pdf_report(
+        with st.spinner('Generating PDF report...'), stage("pdf_report"):
+            import reports
+            pdf_buffer = reports.create_pdf_report(
                 report_lab, 
                 selected_model, 
-                meandata, 
+                labs, 
                 stats_dict, 
-                numeric_cols, 
-                calc_details
+                numeric_cols,
+                estimator,
+                history_store.lab_history(report_lab, selected_model)
             )
             
             if pdf_buffer:
@@ -840,55 +861,106 @@ if uploaded_file is not None:
                     mime="application/pdf",
                     use_container_width=True
                 )
-                
-                # Add option to generate reports for all labs
-                if st.button("Generate Reports for All Labs in this Model"):
-                    all_labs = meandata['Lab Code'].unique()
-                    zip_buffer = BytesIO()
-                    
-                    # Create progress bar
-                    progress_bar = st.progress(0)
-                    status_text = st.empty()
-                    
-                    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                        for i, lab in enumerate(all_labs):
-                            # Update progress
-                            progress = int((i+1) / len(all_labs) * 100)
-                            progress_bar.progress(progress)
-                            status_text.text(f"Processing Lab {lab} ({i+1}/{len(all_labs)})")
-                            
-                            # Generate PDF for this lab
-                            lab_pdf = create_pdf_report(
-                                lab, 
-                                selected_model, 
-                                meandata, 
-                                stats_dict, 
-                                numeric_cols, 
-                                calc_details
-                            )
-                            
-                            if lab_pdf:
-                                # Add to zip
-                                zip_file.writestr(
-                                    f"SmartLab_Lab{lab}_Model{selected_model}_Report.pdf",
-                                    lab_pdf.getvalue()
-                                )
-                    
-                    # Reset progress 
-                    progress_bar.empty()
-                    status_text.empty()
-                    
-                    # Provide download for zip file
-                    zip_buffer.seek(0)
-                    st.download_button(
-                        label=f"📥 Download All Lab Reports for Model {selected_model} (ZIP)",
-                        data=zip_buffer,
-                        file_name=f"SmartLab_AllLabs_Model{selected_model}_Reports.zip",
-                        mime="application/zip",
-                        use_container_width=True
-                    )
             else:
                 st.error("Could not generate PDF report. Please check if data for the selected lab exists.")
+    
+    # Option to generate reports for all labs of this model
+    compress_pdfs = st.checkbox(
+        "Compress PDFs in the ZIP (slower, PDFs barely shrink)",
+        value=False,
+        key="compress_pdf_zip"
+    )
+    if st.button("Generate Reports for All Labs in this Model"):
+        all_labs = labs.lab_codes
+        
+        # Create progress bar
+        progress_bar = st.progress(0)
+        status_text = st.empty()
+        
+        def lab_report_members():
+            # PDFs are rendered in worker processes; each one goes into the zip as it completes
+            import reports
+            lab_reports = reports.generate_lab_reports(
+                selected_model, labs, stats_dict, numeric_cols, estimator=estimator,
+                lab_history=functools.partial(history_store.lab_history, model_code=selected_model))
+            for i, (lab, lab_pdf) in enumerate(lab_reports):
+                yield f"SmartLab_Lab{lab}_Model{selected_model}_Report.pdf", lab_pdf
+                
+                # Update progress
+                progress = int((i+1) / len(all_labs) * 100)
+                progress_bar.progress(progress)
+                status_text.text(f"Processed Lab {lab} ({i+1}/{len(all_labs)})")
+        
+        pdf_compression = zipfile.ZIP_DEFLATED if compress_pdfs else zipfile.ZIP_STORED
+        with stage("pdf_reports_zip"):
+            zip_spool = storage.spooled_zip(lab_report_members(), pdf_compression)
+        
+        # Reset progress 
+        progress_bar.empty()
+        status_text.empty()
+        
+        # Provide download for zip file, read from the spooled file only when clicked
+        st.download_button(
+            label=f"📥 Download All Lab Reports for Model {selected_model} (ZIP)",
+            data=functools.partial(storage.read_spool, zip_spool),
+            file_name=f"SmartLab_AllLabs_Model{selected_model}_Reports.zip",
+            mime="application/zip",
+            use_container_width=True
+        )
 
 else:
-    st.info("ℹ️ Please upload a CSV file to begin analysis. The app will split the data by Model code and calculate z-scores and grades for selected model data.")
+    st.info("ℹ️ Please upload one or more CSV files to begin analysis. The app will split the data by Model code and calculate z-scores and grades for selected model data.")
+
+def stop_stage_recording():
+    # Tracing memory slows every allocation, so it stops with the recording
+    if not st.session_state["debug_stage_timings"]:
+        profiling.stop_memory_tracing()
+
+# Wall time, CPU time and peak memory of every stage, for diagnosing slow reruns
+with st.expander("🛠️ Debug: Stage Timings"):
+    st.checkbox(
+        "Record stage timings",
+        value=False,
+        help="Measure every stage of the following reruns. Memory tracing slows the app down while this is on.",
+        key="debug_stage_timings",
+        on_change=stop_stage_recording
+    )
+    timing_runs = st.session_state["stage_timing_runs"]
+    if not recorder.enabled:
+        st.caption("Recording is off.")
+    else:
+        if os.environ.get(profiling.METRICS_FILE_ENV):
+            st.caption(f"Every run is also written to {os.environ[profiling.METRICS_FILE_ENV]}.")
+        st.markdown(f"**This rerun** (started {recorder.run['started_at']})")
+        # Nested stages are indented under the stage that contains them
+        st.dataframe(pd.DataFrame([
+            {'Stage': '\u2003' * record['depth'] + record['stage'], 'Wall (s)': record['wall_seconds'],
+             'CPU (s)': record['cpu_seconds'], 'Peak memory (KiB)': round(record['peak_memory_bytes'] / 1024, 1),
+             'Failed': record['failed']}
+            for record in recorder.run['stages']
+        ], columns=['Stage', 'Wall (s)', 'CPU (s)', 'Peak memory (KiB)', 'Failed']),
+            hide_index=True, use_container_width=True)
+        st.markdown(f"**Recent reruns** (last {profiling.MAX_RUNS} kept)")
+        st.dataframe(pd.DataFrame([
+            {'Run': run['run'], 'Started': run['started_at'], 'Stages': len(run['stages']),
+             'Wall (s)': round(sum(record['wall_seconds'] for record in run['stages'] if record['depth'] == 0), 3)}
+            for run in reversed(timing_runs)
+        ]), hide_index=True, use_container_width=True)
+
+        format_col, path_col = st.columns(2)
+        metrics_format = format_col.selectbox(
+            "Metrics format",
+            options=list(profiling.METRICS_FORMATS),
+            format_func=lambda fmt: profiling.METRICS_FORMATS[fmt][0],
+            key="metrics_format"
+        )
+        metrics_path = path_col.text_input("Metrics file", value=profiling.METRICS_FORMATS[metrics_format][1],
+                                           key=f"metrics_path_{metrics_format}")
+        if st.button("Write metrics file", key="write_metrics"):
+            try:
+                profiling.write_metrics(timing_runs, metrics_path, metrics_format)
+                st.success(f"Wrote {len(profiling.stage_records(timing_runs))} stage records to {metrics_path}.")
+            except (OSError, ValueError) as e:
+                st.error(f"Could not write {metrics_path}: {e}")
+
+recorder.finish()
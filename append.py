@@ -0,0 +1,272 @@
+"""Incremental append mode for late-arriving lab submissions.
+
+A round store keeps the rows of every model, the running count/mean/M2 of every
+(model, test) and a changelog. Appending a submission folds its rows into the
+running statistics of the models it touches, re-scores only those models and
+records every existing lab whose grade moved because the statistics of its
+model shifted. Only the affected models' files are read and rewritten, so the
+cost of a late submission follows the size of those models, not of the round:
+
+    python append.py init round.csv --store round_store
+    python append.py add late_submissions.csv --store round_store
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+
+import pandas as pd
+
+import analysis
+import ingest
+import storage
+
+APPEND_FOLDER = "append_store"
+
+META_FILE = "meta.json"
+STATS_FILE = "running_stats.csv"
+CHANGELOG_FILE = "changelog.csv"
+
+CHANGELOG_COLUMNS = [
+    'Submission', 'Model code', 'Lab Code', 'Test',
+    'Previous Z-Score', 'Z-Score', 'Previous Grade', 'Grade',
+]
+
+
+def _native(value):
+    """JSON-friendly scalar (numpy integers become int)"""
+    return value.item() if hasattr(value, 'item') else value
+
+
+class IncrementalRound:
+    """A round that accepts late submissions without recomputing unaffected models.
+
+    Model frames are loaded from the store on first use and scores are computed
+    per model and estimator on demand. Appends are serialized by a lock, so one
+    instance can be shared between sessions.
+    """
+
+    def __init__(self, running_stats, folder=None):
+        self.running_stats = running_stats
+        self.folder = folder
+        self.submissions = []
+        self.changelog = pd.DataFrame(columns=CHANGELOG_COLUMNS)
+        self._frames = {}
+        self._scores = {}
+        self._robust_stats = {}
+        self._lock = threading.RLock()
+
+    @property
+    def test_cols(self):
+        return self.running_stats.test_cols
+
+    @classmethod
+    def from_round(cls, df, folder=None):
+        """Start a store from a complete round and save it if ``folder`` is given"""
+        df = analysis.standard_frame(df).reset_index(drop=True)
+        running_stats = ingest.RunningStats(analysis.get_numeric_cols(df))
+        running_stats.update(df)
+        state = cls(running_stats, folder)
+        model_rows, _ = analysis.group_rows_by_model(df)
+        for model_code, rows in model_rows.items():
+            state._frames[model_code] = df.iloc[rows].reset_index(drop=True)
+        if folder:
+            state.save(list(model_rows))
+        return state
+
+    @staticmethod
+    def exists(folder):
+        return os.path.exists(os.path.join(folder, META_FILE))
+
+    @classmethod
+    def load(cls, folder):
+        """Open a saved store; model rows are read only when a model is used"""
+        with open(os.path.join(folder, META_FILE)) as meta_file:
+            meta = json.load(meta_file)
+        records = {model_code: count for model_code, count in meta['records']}
+        stats_frame = pd.read_csv(os.path.join(folder, STATS_FILE))
+        state = cls(ingest.RunningStats.from_frame(stats_frame, records, meta['columns']), folder)
+        state.submissions = meta['submissions']
+        changelog_path = os.path.join(folder, CHANGELOG_FILE)
+        if os.path.exists(changelog_path):
+            state.changelog = pd.read_csv(changelog_path)
+        return state
+
+    def save(self, model_codes):
+        """Write the given models' rows plus the running statistics and metadata"""
+        os.makedirs(self.folder, exist_ok=True)
+        for model_code in model_codes:
+            storage.write_split_file(self._frames[model_code], model_code, self.folder)
+        stats_csv = self.running_stats.to_frame().to_csv(index=False)
+        storage.atomic_write_bytes(os.path.join(self.folder, STATS_FILE), stats_csv.encode('utf-8'))
+        meta = {
+            'columns': self.running_stats.columns,
+            'records': [[_native(model_code), count] for model_code, count in self.model_counts().items()],
+            'submissions': self.submissions,
+        }
+        storage.atomic_write_bytes(os.path.join(self.folder, META_FILE), json.dumps(meta, indent=2).encode('utf-8'))
+
+    def model_counts(self):
+        return self.running_stats.model_counts()
+
+    def frame(self, model_code):
+        """Raw rows of one model, read from the store on first use"""
+        with self._lock:
+            if model_code not in self._frames:
+                path = os.path.join(self.folder, storage.split_filename(model_code))
+                with open(path, 'rb') as split_file:
+                    model_df, _ = analysis.read_round(split_file.read())
+                self._frames[model_code] = model_df
+            return self._frames[model_code]
+
+    def stats_dict(self, model_code, estimator='classical'):
+        if estimator == 'classical':
+            return self.running_stats.stats_dict(model_code)
+        with self._lock:
+            key = (model_code, estimator)
+            if key not in self._robust_stats:
+                self._robust_stats[key] = analysis.compute_stats(self.frame(model_code), self.test_cols, estimator)
+            return self._robust_stats[key]
+
+    def scored(self, model_code, estimator='classical'):
+        """Z-scores and grades of one model against its current statistics"""
+        with self._lock:
+            key = (model_code, estimator)
+            if key not in self._scores:
+                self._scores[key] = analysis.score_model(
+                    self.frame(model_code), self.test_cols, self.stats_dict(model_code, estimator))
+            return self._scores[key]
+
+    def _conform(self, new_rows):
+        """Align a submission with the round's columns and test dtypes"""
+        missing = [col for col in analysis.NON_TEST_COLUMNS if col not in new_rows.columns]
+        if missing:
+            raise ValueError(f"Submission is missing column(s): {', '.join(missing)}")
+        new_rows = analysis.standard_frame(new_rows).reindex(columns=self.running_stats.columns)
+        new_rows[self.test_cols] = self.running_stats.test_values(new_rows)
+        return new_rows.reset_index(drop=True)
+
+    def _grade_changes(self, model_code, before, after, submission):
+        """Existing labs of one model whose grade differs between two scorings"""
+        after = after.iloc[:len(before)]
+        changes = []
+        for col in self.test_cols:
+            previous = before[f'{col}_grade'].to_numpy()
+            current = after[f'{col}_grade'].to_numpy()
+            moved = previous != current
+            if moved.any():
+                changes.append(pd.DataFrame({
+                    'Submission': submission,
+                    'Model code': model_code,
+                    'Lab Code': before['Lab Code'].to_numpy()[moved],
+                    'Test': col,
+                    'Previous Z-Score': before[f'{col}_zscore'].to_numpy()[moved],
+                    'Z-Score': after[f'{col}_zscore'].to_numpy()[moved],
+                    'Previous Grade': previous[moved],
+                    'Grade': current[moved],
+                }))
+        return changes
+
+    def append(self, new_rows, estimator='classical', submission=None, data_hash=None):
+        """Add late rows and return the grade changes they caused.
+
+        Only models present in ``new_rows`` have their statistics updated and
+        are re-scored. A submission whose ``data_hash`` was already appended
+        is ignored and returns None.
+        """
+        with self._lock:
+            if data_hash is not None and any(entry['sha256'] == data_hash for entry in self.submissions):
+                return None
+
+            new_rows = self._conform(new_rows)
+            model_rows, model_counts = analysis.group_rows_by_model(new_rows)
+            known = self.model_counts()
+            before = {model_code: self.scored(model_code, estimator) for model_code in model_rows if model_code in known}
+
+            self.running_stats.update(new_rows)
+            for model_code, rows in model_rows.items():
+                added = new_rows.iloc[rows]
+                if model_code in known:
+                    added = pd.concat([self.frame(model_code), added], ignore_index=True)
+                self._frames[model_code] = added.reset_index(drop=True)
+                for cache in (self._scores, self._robust_stats):
+                    for key in [key for key in cache if key[0] == model_code]:
+                        del cache[key]
+
+            submission = submission or f"submission {len(self.submissions) + 1}"
+            changes = []
+            for model_code, scores in before.items():
+                changes.extend(self._grade_changes(model_code, scores, self.scored(model_code, estimator), submission))
+            changes = pd.concat(changes, ignore_index=True) if changes else pd.DataFrame(columns=CHANGELOG_COLUMNS)
+
+            self.changelog = pd.concat([self.changelog, changes], ignore_index=True) if len(self.changelog) else changes
+            self.submissions.append({
+                'name': submission,
+                'sha256': data_hash,
+                'submitted_at': pd.Timestamp.now().isoformat(timespec='seconds'),
+                'estimator': estimator,
+                'records': {str(_native(model_code)): count for model_code, count in model_counts.items()},
+                'grade_changes': len(changes),
+            })
+
+            if self.folder:
+                self.save(list(model_rows))
+                changelog_path = os.path.join(self.folder, CHANGELOG_FILE)
+                if len(changes):
+                    changes.to_csv(changelog_path, mode='a', index=False, header=not os.path.exists(changelog_path))
+            return changes
+
+
+def store_folder(data_hash, root=APPEND_FOLDER):
+    """Store location for the round with the given upload hash"""
+    return os.path.join(root, data_hash[:16])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep a round up to date as late lab submissions arrive.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = subparsers.add_parser("init", help="start a round store from a complete round file")
+    init_parser.add_argument("input", help="round file (CSV, Parquet or Feather/Arrow IPC)")
+    init_parser.add_argument("--store", required=True, help="directory of the round store")
+
+    add_parser = subparsers.add_parser("add", help="append a file of late submissions to a round store")
+    add_parser.add_argument("input", help="submission file (CSV, Parquet or Feather/Arrow IPC)")
+    add_parser.add_argument("--store", required=True, help="directory of the round store")
+    add_parser.add_argument("--estimator", choices=list(analysis.ESTIMATORS), default="classical",
+                            help="statistics used to grade the affected models (default: %(default)s)")
+    add_parser.add_argument("--changelog-output", default=None,
+                            help="optional CSV of the grade changes caused by this submission")
+    args = parser.parse_args(argv)
+
+    with open(args.input, 'rb') as input_file:
+        raw_bytes = input_file.read()
+    df, schema_warnings = analysis.read_round(raw_bytes, analysis.round_format(args.input))
+    for warning in schema_warnings:
+        print(f"Warning: {warning}", file=sys.stderr)
+
+    if args.command == "init":
+        if IncrementalRound.exists(args.store):
+            print(f"{args.store} already holds a round store", file=sys.stderr)
+            return 1
+        state = IncrementalRound.from_round(df, args.store)
+        print(f"Stored {len(df)} records across {len(state.model_counts())} models in {args.store}", file=sys.stderr)
+        return 0
+
+    state = IncrementalRound.load(args.store)
+    changes = state.append(df, args.estimator, os.path.basename(args.input), analysis.hash_bytes(raw_bytes))
+    if changes is None:
+        print(f"{args.input} was already appended to {args.store}", file=sys.stderr)
+        return 0
+    if args.changelog_output:
+        storage.atomic_write_bytes(args.changelog_output, changes.to_csv(index=False).encode('utf-8'))
+    affected = state.submissions[-1]['records']
+    print(f"Appended {len(df)} records to {len(affected)} models; "
+          f"{changes['Lab Code'].nunique() if len(changes) else 0} labs changed grade in {len(changes)} results",
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+"""Headless batch analysis of a whole round, fanning model codes out to worker processes.
+
+Runs the same split -> stats -> z-score -> grade -> CSV/PDF export pipeline as
+the Streamlit app for every model code and writes one output directory per
+model plus a run manifest:
+
+    python batch.py round.csv --output-dir batch_output --workers 8
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import analysis
+import storage
+
+
+def analyze_model(model_code, model_df, output_dir, with_pdfs=True, split_format='csv', estimator='classical',
+                  report_format='csv'):
+    """Run the full pipeline for one model and write its outputs to its own directory"""
+    started = time.perf_counter()
+    model_dir = os.path.join(output_dir, f"model_{model_code}")
+    os.makedirs(model_dir, exist_ok=True)
+
+    split_path, _ = storage.write_split_file(model_df, model_code, model_dir, split_format)
+
+    numeric_cols = analysis.get_numeric_cols(model_df)
+    stats_dict = analysis.compute_stats(model_df, numeric_cols, estimator)
+    meandata = analysis.score_model(model_df, numeric_cols, stats_dict)
+    labs = analysis.LabIndex(meandata, numeric_cols, stats_dict)
+
+    stats_path = os.path.join(model_dir, f"statistics_model_{model_code}.csv")
+    stats_csv = analysis.stats_table(stats_dict, numeric_cols, estimator).to_csv(index=False)
+    storage.atomic_write_bytes(stats_path, stats_csv.encode('utf-8'))
+
+    report_path = os.path.join(model_dir, f"smartlab_analysis_model_{model_code}{storage.EXPORT_FORMATS[report_format][1]}")
+    storage.write_export(analysis.export_chunks(meandata, numeric_cols, stats_dict), report_path, report_format)
+
+    pdf_reports = []
+    if with_pdfs:
+        # reportlab is only needed by workers that actually render PDFs
+        import reports
+
+        pdf_dir = os.path.join(model_dir, "reports")
+        os.makedirs(pdf_dir, exist_ok=True)
+        stat_rows = reports.model_stat_rows(stats_dict, numeric_cols, estimator)
+        for lab in labs.lab_codes:
+            pdf_buffer = reports.render_lab_pdf(lab, model_code, labs.record(lab), stats_dict, numeric_cols, estimator,
+                                                stat_rows=stat_rows)
+            pdf_path = os.path.join(pdf_dir, f"SmartLab_Lab{lab}_Model{model_code}_Report.pdf")
+            storage.atomic_write_bytes(pdf_path, pdf_buffer.getvalue())
+            pdf_reports.append(os.path.relpath(pdf_path, output_dir))
+
+    return {
+        'model_code': str(model_code),
+        'status': 'ok',
+        'records': len(model_df),
+        'labs': len(labs),
+        'duplicate_lab_codes': {str(lab): int(count) for lab, count in labs.duplicates.items()},
+        'tests': list(numeric_cols),
+        'outputs': {
+            'directory': os.path.relpath(model_dir, output_dir),
+            'split_file': os.path.relpath(split_path, output_dir),
+            'statistics': os.path.relpath(stats_path, output_dir),
+            'analysis_report': os.path.relpath(report_path, output_dir),
+            'pdf_reports': pdf_reports,
+        },
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def run_batch(input_path, output_dir="batch_output", workers=None, with_pdfs=True, split_format='csv',
+              estimator='classical', report_format='csv'):
+    """Analyze every model code of a round in a process pool and write the run manifest"""
+    started_at = pd.Timestamp.now().isoformat(timespec='seconds')
+    started = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+
+    with open(input_path, 'rb') as input_file:
+        raw_bytes = input_file.read()
+    round_df, schema_warnings = analysis.read_round(raw_bytes, analysis.round_format(input_path))
+    for warning in schema_warnings:
+        print(f"Warning: {warning}", file=sys.stderr)
+    model_rows, model_counts = analysis.group_rows_by_model(round_df)
+
+    models = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(
+                analyze_model,
+                model_code,
+                analysis.model_frame(round_df, model_rows, model_code),
+                output_dir,
+                with_pdfs,
+                split_format,
+                estimator,
+                report_format,
+            ): model_code
+            for model_code in model_rows
+        }
+        for future in as_completed(futures):
+            model_code = futures[future]
+            try:
+                result = future.result()
+            except Exception as exc:
+                result = {
+                    'model_code': str(model_code),
+                    'status': 'failed',
+                    'records': model_counts[model_code],
+                    'error': f"{type(exc).__name__}: {exc}",
+                }
+            models.append(result)
+            print(f"Model {model_code}: {result['status']} ({result['records']} records)", file=sys.stderr)
+
+    # Keep the manifest in round order rather than completion order
+    order = {str(model_code): i for i, model_code in enumerate(model_rows)}
+    models.sort(key=lambda result: order[result['model_code']])
+
+    manifest = {
+        'input_file': os.path.abspath(input_path),
+        'input_sha256': analysis.hash_bytes(raw_bytes),
+        'started_at': started_at,
+        'seconds': round(time.perf_counter() - started, 3),
+        'workers': workers or os.cpu_count(),
+        'split_format': split_format,
+        'estimator': estimator,
+        'report_format': report_format,
+        'pdf_reports': with_pdfs,
+        'total_records': len(round_df),
+        'schema_warnings': schema_warnings,
+        'models': models,
+    }
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    storage.atomic_write_bytes(manifest_path, json.dumps(manifest, indent=2).encode('utf-8'))
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the SmartLab analysis for every model code in a round.")
+    parser.add_argument("input", help="round file (CSV, Parquet or Feather/Arrow IPC)")
+    parser.add_argument("--output-dir", default="batch_output", help="directory for per-model outputs (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: number of CPUs)")
+    parser.add_argument("--no-pdf", action="store_true", help="skip per-lab PDF reports")
+    parser.add_argument("--split-format", choices=list(storage.SPLIT_FORMATS), default="csv",
+                        help="format of the per-model split files (default: %(default)s)")
+    parser.add_argument("--estimator", choices=list(analysis.ESTIMATORS), default="classical",
+                        help="statistics for the z-scores: classical mean/SD, median/scaled MAD or "
+                             "ISO 13528 Algorithm A (default: %(default)s)")
+    parser.add_argument("--report-format", choices=storage.export_formats(), default="csv",
+                        help="format of the per-model analysis report (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    manifest = run_batch(args.input, args.output_dir, args.workers, not args.no_pdf, args.split_format,
+                         args.estimator, args.report_format)
+    failed = [model for model in manifest['models'] if model['status'] != 'ok']
+    print(f"Processed {len(manifest['models'])} models in {manifest['seconds']}s; "
+          f"manifest written to {os.path.join(args.output_dir, 'manifest.json')}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,305 @@
+"""Time every stage of the pipeline on synthetic rounds of increasing size.
+
+Each size gets a deterministic round from synthetic.generate_round. Every
+stage is timed on its own, from parsing the uploaded CSV to the ZIP
+downloads, using the outputs of the earlier stages as its input. Per-model
+stages (Styler, charts, PDF reports, the export) run on the largest model, as
+the app does for the selected model. The best of ``--repeat`` runs after an
+untimed warm-up run is kept.
+
+Results are written as JSON and compared with a stored baseline; a stage more
+than ``--tolerance`` slower than in the baseline is reported as a regression:
+
+    python benchmark.py --sizes 1000 10000 100000 1000000 --json results.json
+    python benchmark.py --save-baseline benchmark_baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import analysis
+import storage
+import synthetic
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+# Labs of the largest model rendered by the pdf_report stage
+PDF_LABS = 10
+
+# Rows of the results page rendered by the styler_page stage
+STYLER_PAGE_ROWS = 50
+
+# Differences below this many seconds are timer noise, not regressions
+MIN_REGRESSION_SECONDS = 0.005
+
+
+def prepare(rows, models, tests, seed):
+    """Inputs of every stage for one round size, computed once and untimed"""
+    raw_df = synthetic.generate_round(labs=rows, models=models, tests=tests, seed=seed)
+    raw_bytes = raw_df.to_csv(index=False).encode('utf-8')
+    df, _ = analysis.read_round(raw_bytes, 'csv')
+    numeric_cols = analysis.get_numeric_cols(df)
+    round_stats = analysis.RoundStats(df, numeric_cols)
+    zscores = analysis.round_zscores(df, numeric_cols, round_stats)
+    scores = analysis.score_round(df, numeric_cols, round_stats)
+    model_rows, model_counts = analysis.group_rows_by_model(scores)
+
+    model_code = max(model_counts, key=model_counts.get)
+    meandata = analysis.model_frame(scores, model_rows, model_code)
+    stats_dict = round_stats.stats_dict(model_code)
+    return {
+        'raw_bytes': raw_bytes,
+        'df': df,
+        'numeric_cols': numeric_cols,
+        'round_stats': round_stats,
+        'zscores': zscores,
+        'scores': scores,
+        'model_rows': model_rows,
+        'model_code': model_code,
+        'meandata': meandata,
+        'stats_dict': stats_dict,
+        'labs': analysis.LabIndex(meandata, numeric_cols, stats_dict),
+    }
+
+
+def split_round(df, output_folder):
+    """Write every model's split file, as the app's split writer does"""
+    model_rows, _ = analysis.group_rows_by_model(df)
+    for model_code in model_rows:
+        storage.write_split_file(analysis.model_frame(df, model_rows, model_code), model_code, output_folder)
+
+
+def stage_csv_parse(ctx, workdir):
+    analysis.read_round(ctx['raw_bytes'], 'csv')
+
+
+def stage_split(ctx, workdir):
+    # A fresh folder every run, so unchanged files are not skipped
+    split_round(ctx['df'], tempfile.mkdtemp(dir=workdir))
+
+
+def stage_stats(ctx, workdir):
+    analysis.RoundStats(ctx['df'], ctx['numeric_cols'])
+
+
+def stage_zscore(ctx, workdir):
+    analysis.round_zscores(ctx['df'], ctx['numeric_cols'], ctx['round_stats'])
+
+
+def stage_grade(ctx, workdir):
+    analysis.grade_matrix(ctx['zscores'])
+
+
+def stage_calc_details(ctx, workdir):
+    scores = ctx['scores']
+    for model_code, rows in ctx['model_rows'].items():
+        meandata = scores.iloc[rows]
+        analysis.ExplanationProvider(meandata, ctx['numeric_cols'], ctx['round_stats'].stats_dict(model_code)).full_columns()
+
+
+def stage_styler_page(ctx, workdir):
+    page = analysis.results_page(ctx['meandata'], np.arange(len(ctx['meandata'])), 0, STYLER_PAGE_ROWS)
+    analysis.style_results(page, ctx['numeric_cols']).to_html()
+
+
+def stage_charts_matplotlib(ctx, workdir):
+    import charts
+
+    counts = analysis.grade_counts(ctx['meandata'], ctx['numeric_cols'])
+    box_stats = analysis.zscore_box_stats(ctx['meandata'], ctx['numeric_cols'])
+    charts.grade_distribution_png(counts, ctx['model_code'])
+    charts.zscore_distribution_png(box_stats, ctx['model_code'])
+
+
+def stage_charts_plotly(ctx, workdir):
+    import charts
+
+    counts = analysis.grade_counts(ctx['meandata'], ctx['numeric_cols'])
+    box_stats = analysis.zscore_box_stats(ctx['meandata'], ctx['numeric_cols'])
+    charts.grade_distribution_plotly(counts, ctx['model_code']).to_json()
+    charts.zscore_distribution_plotly(box_stats, ctx['model_code']).to_json()
+
+
+def stage_pdf_report(ctx, workdir):
+    import reports
+
+    ctx['pdfs'] = [
+        (f"lab_{lab_code}.pdf",
+         reports.create_pdf_report(lab_code, ctx['model_code'], ctx['labs'], ctx['stats_dict'],
+                                   ctx['numeric_cols']).getvalue())
+        for lab_code in ctx['meandata']['Lab Code'].drop_duplicates().head(PDF_LABS)
+    ]
+
+
+def stage_zip_reports(ctx, workdir):
+    if 'pdfs' not in ctx:
+        stage_pdf_report(ctx, workdir)
+    storage.spooled_zip(ctx['pdfs']).close()
+
+
+def stage_zip_split_files(ctx, workdir):
+    if 'split_files' not in ctx:
+        folder = tempfile.mkdtemp(dir=workdir)
+        split_round(ctx['df'], folder)
+        ctx['split_files'] = [(name, os.path.join(folder, name)) for name in sorted(os.listdir(folder))]
+    storage.spooled_zip(ctx['split_files']).close()
+
+
+def stage_export_report(ctx, workdir):
+    chunks = analysis.export_chunks(ctx['meandata'], ctx['numeric_cols'], ctx['stats_dict'])
+    storage.write_export(chunks, os.path.join(workdir, 'export.csv'), 'csv')
+
+
+STAGES = [
+    ('csv_parse', stage_csv_parse),
+    ('split', stage_split),
+    ('stats', stage_stats),
+    ('zscore', stage_zscore),
+    ('grade', stage_grade),
+    ('calc_details', stage_calc_details),
+    ('styler_page', stage_styler_page),
+    ('charts_matplotlib', stage_charts_matplotlib),
+    ('charts_plotly', stage_charts_plotly),
+    ('pdf_report', stage_pdf_report),
+    ('zip_reports', stage_zip_reports),
+    ('zip_split_files', stage_zip_split_files),
+    ('export_report', stage_export_report),
+]
+
+
+def run_size(rows, models, tests, seed, repeat=3, stages=None):
+    """Best time in seconds of every stage for one round size (None if a library is missing)"""
+    ctx = prepare(rows, models, tests, seed)
+    workdir = tempfile.mkdtemp(prefix='smartlab_benchmark_')
+    timings = {}
+    try:
+        for name, stage in STAGES:
+            if stages and name not in stages:
+                continue
+            best = None
+            try:
+                # An untimed first run imports the plotting/PDF libraries and builds cached inputs
+                stage(ctx, workdir)
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    stage(ctx, workdir)
+                    elapsed = time.perf_counter() - started
+                    best = elapsed if best is None else min(best, elapsed)
+            except ImportError:
+                best = None
+            timings[name] = None if best is None else round(best, 4)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return timings
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, models=10, tests=8, seed=0, repeat=3, stages=None):
+    """Timings of every stage for every size, with the environment they were measured in"""
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+        },
+        # The rounds measured; any number of repeats is comparable with them
+        'settings': {'models': models, 'tests': tests, 'seed': seed},
+        'repeat': repeat,
+        'results': {
+            str(rows): run_size(rows, models, tests, seed, repeat, stages)
+            for rows in sizes
+        },
+    }
+
+
+def compare(results, baseline, tolerance):
+    """(size, stage, baseline seconds, seconds) of every stage slower than the baseline allows"""
+    regressions = []
+    for size, timings in results['results'].items():
+        base_timings = baseline.get('results', {}).get(size, {})
+        for stage, seconds in timings.items():
+            base = base_timings.get(stage)
+            if seconds is None or base is None:
+                continue
+            if seconds > base * (1 + tolerance) and seconds - base > MIN_REGRESSION_SECONDS:
+                regressions.append((size, stage, base, seconds))
+    return regressions
+
+
+def print_table(results, baseline=None):
+    sizes = list(results['results'])
+    stages = [name for name, _ in STAGES if any(name in results['results'][size] for size in sizes)]
+    print(f"{'stage':<18}" + "".join(f"{int(size):>14,}" for size in sizes))
+    for stage in stages:
+        cells = []
+        for size in sizes:
+            seconds = results['results'][size].get(stage)
+            base = (baseline or {}).get('results', {}).get(size, {}).get(stage)
+            if seconds is None:
+                cells.append(f"{'-':>14}")
+            elif base:
+                cells.append(f"{seconds:>8.3f}s{seconds / base - 1:>+5.0%}")
+            else:
+                cells.append(f"{seconds:>13.3f}s")
+        print(f"{stage:<18}" + "".join(cells))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time every pipeline stage on synthetic rounds.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="round sizes in rows (default: %(default)s)")
+    parser.add_argument("--models", type=int, default=10, help="number of model codes (default: %(default)s)")
+    parser.add_argument("--tests", type=int, default=8, help="number of test columns (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the rounds (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, best kept (default: %(default)s)")
+    parser.add_argument("--stages", nargs="+", choices=[name for name, _ in STAGES], default=None,
+                        help="only time these stages")
+    parser.add_argument("--json", default=None, help="also write the results to this JSON file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE,
+                        help="baseline to compare with, if it exists (default: %(default)s)")
+    parser.add_argument("--save-baseline", default=None, metavar="PATH",
+                        help="write the results as the new baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown against the baseline (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.sizes, args.models, args.tests, args.seed, args.repeat, args.stages)
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        # Baselines saved before 'repeat' was recorded separately keep it in their settings
+        settings = {key: value for key, value in baseline.get('settings', {}).items() if key != 'repeat'}
+        if settings != results['settings']:
+            print(f"Baseline {args.baseline} was measured with other settings; not comparing", file=sys.stderr)
+            baseline = None
+
+    print_table(results, baseline)
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as output:
+                json.dump(results, output, indent=2)
+                output.write("\n")
+
+    if baseline is None:
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for size, stage, base, seconds in regressions:
+        print(f"Regression: {stage} at {int(size):,} rows took {seconds:.3f}s (baseline {base:.3f}s)",
+              file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Charts for the Visual Analysis tabs, drawn from pre-aggregated data.
+
+Both charts take the small summaries from analysis.grade_counts and
+analysis.zscore_box_stats instead of the per-lab results, so their size
+depends only on the number of tests. Matplotlib charts are returned as PNG
+bytes and Plotly charts as figures. Each plotting library is imported on first
+use.
+"""
+from io import BytesIO
+
+import numpy as np
+
+import analysis
+
+CHART_ENGINES = ['Matplotlib', 'Plotly']
+
+
+def _png(fig):
+    import matplotlib.pyplot as plt
+
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', dpi=100)
+    plt.close(fig)
+    return buffer.getvalue()
+
+
+def grade_distribution_png(counts, model_code):
+    """Grouped bar chart of labs per grade and test, as PNG bytes"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    # Only grades that occur get a bar, as with the long-format groupby before
+    grades = [grade for grade in analysis.GRADE_LABELS if counts[grade].sum() > 0]
+    positions = np.arange(len(counts.index))
+    width = 0.8 / max(len(grades), 1)
+
+    fig, ax = plt.subplots(figsize=(12, 6))
+    for i, grade in enumerate(grades):
+        ax.bar(positions + (i - (len(grades) - 1) / 2) * width, counts[grade], width,
+               label=grade, color=analysis.GRADE_COLORS[grade])
+    ax.set_xticks(positions)
+    ax.set_xticklabels(counts.index, rotation=45, ha='right')
+    ax.set_xlabel('Test')
+    ax.set_ylabel('Count')
+    ax.legend(title='Grade')
+    ax.set_title(f'Grade Distribution by Test (Model {model_code})')
+    fig.tight_layout()
+    return _png(fig)
+
+
+def zscore_distribution_png(box_stats, model_code):
+    """Box plot of z-scores per test from precomputed quartiles, as PNG bytes"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(12, 6))
+    if box_stats:
+        ax.bxp(box_stats, patch_artist=True,
+               boxprops={'facecolor': '#aed6f1'}, medianprops={'color': '#2c3e50'})
+        ax.set_xticks(range(1, len(box_stats) + 1))
+        ax.set_xticklabels([stats['label'] for stats in box_stats], rotation=45, ha='right')
+    ax.set_xlabel('Test')
+    ax.set_ylabel('Z-Score')
+    ax.set_title(f'Z-Score Distribution by Test (Model {model_code})')
+    fig.tight_layout()
+    return _png(fig)
+
+
+def grade_distribution_plotly(counts, model_code):
+    """Grouped bar chart of labs per grade and test, as a Plotly figure"""
+    import plotly.graph_objects as go
+
+    fig = go.Figure()
+    for grade in analysis.GRADE_LABELS:
+        if counts[grade].sum() > 0:
+            fig.add_trace(go.Bar(x=list(counts.index), y=counts[grade].tolist(), name=grade,
+                                 marker_color=analysis.GRADE_COLORS[grade]))
+    fig.update_layout(barmode='group', title=f'Grade Distribution by Test (Model {model_code})',
+                      xaxis_title='Test', yaxis_title='Count', legend_title='Grade')
+    return fig
+
+
+def zscore_distribution_plotly(box_stats, model_code):
+    """Box plot of z-scores per test from precomputed quartiles, as a Plotly figure"""
+    import plotly.graph_objects as go
+
+    labels = [stats['label'] for stats in box_stats]
+    fig = go.Figure(go.Box(
+        x=labels,
+        q1=[stats['q1'] for stats in box_stats],
+        median=[stats['med'] for stats in box_stats],
+        q3=[stats['q3'] for stats in box_stats],
+        lowerfence=[stats['whislo'] for stats in box_stats],
+        upperfence=[stats['whishi'] for stats in box_stats],
+        name='Z-Score',
+        marker_color='#3498db',
+    ))
+    flier_labels = [stats['label'] for stats in box_stats for _ in stats['fliers']]
+    if flier_labels:
+        fig.add_trace(go.Scatter(
+            x=flier_labels,
+            y=np.concatenate([stats['fliers'] for stats in box_stats]).tolist(),
+            mode='markers', name='Outliers', marker={'color': '#2c3e50', 'size': 5},
+        ))
+    fig.update_layout(title=f'Z-Score Distribution by Test (Model {model_code})',
+                      xaxis_title='Test', yaxis_title='Z-Score', showlegend=False)
+    return fig
@@ -0,0 +1,297 @@
+"""Store of processed rounds for per-lab trend queries across rounds.
+
+Every saved round is written as uncompressed Arrow IPC (Feather) files,
+partitioned by round and model code, next to an index of Lab Codes:
+
+    round_history/
+        rounds.json                                  saved rounds, oldest first
+        lab_index.feather                            Lab Code -> round, model code, row
+        round=<round>/model=<code>/results.feather   values, z-scores and grades
+        round=<round>/model=<code>/statistics.feather
+
+Model codes with characters that are unsafe in a path are stored under a
+cleaned name with a hash suffix (see model_dir_name).
+
+A lab's history is looked up in the index and read one row per round from
+memory-mapped files, so it does not scan old rounds:
+
+    python history.py save round.csv --round 2026-03
+    python history.py lab 1001 --test WBC
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+import analysis
+import storage
+
+HISTORY_FOLDER = "round_history"
+
+ROUNDS_FILE = "rounds.json"
+INDEX_FILE = "lab_index.feather"
+RESULTS_FILE = "results.feather"
+STATISTICS_FILE = "statistics.feather"
+
+
+def round_name(name):
+    """Round name usable as a directory name"""
+    name = re.sub(r'[^A-Za-z0-9 ._-]+', '_', str(name)).strip(' ._')
+    if not name:
+        raise ValueError("Round name must contain letters or digits")
+    return name
+
+
+def model_dir_name(model_code):
+    """Partition directory of a model code.
+
+    Characters unsafe in a path are replaced as in round_name, and a hash of
+    the code then keeps the names distinct (e.g. 'A/B' and 'A_B').
+    """
+    model_code = str(model_code)
+    name = re.sub(r'[^A-Za-z0-9 ._-]+', '_', model_code).strip(' ._')
+    if name != model_code:
+        name = f"{name}-{hashlib.sha256(model_code.encode('utf-8')).hexdigest()[:8]}"
+    return f"model={name}"
+
+
+def _write_feather(df, path):
+    # Uncompressed files can be memory-mapped and sliced without decoding
+    feather.write_feather(df.reset_index(drop=True), path, compression='uncompressed')
+
+
+class HistoryStore:
+    """Saved rounds on disk; the round list and Lab Code index are cached in memory.
+
+    Saving a round under an existing name replaces it. One instance can be
+    shared between sessions.
+    """
+
+    def __init__(self, folder=HISTORY_FOLDER):
+        self.folder = folder
+        self._lock = threading.RLock()
+        self._rounds = None
+        self._index = None
+        self._positions = None
+        self._tables = {}
+
+    def _round_dir(self, round_id, model_code=None):
+        path = os.path.join(self.folder, f"round={round_id}")
+        return path if model_code is None else os.path.join(path, model_dir_name(model_code))
+
+    def rounds(self):
+        """Saved rounds in the order they were saved"""
+        with self._lock:
+            if self._rounds is None:
+                path = os.path.join(self.folder, ROUNDS_FILE)
+                if os.path.exists(path):
+                    with open(path) as rounds_file:
+                        self._rounds = json.load(rounds_file)
+                else:
+                    self._rounds = []
+            return self._rounds
+
+    def round_for_hash(self, data_hash):
+        """Name of the saved round with this upload hash, or None"""
+        for entry in self.rounds():
+            if entry['data_hash'] == data_hash:
+                return entry['round']
+        return None
+
+    def _lab_positions(self):
+        with self._lock:
+            if self._positions is None:
+                path = os.path.join(self.folder, INDEX_FILE)
+                if os.path.exists(path):
+                    self._index = feather.read_feather(path)
+                    # Indexes written before Lab Codes were stored as text hold numbers
+                    self._index['Lab Code'] = analysis.lab_code_text(self._index['Lab Code'])
+                else:
+                    self._index = pd.DataFrame({'Lab Code': pd.Series([], dtype=str), 'Round': [],
+                                                'Model code': [], 'Row': pd.Series([], dtype='int64')})
+                self._positions = self._index.groupby('Lab Code', sort=False).indices
+            return self._index, self._positions
+
+    def _table(self, round_id, model_code, filename):
+        key = (round_id, model_code, filename)
+        with self._lock:
+            if key not in self._tables:
+                path = os.path.join(self._round_dir(round_id, model_code), filename)
+                self._tables[key] = feather.read_table(path, memory_map=True)
+            return self._tables[key]
+
+    def model_statistics(self, round_id, model_code):
+        """Saved statistics of one model in one round, indexed by test"""
+        key = (round_id, str(model_code), 'statistics')
+        with self._lock:
+            if key not in self._tables:
+                self._tables[key] = self._table(round_id, str(model_code), STATISTICS_FILE).to_pandas().set_index('Test')
+            return self._tables[key]
+
+    def save_round(self, round_id, scores, round_stats, data_hash=None):
+        """Persist a scored round (see analysis.score_round) and its model statistics"""
+        round_id = round_name(round_id)
+        numeric_cols = round_stats.test_cols
+        model_rows, model_counts = analysis.group_rows_by_model(scores)
+
+        with self._lock:
+            os.makedirs(self.folder, exist_ok=True)
+            # Write the new partitions beside the old ones, then swap them in
+            staging_dir = self._round_dir(round_id) + ".tmp"
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            index_parts = []
+            for model_code, rows in model_rows.items():
+                model_dir = os.path.join(staging_dir, model_dir_name(model_code))
+                os.makedirs(model_dir)
+                results = analysis.standard_frame(scores.iloc[rows])
+                _write_feather(results, os.path.join(model_dir, RESULTS_FILE))
+                stats_dict = round_stats.stats_dict(model_code)
+                _write_feather(pd.DataFrame({
+                    'Test': numeric_cols,
+                    'Mean': [stats_dict[col]['mean'] for col in numeric_cols],
+                    'Std Dev': [stats_dict[col]['std'] for col in numeric_cols],
+                    'Count': [stats_dict[col]['count'] for col in numeric_cols],
+                }), os.path.join(model_dir, STATISTICS_FILE))
+                index_parts.append(pd.DataFrame({
+                    'Lab Code': analysis.lab_code_text(results['Lab Code']),
+                    'Round': round_id,
+                    'Model code': str(model_code),
+                    'Row': range(len(results)),
+                }))
+            shutil.rmtree(self._round_dir(round_id), ignore_errors=True)
+            os.replace(staging_dir, self._round_dir(round_id))
+
+            index, _ = self._lab_positions()
+            index = pd.concat([index[index['Round'] != round_id]] + index_parts, ignore_index=True)
+            _write_feather(index, os.path.join(self.folder, INDEX_FILE))
+
+            rounds = [entry for entry in self.rounds() if entry['round'] != round_id]
+            rounds.append({
+                'round': round_id,
+                'saved_at': pd.Timestamp.now().isoformat(timespec='seconds'),
+                'data_hash': data_hash,
+                'estimator': round_stats.estimator,
+                'records': int(sum(model_counts.values())),
+                'models': [str(model_code) for model_code in model_counts],
+                'tests': list(numeric_cols),
+            })
+            storage.atomic_write_bytes(os.path.join(self.folder, ROUNDS_FILE),
+                                       json.dumps(rounds, indent=2).encode('utf-8'))
+
+            self._rounds = rounds
+            self._index = self._positions = None
+            self._tables = {key: table for key, table in self._tables.items() if key[0] != round_id}
+        return round_id
+
+    def lab_history(self, lab_code, model_code=None):
+        """One row per saved round with the lab's values, z-scores and grades, oldest first"""
+        index, positions = self._lab_positions()
+        entries = index.iloc[positions.get(analysis.lab_code_text([lab_code])[0], [])]
+        if model_code is not None:
+            entries = entries[entries['Model code'] == str(model_code)]
+        # A Lab Code repeated within a model uses its first row, as in analysis.LabIndex
+        entries = entries.drop_duplicates(['Round', 'Model code'])
+        if len(entries) == 0:
+            return pd.DataFrame(columns=['Round'])
+
+        order = {entry['round']: i for i, entry in enumerate(self.rounds())}
+        entries = entries.assign(order=entries['Round'].map(order)).sort_values('order', kind='stable')
+        rows = [
+            self._table(round_id, entry_model, RESULTS_FILE).slice(row, 1)
+            for round_id, entry_model, row in zip(entries['Round'], entries['Model code'], entries['Row'])
+        ]
+        if len({row.schema.field('Lab Code').type for row in rows}) > 1:
+            # Rounds with numeric and text Lab Codes are combined with the Lab Code as text
+            rows = [
+                row.set_column(row.schema.get_field_index('Lab Code'), 'Lab Code',
+                               pa.array(analysis.lab_code_text(row.column('Lab Code').to_pandas()), type=pa.string()))
+                for row in rows
+            ]
+        history = pa.concat_tables(rows, promote_options='default').to_pandas()
+        history.insert(0, 'Round', entries['Round'].to_numpy())
+        return history
+
+    def test_trend(self, lab_code, test, model_code=None):
+        """A lab's value, z-score and grade for one test per saved round, with the model statistics"""
+        history = self.lab_history(lab_code, model_code)
+        columns = ['Round', 'Model code', 'Value', 'Z-Score', 'Grade', 'Mean', 'Std Dev']
+        if len(history) == 0 or test not in history.columns:
+            return pd.DataFrame(columns=columns)
+
+        means, stds = [], []
+        for round_id, entry_model in zip(history['Round'], history['Model code'].astype(str)):
+            stats = self.model_statistics(round_id, entry_model)
+            means.append(stats['Mean'].get(test))
+            stds.append(stats['Std Dev'].get(test))
+        return pd.DataFrame({
+            'Round': history['Round'],
+            'Model code': history['Model code'],
+            'Value': history[test],
+            'Z-Score': history[f'{test}_zscore'],
+            'Grade': history[f'{test}_grade'].astype(str),
+            'Mean': means,
+            'Std Dev': stds,
+        }, columns=columns)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Save scored rounds and query a lab's results across rounds.")
+    parser.add_argument("--store", default=HISTORY_FOLDER, help="history directory (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    save_parser = subparsers.add_parser("save", help="score a round file and save it to the history")
+    save_parser.add_argument("input", help="round file (CSV, Parquet or Feather/Arrow IPC)")
+    save_parser.add_argument("--round", default=None, help="round name (default: the file name)")
+    save_parser.add_argument("--estimator", choices=list(analysis.ESTIMATORS), default="classical",
+                             help="statistics used for the z-scores (default: %(default)s)")
+
+    subparsers.add_parser("rounds", help="list the saved rounds")
+
+    lab_parser = subparsers.add_parser("lab", help="print a lab's results across the saved rounds")
+    lab_parser.add_argument("lab_code", help="Lab Code to look up")
+    lab_parser.add_argument("--test", default=None, help="only this test, with the model statistics")
+    lab_parser.add_argument("--model", default=None, help="only rounds in which the lab used this model code")
+    args = parser.parse_args(argv)
+
+    store = HistoryStore(args.store)
+
+    if args.command == "save":
+        with open(args.input, 'rb') as input_file:
+            raw_bytes = input_file.read()
+        df, schema_warnings = analysis.read_round(raw_bytes, analysis.round_format(args.input))
+        for warning in schema_warnings:
+            print(f"Warning: {warning}", file=sys.stderr)
+        round_stats = analysis.RoundStats(df, analysis.get_numeric_cols(df), args.estimator)
+        scores = analysis.score_round(df, round_stats.test_cols, round_stats)
+        round_id = store.save_round(args.round or os.path.splitext(os.path.basename(args.input))[0],
+                                    scores, round_stats, analysis.hash_bytes(raw_bytes))
+        print(f"Saved {len(df)} records as round {round_id} in {args.store}", file=sys.stderr)
+        return 0
+
+    if args.command == "rounds":
+        print(pd.DataFrame(store.rounds(), columns=['round', 'saved_at', 'estimator', 'records']).to_string(index=False))
+        return 0
+
+    # Lab Codes are numbers in most rounds
+    lab_code = int(args.lab_code) if args.lab_code.lstrip('-').isdigit() else args.lab_code
+    if args.test:
+        result = store.test_trend(lab_code, args.test, args.model)
+    else:
+        result = store.lab_history(lab_code, args.model)
+    if len(result) == 0:
+        print(f"No saved results for Lab {args.lab_code}", file=sys.stderr)
+        return 1
+    print(result.to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
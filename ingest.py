@@ -0,0 +1,326 @@
+"""Chunked streaming ingestion for rounds that are too large to load at once.
+
+The first pass reads the CSV in chunks and accumulates per-model, per-test
+count/mean/M2 with Chan et al.'s parallel form of Welford's algorithm, treating
+zeros as missing on the fly; it yields the same stats_dict as the in-memory
+path. A second pass scores each chunk against those statistics and appends it
+to the output, so peak memory is bounded by the chunk size:
+
+    python ingest.py round.csv --output scored_round.csv --chunksize 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import uuid
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+import analysis
+import storage
+
+DEFAULT_CHUNKSIZE = 100_000
+
+
+def _csv_chunks(source, chunksize):
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    return pd.read_csv(source, chunksize=chunksize)
+
+
+def read_chunks(source, chunksize=DEFAULT_CHUNKSIZE, test_cols=()):
+    """Read a round CSV (path, file object or bytes) in chunks, treating zero values as missing.
+
+    ``test_cols`` (see ChunkSchema) are parsed as numbers; stray text in them becomes missing.
+    """
+    for chunk in _csv_chunks(source, chunksize):
+        for col in test_cols:
+            chunk[col] = pd.to_numeric(chunk[col], errors='coerce').astype('float64')
+        yield chunk.replace(0, np.nan)
+
+
+class ChunkSchema:
+    """Test columns and schema warnings of a round CSV, gathered over all of its chunks.
+
+    Each column is judged on the whole file as analysis.apply_round_schema
+    would judge it, so a test whose first chunks are empty or text is still a
+    test and stray text in any chunk is reported.
+    """
+
+    def __init__(self):
+        self.columns = None
+        self.kinds = {}
+        self.invalid = {}
+        self.has_values = set()
+
+    def update(self, chunk):
+        """Record one chunk as read from the CSV"""
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+            self.invalid = {col: 0 for col in self.columns if col not in analysis.NON_TEST_COLUMNS}
+        for col in self.invalid:
+            values, kind, invalid = analysis.test_column(chunk[col])
+            if kind:
+                self.kinds.setdefault(col, kind)
+                continue
+            self.invalid[col] += invalid
+            if values.notna().any():
+                self.has_values.add(col)
+
+    def is_test(self, col):
+        return col not in self.kinds and (col in self.has_values or not self.invalid[col])
+
+    @property
+    def candidate_cols(self):
+        """Every column that may turn out to be a test"""
+        return list(self.invalid)
+
+    @property
+    def test_cols(self):
+        return [col for col in self.invalid if self.is_test(col)]
+
+    def warnings(self):
+        """Schema warnings for the whole file, worded as in analysis.apply_round_schema"""
+        warnings = []
+        for col, invalid in self.invalid.items():
+            warning = analysis.column_warning(col, self.kinds.get(col), invalid, self.is_test(col))
+            if warning:
+                warnings.append(warning)
+        return warnings
+
+
+class RunningStats:
+    """Per-model, per-test count, mean and sum of squared deviations (M2).
+
+    Partial results are combined with Chan et al.'s parallel update, which stays
+    numerically stable when merging chunks of very different sizes.
+    """
+
+    def __init__(self, test_cols=None):
+        self.test_cols = list(test_cols) if test_cols is not None else None
+        self.columns = None
+        self.count = None
+        self.mean = None
+        self.m2 = None
+        self.records = pd.Series(dtype='int64')
+
+    def test_values(self, chunk):
+        """The test columns of a chunk as numbers; stray text values become missing"""
+        return chunk[self.test_cols].apply(pd.to_numeric, errors='coerce')
+
+    def select_tests(self, test_cols):
+        """Keep only these test columns, e.g. once the whole file has been read"""
+        self.test_cols = list(test_cols)
+        if self.count is not None:
+            self.count = self.count[self.test_cols]
+            self.mean = self.mean[self.test_cols]
+            self.m2 = self.m2[self.test_cols]
+        return self
+
+    def update(self, chunk):
+        """Fold one chunk of raw rows into the running statistics"""
+        if self.test_cols is None:
+            self.test_cols = analysis.get_numeric_cols(chunk)
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+
+        groups = self.test_values(chunk).groupby(chunk['Model code'], sort=False)
+        count = groups.count()
+        self.merge_parts(count, groups.mean(), groups.var(ddof=0) * count, groups.size())
+        return self
+
+    def merge(self, other):
+        """Fold another RunningStats (e.g. from a parallel worker) into this one"""
+        if other.count is not None:
+            self.merge_parts(other.count, other.mean, other.m2, other.records)
+        return self
+
+    def merge_parts(self, count, mean, m2, records):
+        if self.count is None:
+            self.count = count.astype(float)
+            self.mean = mean.where(count > 0)
+            self.m2 = m2.fillna(0.0)
+            self.records = records.astype('int64')
+            return
+
+        # Keep models in order of first appearance
+        index = self.count.index.append(count.index.difference(self.count.index))
+        n_a = self.count.reindex(index, fill_value=0.0)
+        n_b = count.reindex(index, fill_value=0).astype(float)
+        mean_a = self.mean.reindex(index).fillna(0.0)
+        mean_b = mean.reindex(index).fillna(0.0)
+        m2_a = self.m2.reindex(index).fillna(0.0)
+        m2_b = m2.reindex(index).fillna(0.0)
+
+        n = n_a + n_b
+        safe_n = n.where(n > 0, 1.0)
+        delta = mean_b - mean_a
+
+        self.count = n
+        self.mean = (mean_a + delta * n_b / safe_n).where(n > 0)
+        self.m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / safe_n
+        self.records = self.records.reindex(index, fill_value=0) + records.reindex(index, fill_value=0)
+
+    def to_frame(self):
+        """Long table of Model code, Test, count, mean and m2, e.g. for saving to disk"""
+        frame = pd.concat({
+            'count': self.count.stack(future_stack=True),
+            'mean': self.mean.stack(future_stack=True),
+            'm2': self.m2.stack(future_stack=True),
+        }, axis=1)
+        frame.index.names = ['Model code', 'Test']
+        return frame.reset_index()
+
+    @classmethod
+    def from_frame(cls, frame, records, columns=None):
+        """Rebuild running statistics saved with to_frame; ``records`` maps model code to row count"""
+        running_stats = cls(frame['Test'].drop_duplicates())
+        running_stats.columns = columns
+        wide = frame.pivot(index='Model code', columns='Test')
+        models = pd.Index(records.keys())
+        running_stats.merge_parts(
+            wide['count'].reindex(index=models, columns=running_stats.test_cols),
+            wide['mean'].reindex(index=models, columns=running_stats.test_cols),
+            wide['m2'].reindex(index=models, columns=running_stats.test_cols),
+            pd.Series(records, dtype='int64'),
+        )
+        return running_stats
+
+    @property
+    def std(self):
+        """Sample standard deviation (ddof=1), matching pandas' std()"""
+        variance = self.m2 / (self.count - 1)
+        return np.sqrt(variance.where(self.count > 1))
+
+    def model_counts(self):
+        """Number of records per model code, in order of first appearance"""
+        return {model_code: int(count) for model_code, count in self.records.items()}
+
+    def stats_dict(self, model_code):
+        """Statistics of one model in the same shape as analysis.compute_stats"""
+        count = self.count.loc[model_code]
+        mean = self.mean.loc[model_code]
+        std = self.std.loc[model_code]
+        return {
+            col: {'mean': mean[col], 'std': std[col], 'count': int(count[col])}
+            for col in self.test_cols
+        }
+
+
+def stream_statistics(source, chunksize=DEFAULT_CHUNKSIZE):
+    """First pass: accumulate per-model statistics without loading the whole file.
+
+    Returns ``(running_stats, warnings)``; the tests and the schema warnings are
+    those of the whole file (see ChunkSchema).
+    """
+    schema = ChunkSchema()
+    running_stats = RunningStats()
+    for chunk in _csv_chunks(source, chunksize):
+        schema.update(chunk)
+        if running_stats.test_cols is None:
+            # Any column may hold a test's first numbers in a later chunk
+            running_stats.test_cols = schema.candidate_cols
+        running_stats.update(chunk.replace(0, np.nan))
+    running_stats.select_tests(schema.test_cols)
+    return running_stats, schema.warnings()
+
+
+def score_chunk(chunk, running_stats):
+    """Z-scores and grades for a chunk of rows from any models, read with the round's test columns"""
+    return analysis.score_round(chunk, running_stats.test_cols, running_stats)
+
+
+def stream_scores(source, running_stats, output_path, chunksize=DEFAULT_CHUNKSIZE):
+    """Second pass: score the round chunk by chunk and append the results to a CSV"""
+    folder = os.path.dirname(output_path) or '.'
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.tmp-', suffix=os.path.basename(output_path))
+    rows = 0
+    try:
+        with os.fdopen(fd, 'w', newline='', encoding='utf-8') as output:
+            for i, chunk in enumerate(read_chunks(source, chunksize, running_stats.test_cols)):
+                score_chunk(chunk, running_stats).to_csv(output, index=False, header=(i == 0))
+                rows += len(chunk)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return rows
+
+
+def load_model_rows(source, model_code, running_stats, chunksize=DEFAULT_CHUNKSIZE):
+    """Collect the rows of a single model, keeping only that model in memory"""
+    parts = []
+    for chunk in read_chunks(source, chunksize, running_stats.test_cols):
+        part = chunk[chunk['Model code'] == model_code]
+        if len(part):
+            parts.append(part)
+    if not parts:
+        return pd.DataFrame(columns=running_stats.columns)
+    return pd.concat(parts)
+
+
+def stream_split_files(source, output_folder=storage.SPLIT_FOLDER, chunksize=DEFAULT_CHUNKSIZE, test_cols=()):
+    """Write the per-model CSV split files in one pass, appending chunk by chunk.
+
+    ``test_cols`` are written as numbers, as in the in-memory split. Each model is written to a private temporary file that is atomically renamed
+    into place once the pass completes. Returns ``{model_code: path}``.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    token = uuid.uuid4().hex
+    tmp_paths = {}
+    try:
+        for chunk in read_chunks(source, chunksize, test_cols):
+            for model_code, rows in chunk.groupby('Model code', sort=False).indices.items():
+                tmp_path = tmp_paths.get(model_code)
+                if tmp_path is None:
+                    final_path = os.path.join(output_folder, storage.split_filename(model_code))
+                    tmp_path = tmp_paths[model_code] = f"{final_path}.{token}.tmp"
+                    chunk.iloc[rows].to_csv(tmp_path, index=False)
+                else:
+                    chunk.iloc[rows].to_csv(tmp_path, index=False, header=False, mode='a')
+
+        paths = {}
+        for model_code, tmp_path in tmp_paths.items():
+            final_path = tmp_path[:-len(f".{token}.tmp")]
+            os.replace(tmp_path, final_path)
+            paths[model_code] = final_path
+        return paths
+    except BaseException:
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score a round in bounded memory by streaming it in chunks.")
+    parser.add_argument("input", help="round CSV file")
+    parser.add_argument("--output", default="scored_round.csv", help="scored CSV to write (default: %(default)s)")
+    parser.add_argument("--stats-output", default=None, help="optional CSV of per-model test statistics")
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE,
+                        help="rows per chunk (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    running_stats, schema_warnings = stream_statistics(args.input, args.chunksize)
+    for warning in schema_warnings:
+        print(f"Warning: {warning}", file=sys.stderr)
+    if args.stats_output:
+        stats_frames = []
+        for model_code in running_stats.model_counts():
+            stats_df = analysis.stats_table(running_stats.stats_dict(model_code), running_stats.test_cols)
+            stats_df.insert(0, 'Model code', model_code)
+            stats_frames.append(stats_df)
+        stats_csv = pd.concat(stats_frames).to_csv(index=False) if stats_frames else ''
+        storage.atomic_write_bytes(args.stats_output, stats_csv.encode('utf-8'))
+
+    rows = stream_scores(args.input, running_stats, args.output, args.chunksize)
+    print(f"Scored {rows} records across {len(running_stats.model_counts())} models into {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""Wall time, CPU time and peak memory of the named stages of an app run.
+
+app.py wraps every stage of its flow in ``recorder.stage(name)``. A disabled
+recorder hands out one shared no-op context manager, so the instrumented code
+costs a method call per stage. An enabled recorder measures each stage with
+perf_counter, process_time and tracemalloc and appends it to the current run.
+
+Runs can be written as JSON lines (one line per stage, appended) or as a
+Prometheus text exposition file for the node exporter's textfile collector.
+Setting SMARTLAB_STAGE_METRICS to a ``.jsonl`` or ``.prom`` path enables
+recording and writes every run there.
+
+CPU time is that of the whole process, including background threads, and
+peak memory counts the Python, NumPy and pandas allocations traced by
+tracemalloc (Arrow buffers are not traced), both across all sessions.
+"""
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+import uuid
+
+import storage
+
+# Enables recording and names the file every run is written to
+METRICS_FILE_ENV = "SMARTLAB_STAGE_METRICS"
+
+# Metric export formats: format -> (label, default file name)
+METRICS_FORMATS = {
+    'jsonl': ('JSON lines', 'stage_metrics.jsonl'),
+    'prometheus': ('Prometheus text exposition', 'stage_metrics.prom'),
+}
+
+# Runs kept per session for the debug panel and exports
+MAX_RUNS = 20
+
+# Prometheus metrics: record field -> (metric name, help text)
+PROMETHEUS_METRICS = {
+    'wall_seconds': ('smartlab_stage_wall_seconds', 'Wall time of the stage in its most recent run.'),
+    'cpu_seconds': ('smartlab_stage_cpu_seconds', 'Process CPU time of the stage in its most recent run.'),
+    'peak_memory_bytes': ('smartlab_stage_peak_memory_bytes',
+                          'Peak traced memory above the start of the stage in its most recent run.'),
+}
+
+_DISABLED_STAGE = contextlib.nullcontext()
+
+
+class _Stage:
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.peak = 0
+
+    def __enter__(self):
+        stack = self.recorder._stack
+        if stack:
+            # The parent keeps the peak reached so far before the counter is reset for this stage
+            stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+        stack.append(self)
+        tracemalloc.reset_peak()
+        self.start_memory = tracemalloc.get_traced_memory()[0]
+        self.start_cpu = time.process_time()
+        self.start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.process_time() - self.start_cpu
+        peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        self.recorder._stack.pop()
+        self.recorder.run['stages'].append({
+            'stage': self.name,
+            'depth': len(self.recorder._stack),
+            'wall_seconds': round(wall, 6),
+            'cpu_seconds': round(cpu, 6),
+            'peak_memory_bytes': max(peak - self.start_memory, 0),
+            'failed': exc_type is not None,
+        })
+        return False
+
+
+class StageRecorder:
+    """Records the stages of one run of the app.
+
+    ``runs`` is a list kept across runs (e.g. in the session state); the new run
+    is appended to it right away, so stages of an interrupted run still show,
+    and it is trimmed to MAX_RUNS.
+    """
+
+    def __init__(self, enabled=False, runs=None):
+        self.enabled = enabled
+        self.run = {
+            'run': uuid.uuid4().hex[:12],
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'stages': [],
+        }
+        self._stack = []
+        if enabled:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if runs is not None:
+                runs.append(self.run)
+                del runs[:-MAX_RUNS]
+
+    def stage(self, name):
+        """Context manager measuring one stage; a shared no-op when recording is disabled"""
+        if not self.enabled:
+            return _DISABLED_STAGE
+        return _Stage(self, name)
+
+    def finish(self):
+        """Write the run to the SMARTLAB_STAGE_METRICS file, if set"""
+        path = os.environ.get(METRICS_FILE_ENV)
+        if self.enabled and path:
+            write_metrics([self.run], path, 'prometheus' if path.endswith('.prom') else 'jsonl')
+
+
+def recording_requested(enabled=False):
+    """Whether to record: enabled in the UI or by the SMARTLAB_STAGE_METRICS variable"""
+    return bool(enabled or os.environ.get(METRICS_FILE_ENV))
+
+
+def stop_memory_tracing():
+    """Stop tracemalloc once recording is switched off, as tracing slows every allocation"""
+    if tracemalloc.is_tracing() and not os.environ.get(METRICS_FILE_ENV):
+        tracemalloc.stop()
+
+
+def stage_records(runs):
+    """Flat stage records of several runs, each with its run id and start time"""
+    return [
+        {'run': run['run'], 'started_at': run['started_at'], **record}
+        for run in runs for record in run['stages']
+    ]
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(runs):
+    """Prometheus text exposition of the most recent measurement of every stage"""
+    latest, counts = {}, {}
+    for record in stage_records(runs):
+        latest[record['stage']] = record
+        counts[record['stage']] = counts.get(record['stage'], 0) + 1
+
+    lines = []
+    for field, (metric, help_text) in PROMETHEUS_METRICS.items():
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        for stage, record in latest.items():
+            lines.append(f'{metric}{{stage="{_label_value(stage)}"}} {record[field]}')
+    lines.append("# HELP smartlab_stage_runs Number of recorded runs of the stage.")
+    lines.append("# TYPE smartlab_stage_runs gauge")
+    for stage, count in counts.items():
+        lines.append(f'smartlab_stage_runs{{stage="{_label_value(stage)}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(runs, path, fmt='jsonl'):
+    """Append the stage records to a JSON lines file, or replace a Prometheus text file"""
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    if fmt == 'prometheus':
+        # The textfile collector must never read a half-written file
+        storage.atomic_write_bytes(path, prometheus_text(runs).encode('utf-8'))
+    elif fmt == 'jsonl':
+        with open(path, 'a') as metrics_file:
+            for record in stage_records(runs):
+                metrics_file.write(json.dumps(record) + "\n")
+    else:
+        raise ValueError(f"Unsupported metrics format: {fmt}")
+    return path
@@ -0,0 +1,443 @@
+"""PDF report generation for single labs and for all labs of a model."""
+import functools
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from io import BytesIO
+
+import pandas as pd
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+
+import analysis
+
+
+def create_pdf_report(lab_code, model_code, labs, stats_dict, numeric_cols, estimator='classical', history=None):
+    """Generate a PDF report for a specific lab with enhanced Lab Code and Model Code format"""
+    # Look up the selected lab in the model's LabIndex
+    if lab_code not in labs:
+        return None
+
+    return render_lab_pdf(lab_code, model_code, labs.record(lab_code), stats_dict, numeric_cols, estimator, history)
+
+
+# Most recent saved rounds listed in the trend table
+MAX_TREND_ROUNDS = 12
+
+# Reports submitted per worker process at once when rendering many labs
+REPORT_JOBS_PER_WORKER = 4
+
+
+# Header row styling shared by the summary and statistics tables
+HEADER_TABLE_COMMANDS = [
+    ('BACKGROUND', (0, 0), (-1, 0), colors.navy),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ('ALIGN', (1, 1), (2, -1), 'CENTER'),  # Center-align the values and z-scores
+]
+
+
+class ReportTemplate:
+    """Styles, grade colours and static layout pieces shared by every lab report.
+
+    Built once per process through get_report_template().
+    """
+
+    def __init__(self):
+        styles = getSampleStyleSheet()
+
+        # Create custom styles
+        self.title_style = ParagraphStyle(
+            'Title',
+            parent=styles['Heading1'],
+            fontSize=20,
+            textColor=colors.navy,
+            spaceAfter=12,
+            alignment=1  # Center alignment
+        )
+
+        self.subtitle_style = ParagraphStyle(
+            'Subtitle',
+            parent=styles['Heading2'],
+            fontSize=14,
+            textColor=colors.darkblue,
+            spaceAfter=6
+        )
+
+        self.lab_model_style = ParagraphStyle(
+            'LabModel',
+            parent=styles['Heading2'],
+            fontSize=16,
+            textColor=colors.darkblue,
+            spaceAfter=8,
+            borderWidth=1,
+            borderColor=colors.navy,
+            borderPadding=5,
+            borderRadius=5,
+            alignment=1  # Center alignment
+        )
+
+        self.normal_style = ParagraphStyle(
+            'Normal',
+            parent=styles['Normal'],
+            fontSize=10,
+            spaceAfter=6
+        )
+
+        self.header_style = ParagraphStyle(
+            'Header',
+            parent=styles['Heading3'],
+            fontSize=12,
+            textColor=colors.darkblue,
+            spaceAfter=6
+        )
+
+        self.attention_style = ParagraphStyle(
+            'Attention',
+            parent=styles['Normal'],
+            fontSize=10,
+            textColor=colors.red,
+            spaceAfter=6
+        )
+
+        self.grade_colors = {grade: colors.HexColor(color) for grade, color in analysis.GRADE_COLORS.items()}
+        self.no_data_color = self.grade_colors[analysis.NO_DATA_GRADE]
+
+        self.stat_table_style = TableStyle(HEADER_TABLE_COMMANDS)
+        self.grade_table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.lightsteelblue),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.black),
+            ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('ALIGN', (1, 1), (2, -1), 'CENTER'),
+        ])
+
+    def summary_table_style(self, grades):
+        """Header style plus one grade colour per summary row"""
+        commands = list(HEADER_TABLE_COMMANDS)
+        for i, grade in enumerate(grades, 1):
+            commands.append(('BACKGROUND', (3, i), (3, i), self.grade_colors.get(grade, self.no_data_color)))
+            commands.append(('TEXTCOLOR', (3, i), (3, i), colors.white))
+        return TableStyle(commands)
+
+    def stat_table(self, stat_rows):
+        """The model statistics table from the rows of model_stat_rows()"""
+        return Table(stat_rows, colWidths=[1.5*inch, 1.5*inch, 1.5*inch, 1.5*inch], style=self.stat_table_style)
+
+    def trend_table(self, history, numeric_cols):
+        """Z-scores per saved round (rows) and test (columns), each cell coloured by its grade"""
+        tests = [col for col in numeric_cols if f'{col}_zscore' in history.columns]
+        trend_data = [['Round'] + tests]
+        commands = HEADER_TABLE_COMMANDS[:-1] + [
+            ('FONTSIZE', (0, 0), (-1, -1), 8),
+            ('ALIGN', (1, 1), (-1, -1), 'CENTER'),
+        ]
+        for i, (_, row) in enumerate(history.iterrows(), 1):
+            trend_data.append([str(row['Round'])] + [
+                f"{row[f'{col}_zscore']:.2f}" if pd.notna(row[f'{col}_zscore']) else "N/A" for col in tests
+            ])
+            for j, col in enumerate(tests, 1):
+                commands.append(('BACKGROUND', (j, i), (j, i), self.grade_colors.get(row[f'{col}_grade'], self.no_data_color)))
+                commands.append(('TEXTCOLOR', (j, i), (j, i), colors.white))
+        test_width = 5*inch / max(len(tests), 1)
+        return Table(trend_data, colWidths=[1.2*inch] + [test_width] * len(tests), style=TableStyle(commands))
+
+    @staticmethod
+    def draw_footer(canvas, doc):
+        """Footer with page number, lab/model code and report timestamp"""
+        canvas.saveState()
+        canvas.setFont('Helvetica', 9)
+        page_num = canvas.getPageNumber()
+        text = f"Page {page_num}"
+        canvas.drawRightString(A4[0] - 30, 30, text)
+
+        # Add lab/model code to footer
+        canvas.drawString(30, 30, f"Lab: {doc.lab_code} | Model: {doc.model_code}")
+
+        # Add report timestamp
+        canvas.drawCentredString(A4[0]/2, 30, f"Generated: {doc.generated_at}")
+
+        canvas.restoreState()
+
+
+def model_stat_rows(stats_dict, numeric_cols, estimator='classical'):
+    """Rows of the "MODEL STATISTICAL REFERENCE" table, the same for every lab of a model.
+
+    Work them out once per model and pass them to every render_lab_pdf call.
+    """
+    _, location, scale = analysis.ESTIMATORS[estimator]
+    if estimator == 'classical':
+        location, scale = 'Population Mean', 'Population Std Dev'
+    stat_rows = [['Test', location, scale, 'Sample Count']]
+    for col in numeric_cols:
+        stat_rows.append([
+            col,
+            f"{stats_dict[col]['mean']:.2f}",
+            f"{stats_dict[col]['std']:.2f}",
+            f"{stats_dict[col]['count']}"
+        ])
+    return stat_rows
+
+
+@functools.lru_cache(maxsize=None)
+def get_report_template():
+    """The process-wide report template"""
+    return ReportTemplate()
+
+
+def render_lab_pdf(lab_code, model_code, record, stats_dict, numeric_cols, estimator='classical', history=None,
+                   stat_rows=None):
+    """Render the PDF report from a lab's own record (see LabIndex.record) and the model statistics.
+
+    ``history`` is the lab's results in saved rounds (see history.HistoryStore.lab_history);
+    when it has rows, the report gains a trend section. ``stat_rows`` are the
+    model's model_stat_rows(), worked out here when not given.
+    """
+    template = get_report_template()
+    title_style = template.title_style
+    subtitle_style = template.subtitle_style
+    lab_model_style = template.lab_model_style
+    normal_style = template.normal_style
+    header_style = template.header_style
+
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, title=f"SmartLab Report - Lab {lab_code} Model {model_code}")
+    doc.lab_code = lab_code
+    doc.model_code = model_code
+    doc.generated_at = pd.Timestamp.now().strftime("%Y-%m-%d %H:%M")
+
+    # Build the elements for the PDF
+    elements = []
+
+    # Add title and metadata with enhanced formatting
+    elements.append(Paragraph(f"SmartLab Blood Cell Quality Analysis", title_style))
+    elements.append(Spacer(1, 0.2*inch))
+
+    # Add Lab Code and Model Code in a more prominent way
+    elements.append(Paragraph(f"LAB CODE: {lab_code} • MODEL CODE: {model_code}", lab_model_style))
+    elements.append(Spacer(1, 0.2*inch))
+
+    elements.append(Paragraph(f"Report Generated: {pd.Timestamp.now().strftime('%B %d, %Y')}", normal_style))
+    elements.append(Spacer(1, 0.3*inch))
+
+    # Add summary section with Lab/Model information
+    elements.append(Paragraph("TEST RESULTS SUMMARY", header_style))
+    elements.append(Paragraph(f"The following results are for Laboratory {lab_code} using Model {model_code} equipment:", normal_style))
+    elements.append(Spacer(1, 0.1*inch))
+
+    # Create a data table for the test results with improved formatting
+    summary_data = [['Test', 'Value', 'Z-Score', 'Grade']]
+
+    # Track problematic tests for the executive summary
+    problematic_tests = []
+
+    for col, test_value, z_score, grade in zip(numeric_cols, record['Value'], record['Z-Score'], record['Grade']):
+        # Format values properly
+        formatted_value = f"{test_value:.2f}" if pd.notna(test_value) else "No data"
+        formatted_z_score = f"{z_score:.2f}" if pd.notna(z_score) else "N/A"
+
+        summary_data.append([col, formatted_value, formatted_z_score, grade])
+
+        # Track problematic tests for executive summary
+        if grade in ["Unsatisfactory", "Serious problem"]:
+            problematic_tests.append((col, grade, formatted_value, formatted_z_score))
+
+    # Create the table, colouring the grade cells from the template
+    summary_table = Table(summary_data, colWidths=[1.5*inch, 1*inch, 1*inch, 1.5*inch])
+    summary_table.setStyle(template.summary_table_style([row[3] for row in summary_data[1:]]))
+    elements.append(summary_table)
+    elements.append(Spacer(1, 0.3*inch))
+
+    # Add executive summary if there are problematic tests
+    if problematic_tests:
+        elements.append(Paragraph("EXECUTIVE SUMMARY", header_style))
+
+        elements.append(Paragraph(
+            f"<b>ATTENTION REQUIRED:</b> Lab {lab_code} has {len(problematic_tests)} test(s) that require immediate attention:",
+            template.attention_style
+        ))
+
+        for test, grade, value, zscore in problematic_tests:
+            elements.append(Paragraph(
+                f"• <b>{test}</b>: {grade} (Value: {value}, Z-Score: {zscore})",
+                normal_style
+            ))
+
+        elements.append(Spacer(1, 0.15*inch))
+
+    # Add statistical context section
+    elements.append(Paragraph("MODEL STATISTICAL REFERENCE", header_style))
+    estimator_note = "" if estimator == 'classical' else f" (estimated with {analysis.ESTIMATORS[estimator][0]})"
+    elements.append(Paragraph(f"Statistical distribution for all laboratories using Model {model_code}{estimator_note}:", normal_style))
+    elements.append(Spacer(1, 0.1*inch))
+
+    if stat_rows is None:
+        stat_rows = model_stat_rows(stats_dict, numeric_cols, estimator)
+    elements.append(template.stat_table(stat_rows))
+    elements.append(Spacer(1, 0.3*inch))
+
+    # Add the lab's z-scores from previously saved rounds
+    if history is not None and len(history) > 0:
+        history = history.tail(MAX_TREND_ROUNDS)
+        elements.append(Paragraph("PERFORMANCE TREND", header_style))
+        elements.append(Paragraph(
+            f"Z-scores of Lab {lab_code} with Model {model_code} in the last {len(history)} saved round(s), coloured by grade:",
+            normal_style
+        ))
+        elements.append(Spacer(1, 0.1*inch))
+        elements.append(template.trend_table(history, numeric_cols))
+        elements.append(Spacer(1, 0.3*inch))
+
+    # Add detailed calculations section with enhanced lab/model presentation
+    elements.append(Paragraph(f"DETAILED CALCULATIONS FOR LAB {lab_code}", header_style))
+    elements.append(Paragraph(f"Model {model_code} Performance Analysis", subtitle_style))
+    elements.append(Spacer(1, 0.1*inch))
+
+    for col, test_value, grade, calculation, grade_explanation in zip(
+            numeric_cols, record['Value'], record['Grade'], record['Calculation'], record['Grade Explanation']):
+        if pd.notna(test_value):
+            elements.append(Paragraph(f"<b>Test: {col}</b>", subtitle_style))
+            elements.append(Paragraph(f"Raw Value: {test_value:.2f}", normal_style))
+
+            elements.append(Paragraph(f"<b>Z-Score Calculation:</b> {calculation}", normal_style))
+            elements.append(Paragraph(f"<b>Grade Determination:</b> {grade_explanation}", normal_style))
+            elements.append(Paragraph(f"<b>Final Grade:</b> {grade}", normal_style))
+            elements.append(Spacer(1, 0.15*inch))
+
+    # Add interpretations and recommendations section
+    elements.append(Paragraph("RECOMMENDATIONS", header_style))
+
+    # Count grades to provide an overall summary
+    grade_counts = {grade: 0 for grade in analysis.GRADE_LABELS}
+
+    for grade in record['Grade']:
+        if pd.notna(grade):
+            grade_counts[grade] += 1
+
+    total_grades = sum(grade_counts.values()) - grade_counts["No data"]
+
+    # Generate interpretation text with enhanced formatting
+    interpretation_text = f"<b>Lab {lab_code}</b> performance with <b>Model {model_code}</b> equipment shows the following distribution:"
+    elements.append(Paragraph(interpretation_text, normal_style))
+
+    # Create a mini table for grade distribution
+    grade_dist = [['Grade', 'Count', 'Percentage']]
+    for grade, count in grade_counts.items():
+        if grade != "No data":
+            if total_grades > 0:
+                percentage = (count / total_grades) * 100
+                grade_dist.append([grade, str(count), f"{percentage:.1f}%"])
+
+    if grade_counts["No data"] > 0:
+        grade_dist.append(["No data", str(grade_counts["No data"]), "N/A"])
+
+    grade_table = Table(grade_dist, colWidths=[1.5*inch, 1*inch, 1.5*inch], style=template.grade_table_style)
+
+    elements.append(grade_table)
+    elements.append(Spacer(1, 0.15*inch))
+
+    # Add recommendations based on overall performance
+    elements.append(Paragraph("<b>Action Items for Lab Management:</b>", normal_style))
+
+    if grade_counts["Unsatisfactory"] + grade_counts["Serious problem"] > 0:
+        elements.append(Paragraph(
+            "• <b>URGENT:</b> Review tests with 'Unsatisfactory' or 'Serious problem' grades.",
+            normal_style
+        ))
+        elements.append(Paragraph(
+            "• Verify equipment calibration for Model " + str(model_code) + " at Lab " + str(lab_code) + ".",
+            normal_style
+        ))
+        elements.append(Paragraph(
+            "• Check technician training and procedural adherence.",
+            normal_style
+        ))
+
+    if grade_counts["Satisfactory"] > 0:
+        elements.append(Paragraph(
+            "• <b>RECOMMENDED:</b> Schedule routine review for tests with 'Satisfactory' grades.",
+            normal_style
+        ))
+        elements.append(Paragraph(
+            "• Consider additional staff training on Model " + str(model_code) + " equipment.",
+            normal_style
+        ))
+
+    if grade_counts["Excellent"] + grade_counts["Good"] > 0:
+        elements.append(Paragraph(
+            "• <b>POSITIVE FINDING:</b> " + str(grade_counts["Excellent"] + grade_counts["Good"]) +
+            " test(s) show excellent or good performance.",
+            normal_style
+        ))
+
+    if grade_counts["Excellent"] + grade_counts["Good"] == total_grades and total_grades > 0:
+        elements.append(Paragraph(
+            "• <b>CONGRATULATIONS:</b> All tests are performing well. Continue current quality control processes.",
+            normal_style
+        ))
+
+    # Add certification section
+    elements.append(Spacer(1, 0.3*inch))
+    elements.append(Paragraph("CERTIFICATION", header_style))
+
+    cert_text = f"""This report was automatically generated by the SmartLab Blood Cell Quality Analysis System
+    for Lab Code {lab_code} using Model {model_code} equipment. The analysis is based on statistical comparison
+    with other laboratories using the same model code. Results should be reviewed by qualified laboratory personnel."""
+
+    elements.append(Paragraph(cert_text, normal_style))
+
+    # Build the PDF
+    doc.build(elements, onFirstPage=template.draw_footer, onLaterPages=template.draw_footer)
+    buffer.seek(0)
+    return buffer
+
+
+def render_lab_pdf_bytes(lab_code, model_code, record, stats_dict, numeric_cols, estimator='classical', history=None,
+                         stat_rows=None):
+    """``(lab_code, pdf_bytes)`` of render_lab_pdf, for worker processes that hand PDFs back"""
+    return lab_code, render_lab_pdf(lab_code, model_code, record, stats_dict, numeric_cols, estimator, history,
+                                    stat_rows).getvalue()
+
+
+def generate_lab_reports(model_code, labs, stats_dict, numeric_cols, max_workers=None, estimator='classical',
+                         lab_history=None):
+    """Render the PDF report of every lab of a model in worker processes.
+
+    Each worker only receives that lab's record, the shared model statistics
+    and, if ``lab_history`` is given, that lab's history from ``lab_history(lab_code)``.
+    Yields ``(lab_code, pdf_bytes)`` in completion order. Only a bounded window
+    of reports is in flight at once, so finished PDFs never pile up in memory.
+    """
+    window = REPORT_JOBS_PER_WORKER * (max_workers or os.cpu_count() or 1)
+    stat_rows = model_stat_rows(stats_dict, numeric_cols, estimator)
+
+    # Spawned workers avoid forking the multi-threaded Streamlit server
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pending = set()
+        for lab_code in labs.lab_codes:
+            pending.add(pool.submit(
+                render_lab_pdf_bytes,
+                lab_code,
+                model_code,
+                labs.record(lab_code),
+                stats_dict,
+                numeric_cols,
+                estimator,
+                lab_history(lab_code) if lab_history is not None else None,
+                stat_rows,
+            ))
+            if len(pending) >= window:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
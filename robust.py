@@ -0,0 +1,128 @@
+"""Robust location and scale estimators for proficiency testing (ISO 13528).
+
+All estimators work on a ``(groups x results x tests)`` array with NaN for
+missing results, so every test of every model is estimated by the same array
+operations instead of a Python loop per column.
+
+A robust scale of 0 happens whenever more than half the labs report the same
+value, which is common for coarsely rounded analytes; every other lab would
+then get z = +/-inf. Such a scale is replaced by the classical standard
+deviation of the results, and the estimators report which cells fell back.
+A test with a single result has no scale, as with the classical estimator.
+"""
+import warnings
+
+import numpy as np
+
+# Scale factor making the MAD a consistent estimator of the standard deviation
+MAD_SCALE = 1.483
+
+# Algorithm A (ISO 13528:2015, C.3) winsorizes at 1.5 s* and rescales by 1.134
+ALGORITHM_A_CUTOFF = 1.5
+ALGORITHM_A_SCALE = 1.134
+ALGORITHM_A_MAX_ITER = 50
+ALGORITHM_A_TOL = 1e-6
+
+# Largest padded block estimated at once, in array cells
+MAX_BLOCK_CELLS = 16_000_000
+
+
+def _zero_scale_fallback(values, scale):
+    """Replace a scale of 0 by the classical SD of the results; returns ``(scale, fallback)``"""
+    fallback = scale == 0
+    if fallback.any():
+        scale = np.where(fallback, np.nanstd(values, axis=-2, ddof=1), scale)
+    return scale, fallback
+
+
+def median_mad(values):
+    """Median and scaled median absolute deviation over the results axis.
+
+    Returns ``(median, scale, fallback)``; ``fallback`` marks the cells whose
+    MAD was 0 and whose scale is the classical SD instead.
+    """
+    with warnings.catch_warnings():
+        # All-missing tests give NaN, like pandas does
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(values, axis=-2)
+        mad = MAD_SCALE * np.nanmedian(np.abs(values - median[..., None, :]), axis=-2)
+        # A single result has no spread at all, as with the classical SD
+        mad[np.sum(~np.isnan(values), axis=-2) < 2] = np.nan
+        mad, fallback = _zero_scale_fallback(values, mad)
+    return median, mad, fallback
+
+
+def algorithm_a(values, max_iter=ALGORITHM_A_MAX_ITER, tol=ALGORITHM_A_TOL):
+    """Robust mean x* and SD s* by ISO 13528 Algorithm A.
+
+    Starts from the median and scaled MAD, then repeatedly winsorizes the
+    results at x* +/- 1.5 s* and recomputes x* and s* until neither changes by
+    more than ``tol`` (relative) in any cell or ``max_iter`` is reached.
+    Returns ``(x*, s*, fallback)`` like median_mad. Where the MAD was 0 the
+    iteration would only shrink s* towards 0, so those cells keep the median
+    and the classical SD; a final s* of 0 also falls back to the classical SD.
+    """
+    x, s, start_fallback = median_mad(values)
+    start_x, start_s = x, s
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for _ in range(max_iter):
+            # Without a scale (a single result) nothing is winsorized
+            delta = np.where(np.isnan(s), np.inf, ALGORITHM_A_CUTOFF * s)
+            winsorized = np.clip(values, (x - delta)[..., None, :], (x + delta)[..., None, :])
+            new_x = np.where(start_fallback, start_x, np.nanmean(winsorized, axis=-2))
+            new_s = np.where(start_fallback, start_s, ALGORITHM_A_SCALE * np.nanstd(winsorized, axis=-2, ddof=1))
+            converged = (np.allclose(new_x, x, rtol=tol, atol=0, equal_nan=True)
+                         and np.allclose(new_s, s, rtol=tol, atol=0, equal_nan=True))
+            x, s = new_x, new_s
+            if converged:
+                break
+        s, fallback = _zero_scale_fallback(values, s)
+    return x, s, start_fallback | fallback
+
+
+ESTIMATOR_FUNCTIONS = {
+    'mad': median_mad,
+    'algorithm_a': algorithm_a,
+}
+
+
+def grouped_estimates(values, group_index, n_groups, estimator):
+    """Location and scale of every (group, test) for a 2-D array of results.
+
+    ``group_index`` gives the group of every row. Rows are scattered into
+    NaN-padded ``(groups x results x tests)`` blocks; groups are taken in size
+    order so each block stays below MAX_BLOCK_CELLS with little padding.
+    Returns three ``(n_groups x tests)`` arrays: location, scale and whether
+    the scale fell back to the classical SD.
+    """
+    estimate = ESTIMATOR_FUNCTIONS[estimator]
+    values = np.asarray(values, dtype=float)
+    n_tests = values.shape[1]
+    location = np.full((n_groups, n_tests), np.nan)
+    scale = np.full((n_groups, n_tests), np.nan)
+    fallback = np.zeros((n_groups, n_tests), dtype=bool)
+
+    order = np.argsort(group_index, kind='stable')
+    sizes = np.bincount(group_index, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    batch = []
+    for group in np.argsort(sizes, kind='stable'):
+        if sizes[group] == 0:
+            continue
+        if batch and (len(batch) + 1) * sizes[group] * n_tests > MAX_BLOCK_CELLS:
+            _estimate_batch(values, order, sizes, starts, batch, estimate, location, scale, fallback)
+            batch = []
+        batch.append(group)
+    if batch:
+        _estimate_batch(values, order, sizes, starts, batch, estimate, location, scale, fallback)
+    return location, scale, fallback
+
+
+def _estimate_batch(values, order, sizes, starts, groups, estimate, location, scale, fallback):
+    block = np.full((len(groups), sizes[groups].max(), values.shape[1]), np.nan)
+    for i, group in enumerate(groups):
+        rows = order[starts[group]:starts[group] + sizes[group]]
+        block[i, :len(rows)] = values[rows]
+    location[groups], scale[groups], fallback[groups] = estimate(block)
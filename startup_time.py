@@ -0,0 +1,111 @@
+"""Measure the cold-start cost of the Streamlit app.
+
+Every measurement runs in a fresh interpreter so nothing is already imported:
+the import time of each dependency, and the time until app.py has rendered its
+first page (before any upload). It also lists which heavy modules the first
+render pulled in, which should be neither matplotlib nor reportlab:
+
+    python startup_time.py --budget 3.0 --json startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules whose import time is reported
+MODULES = [
+    'streamlit', 'pandas', 'numpy', 'pyarrow', 'matplotlib.pyplot', 'plotly.graph_objects',
+    'reportlab.platypus', 'analysis', 'storage', 'ingest', 'charts', 'reports',
+]
+
+# Modules the first render must not load (plotly is not listed: streamlit imports it)
+DEFERRED_MODULES = ['matplotlib', 'reportlab', 'reports']
+
+IMPORT_SCRIPT = """
+import sys, time
+sys.path.insert(0, {app_dir!r})
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+"""
+
+FIRST_RENDER_SCRIPT = """
+import json, sys, time
+sys.path.insert(0, {app_dir!r})
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file({app_path!r}, default_timeout=120)
+loaded = time.perf_counter()
+app.run()
+rendered = time.perf_counter()
+print(json.dumps({{
+    'harness_import_seconds': loaded - started,
+    'first_render_seconds': rendered - loaded,
+    'exceptions': [str(exc.value) for exc in app.exception],
+    'deferred_modules_loaded': [name for name in {deferred!r} if name in sys.modules],
+}}))
+"""
+
+
+def run_python(code):
+    result = subprocess.run([sys.executable, '-c', code], cwd=APP_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed")
+    return result.stdout.strip().splitlines()[-1]
+
+
+def import_times(modules=MODULES):
+    """Seconds to import each module in a fresh interpreter (None if it is not installed)"""
+    times = {}
+    for module in modules:
+        try:
+            times[module] = round(float(run_python(IMPORT_SCRIPT.format(app_dir=APP_DIR, module=module))), 3)
+        except RuntimeError:
+            times[module] = None
+    return times
+
+
+def first_render():
+    """Time for app.py to render its initial page in a fresh interpreter"""
+    code = FIRST_RENDER_SCRIPT.format(
+        app_dir=APP_DIR, app_path=os.path.join(APP_DIR, 'app.py'), deferred=DEFERRED_MODULES)
+    result = json.loads(run_python(code))
+    for key in ('harness_import_seconds', 'first_render_seconds'):
+        result[key] = round(result[key], 3)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report import times and time to first render of the app.")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="fail if the first render takes longer than this many seconds")
+    parser.add_argument("--json", default=None, help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = {'imports': import_times(), **first_render()}
+
+    print("Import time (fresh interpreter):")
+    for module, seconds in results['imports'].items():
+        print(f"  {module:<20} {'not installed' if seconds is None else f'{seconds:.3f}s'}")
+    print(f"First render: {results['first_render_seconds']:.3f}s")
+    if results['deferred_modules_loaded']:
+        print(f"Loaded before first use: {', '.join(results['deferred_modules_loaded'])}")
+    if results['exceptions']:
+        print(f"Exceptions during first render: {results['exceptions']}")
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    failed = bool(results['exceptions'] or results['deferred_modules_loaded'])
+    if args.budget is not None and results['first_render_seconds'] > args.budget:
+        print(f"First render exceeds the {args.budget:.3f}s budget", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
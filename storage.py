@@ -0,0 +1,377 @@
+"""Persistence of the per-model split files and analysis exports.
+
+Files are serialized in memory, compared against the content hash of the
+copy already on disk and only rewritten when they changed. Writes go through a
+temporary file and an atomic rename, so concurrent sessions never see a
+half-written file. SplitFileWriter runs these writes on a background thread.
+Analysis exports are written chunk by chunk into a cache folder.
+"""
+import contextlib
+import gzip
+import hashlib
+import importlib.util
+import io
+import os
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+
+SPLIT_FOLDER = "split_by_model_code"
+
+EXPORT_FOLDER = "exports"
+
+# Cached exports beyond these limits are deleted, least recently used first
+EXPORT_CACHE_MAX_FILES = 200
+EXPORT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# ZIP exports stay in memory up to this size, then spill to a temporary file
+ZIP_SPOOL_MAX_MEMORY = 32 * 1024 * 1024
+
+# Supported split file formats: format -> (extension, mime type)
+SPLIT_FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'feather': ('.feather', 'application/vnd.apache.arrow.file'),
+}
+
+
+# Analysis export formats: format -> (label, extension, mime type)
+EXPORT_FORMATS = {
+    'csv': ('CSV', '.csv', 'text/csv'),
+    'csv.gz': ('CSV (gzip)', '.csv.gz', 'application/gzip'),
+    'parquet': ('Parquet', '.parquet', 'application/vnd.apache.parquet'),
+    'xlsx': ('Excel (XLSX)', '.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+
+def available_formats():
+    """Split formats usable in this environment (Parquet/Feather need pyarrow)"""
+    if importlib.util.find_spec('pyarrow') is None:
+        return ['csv']
+    return list(SPLIT_FORMATS)
+
+
+def split_filename(model_code, fmt='csv'):
+    return f"BloodData_Model_{model_code}{SPLIT_FORMATS[fmt][0]}"
+
+
+def serialize_frame(df, fmt='csv'):
+    """Serialize a split frame to bytes in the requested format"""
+    if fmt == 'csv':
+        return df.to_csv(index=False).encode('utf-8')
+    buffer = BytesIO()
+    if fmt == 'parquet':
+        df.to_parquet(buffer, index=False)
+    elif fmt == 'feather':
+        df.reset_index(drop=True).to_feather(buffer)
+    else:
+        raise ValueError(f"Unsupported split file format: {fmt}")
+    return buffer.getvalue()
+
+
+@contextlib.contextmanager
+def atomic_file(path):
+    """Binary temporary file that replaces path by an atomic rename when the block succeeds"""
+    folder = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.tmp-', suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            yield tmp_file
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write_bytes(path, data):
+    """Write data to path through a temporary file and an atomic rename"""
+    with atomic_file(path) as tmp_file:
+        tmp_file.write(data)
+
+
+def _file_digest(path):
+    with open(path, 'rb') as existing:
+        return hashlib.sha256(existing.read()).hexdigest()
+
+
+def write_split_file(df, model_code, output_folder=SPLIT_FOLDER, fmt='csv'):
+    """Persist one model's rows unless an identical copy is already on disk.
+
+    Returns ``(path, written)`` where ``written`` is False when the existing
+    file already has the same content and the write was skipped.
+    """
+    path, written, _ = _write_split_data(serialize_frame(df, fmt), model_code, output_folder, fmt)
+    return path, written
+
+
+def _write_split_data(data, model_code, output_folder, fmt):
+    os.makedirs(output_folder, exist_ok=True)
+    path = os.path.join(output_folder, split_filename(model_code, fmt))
+
+    digest = hashlib.sha256(data).hexdigest()
+    if os.path.exists(path) and os.path.getsize(path) == len(data) and _file_digest(path) == digest:
+        return path, False, digest
+
+    atomic_write_bytes(path, data)
+    return path, True, digest
+
+
+def spooled_zip(members, compression=zipfile.ZIP_DEFLATED, max_memory=ZIP_SPOOL_MAX_MEMORY):
+    """Stream ``(name, data)`` members into a ZIP backed by a spooled temporary file.
+
+    ``data`` is either bytes or the path of a file on disk. Members are written
+    as soon as the iterable produces them, so peak memory does not depend on
+    the number of members. Returns the spooled file positioned at the start.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory, suffix='.zip')
+    with zipfile.ZipFile(spool, 'w', compression) as zip_file:
+        for name, data in members:
+            if isinstance(data, (bytes, bytearray)):
+                zip_file.writestr(name, data)
+            else:
+                zip_file.write(data, name)
+    spool.seek(0)
+    return spool
+
+
+def read_spool(spool):
+    """Read a finished spooled file from the start, e.g. as deferred download data"""
+    spool.seek(0)
+    return spool.read()
+
+
+# Bytes read from a spooled file per chunk when streaming it
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+
+def iter_spool(spool, chunk_size=SPOOL_CHUNK_SIZE):
+    """Read a finished spooled file from the start in chunks, closing it afterwards"""
+    try:
+        spool.seek(0)
+        while True:
+            chunk = spool.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        spool.close()
+
+
+def export_formats():
+    """Export formats usable in this environment (Parquet needs pyarrow, XLSX needs openpyxl)"""
+    formats = ['csv', 'csv.gz']
+    if importlib.util.find_spec('pyarrow') is not None:
+        formats.append('parquet')
+    if importlib.util.find_spec('openpyxl') is not None:
+        formats.append('xlsx')
+    return formats
+
+
+def export_path(key, name, fmt, output_folder=EXPORT_FOLDER):
+    """Cache location of an export; ``key`` identifies the data and settings it is built from"""
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(output_folder, f"{digest}-{name}{EXPORT_FORMATS[fmt][1]}")
+
+
+def read_cached_export(path):
+    """Contents of a cached export, marking it as recently used; None if it is not cached"""
+    try:
+        data = read_file(path)
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return data
+
+
+def prune_exports(output_folder=EXPORT_FOLDER, max_files=EXPORT_CACHE_MAX_FILES, max_bytes=EXPORT_CACHE_MAX_BYTES):
+    """Delete the least recently used cached exports beyond max_files or max_bytes"""
+    try:
+        entries = [entry for entry in os.scandir(output_folder)
+                   if entry.is_file() and not entry.name.startswith('.tmp-')]
+    except FileNotFoundError:
+        return
+    files = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort(reverse=True)
+
+    kept_bytes = 0
+    for i, (_, size, path) in enumerate(files):
+        kept_bytes += size
+        if i >= max_files or kept_bytes > max_bytes:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another session pruned it first
+                pass
+
+
+def _write_csv_chunks(chunks, binary_file):
+    text_file = io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+    for i, chunk in enumerate(chunks):
+        chunk.to_csv(text_file, header=i == 0, index=False)
+    text_file.flush()
+    text_file.detach()
+
+
+def _write_gzip_csv_chunks(chunks, binary_file):
+    # mtime=0 keeps the output identical for identical content
+    with gzip.GzipFile(fileobj=binary_file, mode='wb', mtime=0) as gzip_file:
+        _write_csv_chunks(chunks, gzip_file)
+
+
+def _write_parquet_chunks(chunks, binary_file):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Every chunk becomes a row group with the schema of the first one
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, schema=writer.schema if writer else None, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(binary_file, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _write_xlsx_chunks(chunks, binary_file):
+    from openpyxl import Workbook
+
+    # A write-only workbook streams rows to a temporary file instead of keeping cells
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Analysis")
+    for i, chunk in enumerate(chunks):
+        if i == 0:
+            sheet.append(list(chunk.columns))
+        # Single-precision values are written in their shortest decimal form, as in the CSV
+        single = chunk.select_dtypes('float32').columns
+        if len(single):
+            chunk = chunk.astype({col: 'str' for col in single}).astype({col: 'float64' for col in single})
+        cells = chunk.astype(object).where(chunk.notna(), None)
+        for row in cells.itertuples(index=False, name=None):
+            sheet.append(row)
+    workbook.save(binary_file)
+
+
+_EXPORT_WRITERS = {
+    'csv': _write_csv_chunks,
+    'csv.gz': _write_gzip_csv_chunks,
+    'parquet': _write_parquet_chunks,
+    'xlsx': _write_xlsx_chunks,
+}
+
+
+def write_export(chunks, path, fmt='csv'):
+    """Write an iterable of DataFrame chunks to one export file.
+
+    Chunks are serialized one at a time, so the whole table never exists as one
+    frame or string. The first chunk provides the header (CSV/XLSX) or the
+    schema (Parquet).
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with atomic_file(path) as tmp_file:
+        _EXPORT_WRITERS[fmt](chunks, tmp_file)
+    return path
+
+
+def read_file(path):
+    """Contents of a finished file, e.g. as deferred download data"""
+    with open(path, 'rb') as finished:
+        return finished.read()
+
+
+class SplitFileWriter:
+    """Writes split files on background threads, once per (round, format).
+
+    All sessions share one folder, so another round with the same model codes
+    can replace a file after this round wrote it. Every write records the
+    content hash of the file, and ready_data only hands out a file whose
+    content is still the one this round wrote.
+    """
+
+    def __init__(self, output_folder=SPLIT_FOLDER, max_workers=2):
+        self.output_folder = output_folder
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='split-writer')
+        self._lock = threading.Lock()
+        self._rounds = {}
+
+    def submit_round(self, data_hash, df, model_rows, fmt='csv'):
+        """Queue writes for every model of a round; repeated calls are no-ops.
+
+        ``model_rows`` maps model code to positional row indices in ``df``, so
+        each model's frame is only materialized on the writer thread.
+        """
+        key = (data_hash, fmt)
+        with self._lock:
+            if key not in self._rounds:
+                self._rounds[key] = {
+                    model_code: self._executor.submit(
+                        lambda rows=rows, model_code=model_code: _write_split_data(
+                            serialize_frame(df.iloc[rows], fmt), model_code, self.output_folder, fmt)
+                    )
+                    for model_code, rows in model_rows.items()
+                }
+            return self._rounds[key]
+
+    def submit_stream(self, data_hash, model_codes, write_all):
+        """Queue a single pass that writes every CSV split file of a round.
+
+        ``write_all`` is a callable returning ``{model_code: path}``, such as
+        ingest.stream_split_files bound to the upload, for rounds that are not
+        held in memory. Each model gets its own future so ``status`` works the
+        same as for ``submit_round``.
+        """
+        key = (data_hash, 'csv')
+        with self._lock:
+            if key not in self._rounds:
+                futures = {model_code: Future() for model_code in model_codes}
+                self._rounds[key] = futures
+
+                def run():
+                    try:
+                        paths = write_all()
+                    except BaseException as exc:
+                        for future in futures.values():
+                            future.set_exception(exc)
+                        raise
+                    for model_code, future in futures.items():
+                        path = paths[model_code]
+                        future.set_result((path, True, _file_digest(path)))
+
+                self._executor.submit(run)
+            return self._rounds[key]
+
+    def status(self, data_hash, model_code, fmt='csv'):
+        """Return 'pending', 'saved', 'unchanged' or 'failed' for one split file"""
+        future = self._rounds.get((data_hash, fmt), {}).get(model_code)
+        if future is None or not future.done():
+            return 'pending'
+        if future.exception() is not None:
+            return 'failed'
+        return 'saved' if future.result()[1] else 'unchanged'
+
+    def ready_data(self, data_hash, model_code, fmt='csv'):
+        """Contents of a finished split file of this round.
+
+        None if the file is not on disk yet or has since been replaced by
+        another round's file of the same model code.
+        """
+        if self.status(data_hash, model_code, fmt) not in ('saved', 'unchanged'):
+            return None
+        path, _, digest = self._rounds[(data_hash, fmt)][model_code].result()
+        try:
+            data = read_file(path)
+        except FileNotFoundError:
+            return None
+        # The content is checked after reading, so a file replaced meanwhile is never used
+        return data if hashlib.sha256(data).hexdigest() == digest else None
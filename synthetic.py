@@ -0,0 +1,104 @@
+"""Deterministic synthetic proficiency-testing rounds for benchmarks and demos.
+
+Every model code gets its own level per test, so z-scores behave as in a real
+round. Missing results are written as zeros, as labs submit them, and a share
+of results are gross outliers. Some rows can repeat the Lab Code of another
+lab of the same model. The same arguments and seed always give the same round:
+
+    python synthetic.py round.csv --labs 100000 --models 20 --tests 8 --seed 0
+"""
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+import analysis
+
+# Test names and typical levels of a haematology panel; further tests are named T9, T10, ...
+PANEL = [('WBC', 7.5), ('RBC', 4.8), ('HGB', 14.0), ('HCT', 42.0),
+         ('MCV', 90.0), ('MCH', 30.0), ('MCHC', 33.5), ('PLT', 250.0)]
+
+FIRST_LAB_CODE = 1000
+FIRST_MODEL_CODE = 100
+
+
+def test_levels(n_tests):
+    """(name, typical level) of the first ``n_tests`` tests"""
+    levels = PANEL[:n_tests]
+    levels += [(f"T{i + 1}", 10.0 * (i + 1)) for i in range(len(levels), n_tests)]
+    return levels
+
+
+def generate_round(labs=2000, models=10, tests=8, missing_rate=0.05, outlier_rate=0.01,
+                   duplicate_rate=0.0, seed=0):
+    """A raw round of ``labs`` rows with the columns of an uploaded file.
+
+    ``missing_rate`` of the results are 0 (missing), ``outlier_rate`` are
+    shifted by 5-10 standard deviations and ``duplicate_rate`` of the rows
+    reuse the Lab Code of an earlier row of the same model.
+    """
+    rng = np.random.default_rng(seed)
+    levels = test_levels(tests)
+
+    # Models of uneven size, as in a real round
+    weights = rng.uniform(0.5, 1.5, models)
+    model_index = rng.choice(models, size=labs, p=weights / weights.sum())
+    lab_codes = np.arange(FIRST_LAB_CODE, FIRST_LAB_CODE + labs)
+
+    n_duplicates = int(round(duplicate_rate * labs))
+    if n_duplicates:
+        rows = rng.choice(np.arange(1, labs), size=min(n_duplicates, labs - 1), replace=False)
+        sources = (rng.random(len(rows)) * rows).astype(int)
+        lab_codes[rows] = lab_codes[sources]
+        model_index[rows] = model_index[sources]
+
+    df = pd.DataFrame({
+        'Lab Code': lab_codes,
+        'Brand code': rng.integers(1, 4, models)[model_index],
+        'Model code': FIRST_MODEL_CODE + model_index,
+    })
+    for name, level in levels:
+        # Every model reads a few percent high or low
+        model_level = level * rng.normal(1.0, 0.03, models)
+        spread = 0.04 * level
+        values = model_level[model_index] + rng.normal(0.0, spread, labs)
+        outliers = rng.random(labs) < outlier_rate
+        values[outliers] += rng.choice([-1.0, 1.0], outliers.sum()) * rng.uniform(5, 10, outliers.sum()) * spread
+        values = np.round(np.abs(values), 2)
+        values[rng.random(labs) < missing_rate] = 0.0
+        df[name] = values
+    return df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a deterministic synthetic round file.")
+    parser.add_argument("output", help="output file (.csv, .parquet or .feather)")
+    parser.add_argument("--labs", type=int, default=2000, help="number of rows (default: %(default)s)")
+    parser.add_argument("--models", type=int, default=10, help="number of model codes (default: %(default)s)")
+    parser.add_argument("--tests", type=int, default=8, help="number of test columns (default: %(default)s)")
+    parser.add_argument("--missing-rate", type=float, default=0.05,
+                        help="share of results written as 0 (default: %(default)s)")
+    parser.add_argument("--outlier-rate", type=float, default=0.01,
+                        help="share of results shifted by 5-10 SD (default: %(default)s)")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0,
+                        help="share of rows repeating another lab's Lab Code (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    df = generate_round(args.labs, args.models, args.tests, args.missing_rate, args.outlier_rate,
+                        args.duplicate_rate, args.seed)
+    fmt = analysis.round_format(args.output)
+    if fmt == 'parquet':
+        df.to_parquet(args.output, index=False)
+    elif fmt == 'feather':
+        df.to_feather(args.output)
+    else:
+        df.to_csv(args.output, index=False)
+    print(f"Wrote {len(df)} rows, {df['Model code'].nunique()} models and {args.tests} tests to {args.output}",
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())